@@ -0,0 +1,122 @@
+import json
+import ssl
+from typing import Optional, Union
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import httpx
+except ImportError:  # optional dependency, only needed by the async client
+    httpx = None
+
+from .transport import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+
+# Concurrent connections (and so in-flight requests) per API host
+DEFAULT_MAX_CONNECTIONS = 100
+
+
+class AsyncResponse:
+    """The parts of requests.Response the clients use."""
+
+    def __init__(self, status_code: int, headers: dict, content: bytes, url: str):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+class AsyncHTTPTransport:
+    """
+    Async HTTP client on httpx with a bounded keep-alive connection pool.
+
+    At most max_connections requests are in flight at once; the others
+    wait for a free connection. Proxies come from the usual environment
+    variables unless proxy is given, TLS certificates are verified unless
+    verify says otherwise, and redirects are followed. A request is never
+    resent once it may have reached the server, so a POST is not
+    duplicated. Errors are raised as requests exceptions so both clients
+    handle failures the same way.
+
+    Needs the optional httpx package (pip install httpx).
+    """
+
+    def __init__(self, base_url: str,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 verify: Union[bool, str, ssl.SSLContext] = True,
+                 proxy: Optional[str] = None,
+                 follow_redirects: bool = True):
+        """
+        Args:
+            base_url: Base URL of the metrics API
+            max_connections: Most concurrent requests (and open connections)
+            connect_timeout: Seconds to wait for a connection to the API
+            read_timeout: Seconds to wait for each response
+            verify: False to skip TLS verification, a CA bundle path, or an SSLContext
+            proxy: Proxy URL (default: from HTTP(S)_PROXY / NO_PROXY)
+            follow_redirects: Follow 3xx responses
+        """
+        if httpx is None:
+            raise ImportError("AsyncHTTPTransport needs the httpx package: pip install httpx")
+        self.base_url = base_url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            # Waiting for a pooled connection is not a timeout
+            timeout=self._timeout(read_timeout),
+            verify=verify,
+            proxy=proxy,
+            trust_env=True,
+            follow_redirects=follow_redirects
+        )
+
+    def _timeout(self, read_timeout: float):
+        return httpx.Timeout(read_timeout, connect=self.connect_timeout, pool=None)
+
+    async def request(self, method: str, path: str, params: Optional[dict] = None,
+                      json: Optional[object] = None, headers: Optional[dict] = None,
+                      timeout: Optional[float] = None) -> AsyncResponse:
+        """timeout overrides the read timeout for one call"""
+        url = f"{self.base_url}{path}"
+        try:
+            response = await self._client.request(
+                method, path, params=params, json=json, headers=headers,
+                timeout=self._timeout(timeout) if timeout is not None else httpx.USE_CLIENT_DEFAULT
+            )
+        except httpx.ConnectTimeout as e:
+            raise requests.ConnectTimeout(f"Connection to {self.base_url} timed out: {e}")
+        except httpx.TimeoutException as e:
+            raise requests.Timeout(f"Read timed out: {method} {url}: {e}")
+        except httpx.TooManyRedirects as e:
+            raise requests.TooManyRedirects(str(e))
+        except httpx.TransportError as e:
+            raise requests.ConnectionError(str(e) or type(e).__name__)
+        except httpx.HTTPError as e:
+            raise requests.RequestException(str(e))
+        return AsyncResponse(response.status_code, response.headers, response.content, str(response.url))
+
+    async def get(self, path: str, **kwargs) -> AsyncResponse:
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> AsyncResponse:
+        return await self.request('POST', path, **kwargs)
+
+    async def aclose(self) -> None:
+        """Close pooled connections"""
+        await self._client.aclose()
@@ -0,0 +1,118 @@
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+
+@dataclass
+class Deadband:
+    """Change threshold below which a new value is not reported."""
+    absolute: Optional[float] = None
+    percent: Optional[float] = None
+
+    def exceeded(self, previous: float, value: float) -> bool:
+        change = abs(value - previous)
+        if self.absolute is not None and change > self.absolute:
+            return True
+        if self.percent is not None:
+            if previous == 0:
+                return change > 0
+            if change / abs(previous) * 100 > self.percent:
+                return True
+        return self.absolute is None and self.percent is None and change > 0
+
+
+def parse_deadbands(spec: str) -> Dict[str, Deadband]:
+    """
+    Parse 'metric=band' pairs, e.g. 'ram_usage_percent=1,bitcoin_price_usd=0.5%'.
+
+    A trailing % makes the band relative to the last reported value.
+    """
+    deadbands = {}
+    for item in (part.strip() for part in (spec or '').split(',')):
+        if not item:
+            continue
+        metric, _, band = item.partition('=')
+        band = band.strip()
+        if not metric or not band:
+            raise ValueError(f"Invalid deadband: {item!r}. Use metric=value or metric=value%")
+        if band.endswith('%'):
+            deadbands[metric.strip()] = Deadband(percent=float(band[:-1]))
+        else:
+            deadbands[metric.strip()] = Deadband(absolute=float(band))
+    return deadbands
+
+
+class DeadbandFilter:
+    """
+    Suppresses metric values that stay within their deadband.
+
+    A value is reported when it moves outside the band around the last
+    reported value, or when the metric has been silent for max_silence
+    seconds (heartbeat). Metrics without a deadband never make a report
+    due on their own, or every sample of a noisy field (per-core CPU, IO
+    rates) would be sent; they ride along whenever another value passed
+    to the same filter() call is reported, and on their own heartbeat.
+    Suppressed values are dropped at the source; the server reconstructs
+    the series as a step function from the sparse points.
+    """
+
+    def __init__(self, deadbands: Dict[str, Deadband], max_silence: float = 300.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.deadbands = deadbands
+        self.max_silence = max_silence
+        self._clock = clock
+        self._reported = {}
+        self.suppressed = 0
+        self.reported = 0
+
+    def _silent(self, metric: str, now: float) -> bool:
+        last = self._reported.get(metric)
+        return last is None or now - last[1] >= self.max_silence
+
+    def _due(self, metric: str, value: float, now: float) -> bool:
+        if self._silent(metric, now):
+            return True
+        return self.deadbands[metric].exceeded(self._reported[metric][0], value)
+
+    def filter(self, values: dict) -> dict:
+        """Return the subset of values that should be reported and remember them"""
+        now = self._clock()
+        values = {metric: value for metric, value in values.items() if value is not None}
+        due = {metric for metric, value in values.items()
+               if metric in self.deadbands and self._due(metric, value, now)}
+        unbanded = [metric for metric in values if metric not in self.deadbands]
+        if due or any(self._silent(metric, now) for metric in unbanded):
+            due.update(unbanded)
+        reported = {}
+        for metric, value in values.items():
+            if metric in due:
+                reported[metric] = value
+                self._reported[metric] = (value, now)
+                self.reported += 1
+            else:
+                self.suppressed += 1
+        return reported
+
+    def breached(self, metric: str, low: Optional[float], high: Optional[float]) -> bool:
+        """True if a sampled range [low, high] left the band around the last reported value"""
+        deadband = self.deadbands.get(metric)
+        last = self._reported.get(metric)
+        if deadband is None:
+            return False
+        if last is None:
+            return True
+        return any(v is not None and deadband.exceeded(last[0], v) for v in (low, high))
+
+    def filter_summaries(self, summaries: dict, reporting: bool) -> dict:
+        """
+        Summaries to report: those whose range left their band, plus the
+        unbanded ones whenever anything is reported (reporting is True when
+        the snapshot's values already are).
+        """
+        kept = {
+            metric: summary for metric, summary in summaries.items()
+            if self.breached(metric, summary.min, summary.max)
+        }
+        if kept or reporting:
+            kept.update({metric: summary for metric, summary in summaries.items() if metric not in self.deadbands})
+        return kept
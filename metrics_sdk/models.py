@@ -1,18 +1,31 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 @dataclass
 class SystemMetrics:
-    """System metrics data."""
+    """System metrics data (host-wide; the optional fields are omitted when not collected)."""
     thread_count: int
     ram_usage_percent: float
+    process_count: Optional[int] = None
+    cpu_percent: Optional[float] = None
+    cpu_per_core: Optional[List[float]] = None
+    load_1: Optional[float] = None
+    load_5: Optional[float] = None
+    load_15: Optional[float] = None
+    disk_read_bytes_per_sec: Optional[float] = None
+    disk_write_bytes_per_sec: Optional[float] = None
+    net_sent_bytes_per_sec: Optional[float] = None
+    net_recv_bytes_per_sec: Optional[float] = None
+    top_processes: Optional[List[dict]] = None
 
     def to_dict(self) -> dict:
-        return {
+        data = {
             'thread_count': self.thread_count,
             'ram_usage_percent': self.ram_usage_percent
         }
+        data.update({name: value for name, value in asdict(self).items() if value is not None and name not in data})
+        return data
 
 @dataclass
 class CryptoMetrics:
@@ -26,6 +39,58 @@ class CryptoMetrics:
             'ethereum_price_usd': self.ethereum_price_usd
         }
 
+@dataclass
+class CollectorMetrics:
+    """The collector's own overhead over the interval ending at a snapshot."""
+    cpu_percent: Optional[float] = None
+    cpu_seconds: Optional[float] = None
+    rss_bytes: Optional[int] = None
+    scheduling_lag_seconds: Optional[float] = None
+    flush_seconds: Optional[float] = None
+    source_latencies: Optional[Dict[str, float]] = None
+    source_intervals: Optional[Dict[str, float]] = None
+    interval_factor: Optional[int] = None
+    under_pressure: Optional[bool] = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+@dataclass
+class MetricSummary:
+    """Statistics over the high-frequency samples of one metric in a reporting interval."""
+    count: int
+    min: Optional[float]
+    max: Optional[float]
+    mean: Optional[float]
+    last: Optional[float]
+    p95: Optional[float]
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'last': self.last,
+            'p95': self.p95
+        }
+
+    @classmethod
+    def from_values(cls, values: List[float]) -> 'MetricSummary':
+        """Summarize raw samples (p95 uses the nearest-rank method)."""
+        if not values:
+            return cls(count=0, min=None, max=None, mean=None, last=None, p95=None)
+        ordered = sorted(values)
+        rank = max(-(-95 * len(ordered) // 100) - 1, 0)
+        return cls(
+            count=len(values),
+            min=ordered[0],
+            max=ordered[-1],
+            mean=sum(values) / len(values),
+            last=values[-1],
+            p95=ordered[rank]
+        )
+
 @dataclass
 class MetricsSnapshot:
     """Complete metrics snapshot."""
@@ -34,6 +99,9 @@ class MetricsSnapshot:
     system_metrics: Optional[SystemMetrics] = None
     crypto_metrics: Optional[CryptoMetrics] = None
     snapshot_id: Optional[int] = None
+    summaries: Optional[Dict[str, MetricSummary]] = None
+    collector_metrics: Optional[CollectorMetrics] = None
+    interval_seconds: Optional[float] = None
 
     def to_dict(self) -> dict:
         data = {
@@ -46,6 +114,12 @@ class MetricsSnapshot:
             data['crypto_metrics'] = self.crypto_metrics.to_dict()
         if self.snapshot_id:
             data['snapshot_id'] = self.snapshot_id
+        if self.summaries:
+            data['summaries'] = {name: summary.to_dict() for name, summary in self.summaries.items()}
+        if self.collector_metrics:
+            data['collector_metrics'] = self.collector_metrics.to_dict()
+        if self.interval_seconds is not None:
+            data['interval_seconds'] = self.interval_seconds
         return data
 
     @classmethod
@@ -53,11 +127,33 @@ class MetricsSnapshot:
         """Create a MetricsSnapshot from a dictionary."""
         system_metrics = SystemMetrics(**data['system_metrics']) if data.get('system_metrics') else None
         crypto_metrics = CryptoMetrics(**data['crypto_metrics']) if data.get('crypto_metrics') else None
+        summaries = {
+            name: MetricSummary(**summary) for name, summary in data['summaries'].items()
+        } if data.get('summaries') else None
+        collector_metrics = CollectorMetrics(**data['collector_metrics']) if data.get('collector_metrics') else None
         
         return cls(
             device_id=data['device_id'],
             timestamp=datetime.fromisoformat(data['timestamp']),
             system_metrics=system_metrics,
             crypto_metrics=crypto_metrics,
-            snapshot_id=data.get('snapshot_id')
-        ) 
\ No newline at end of file
+            snapshot_id=data.get('snapshot_id'),
+            summaries=summaries,
+            collector_metrics=collector_metrics,
+            interval_seconds=data.get('interval_seconds')
+        ) 
+@dataclass
+class MarketPrices:
+    """Prices of many symbols on one shared time grid (one list entry per timestamp, None where missing)."""
+    step: int
+    timestamps: List[datetime]
+    prices: Dict[str, List[Optional[float]]]
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'MarketPrices':
+        """Create MarketPrices from the columnar /v1/market/prices response."""
+        return cls(
+            step=data['step'],
+            timestamps=[datetime.fromisoformat(t) for t in data['timestamps']],
+            prices=data['prices']
+        )
@@ -1,16 +1,58 @@
-from flask import Flask, request, jsonify
-from models import Device, Snapshot, SystemMetric, CryptoMetric, get_database_engine
-from sqlalchemy.orm import sessionmaker, joinedload
-from datetime import datetime, UTC
+from flask import Flask, request, jsonify, Response, stream_with_context
+from models import Device, DeviceTag, Snapshot, SystemMetric, CollectorMetric, MetricSummary, MarketSymbol, Command, CommandBatch, get_database_engine
+from commands import (
+    CommandNotifier, InvalidCommand, InvalidTransition, batch_to_dict, command_to_dict,
+    fan_out_command, poll_commands, transition_command, validate_tags
+)
+from device_cache import DeviceListCache
+from liveness import LivenessTracker, parse_duration, utcnow
+from market import crypto_as_of, enabled_symbols, insert_prices, load_series, price_rows, register_symbols
+from export import FORMATS, DEFAULT_BATCH_SIZE, iter_record_batches, parse_batch_size, stream_export, parse_timestamp
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, joinedload, selectinload
+from datetime import datetime, timedelta
 import socket
-import time
 
 app = Flask(__name__)
 
+# Rows per statement for bulk operations (stays under SQLite's bound-parameter limit)
+BULK_CHUNK_SIZE = 500
+MAX_BATCH_DEVICES = 10000
+MAX_BATCH_SNAPSHOTS = 1000
+MAX_DEVICE_PAGE_SIZE = 1000
+
+# Device listing pages, invalidated on registration
+device_list_cache = DeviceListCache()
+
+# Last-seen index, updated on ingest and persisted in batches
+liveness = LivenessTracker()
+
+# Wakes devices long-polling for commands
+command_notifier = CommandNotifier()
+MAX_POLL_TIMEOUT = 60
+
+# System metric fields accepted on upload and returned on read
+SYSTEM_FIELDS = (
+    'thread_count', 'process_count', 'ram_usage_percent',
+    'cpu_percent', 'cpu_per_core', 'load_1', 'load_5', 'load_15',
+    'disk_read_bytes_per_sec', 'disk_write_bytes_per_sec',
+    'net_sent_bytes_per_sec', 'net_recv_bytes_per_sec', 'top_processes'
+)
+# Self-instrumentation reported by the collector alongside its snapshots
+COLLECTOR_FIELDS = (
+    'cpu_percent', 'cpu_seconds', 'rss_bytes', 'scheduling_lag_seconds',
+    'flush_seconds', 'source_latencies', 'source_intervals', 'interval_factor', 'under_pressure'
+)
+
 # Initialize database connection
 engine = get_database_engine()
 Session = sessionmaker(bind=engine)
 
+# Persist last-seen times even when ingest goes quiet
+liveness.start(Session)
+
 def get_db_session():
     """Get a new database session"""
     return Session()
@@ -43,18 +85,289 @@ def register_device():
         )
         session.add(device)
         session.commit()
+        device_list_cache.invalidate()
         
         return jsonify({
             'message': 'Device registered successfully',
             'device_id': device.id
         }), 201
         
+    except IntegrityError:
+        # Lost a race with a concurrent registration of the same name
+        session.rollback()
+        existing_device = session.query(Device).filter_by(name=data['name']).first()
+        return jsonify({
+            'error': 'Device already registered',
+            'device_id': existing_device.id if existing_device else None
+        }), 409
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+def _load_device_page(session, prefix, device_type, after, limit):
+    """Fetch one page of devices ordered by name, using the name indexes"""
+    query = select(Device.id, Device.name, Device.device_type, Device.created_at)
+    
+    if device_type:
+        query = query.where(Device.device_type == device_type)
+    if prefix:
+        # Range form of a prefix match so SQLite can seek the index
+        query = query.where(Device.name >= prefix, Device.name < prefix + '\U0010ffff')
+    if after:
+        query = query.where(Device.name > after)
+        
+    # Fetch one extra row to know whether another page exists
+    rows = session.execute(query.order_by(Device.name).limit(limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    return {
+        'devices': [{
+            'device_id': row.id,
+            'name': row.name,
+            'device_type': row.device_type,
+            'created_at': row.created_at.isoformat() if row.created_at else None
+        } for row in rows],
+        'next_cursor': rows[-1].name if has_more else None
+    }
+
+def _latest_metrics(session, device_ids):
+    """Latest snapshot per device, one index seek per device on the page"""
+    if not device_ids:
+        return {}
+        
+    latest_snapshot_id = (
+        select(Snapshot.id)
+        .where(Snapshot.device_id == Device.id)
+        .order_by(Snapshot.timestamp.desc())
+        .limit(1)
+        .correlate(Device)
+        .scalar_subquery()
+    )
+    rows = session.execute(
+        select(
+            Device.id,
+            Snapshot.timestamp,
+            SystemMetric.thread_count,
+            SystemMetric.ram_usage_percent
+        )
+        .select_from(Device)
+        .join(Snapshot, Snapshot.id == latest_snapshot_id)
+        .outerjoin(SystemMetric, SystemMetric.snapshot_id == Snapshot.id)
+        .where(Device.id.in_(device_ids))
+    ).all()
+    
+    return {
+        row.id: {
+            'last_seen': row.timestamp.isoformat(),
+            'system_metrics': {
+                'thread_count': row.thread_count,
+                'ram_usage_percent': row.ram_usage_percent
+            } if row.thread_count is not None or row.ram_usage_percent is not None else None
+        }
+        for row in rows
+    }
+
+@app.route('/v1/devices', methods=['GET'])
+def list_devices():
+    """List devices with keyset pagination, name prefix search and type filter"""
+    session = get_db_session()
+    try:
+        # Get query parameters
+        prefix = request.args.get('prefix') or None
+        device_type = request.args.get('device_type') or None
+        after = request.args.get('cursor') or None
+        limit = min(int(request.args.get('limit', 100)), MAX_DEVICE_PAGE_SIZE)
+        if limit < 1:
+            return jsonify({'error': 'limit must be positive'}), 400
+            
+        # Device rows come from the cache; latest values are always fresh
+        key = (prefix, device_type, after, limit)
+        page = device_list_cache.get(key)
+        if page is None:
+            generation = device_list_cache.generation()
+            page = _load_device_page(session, prefix, device_type, after, limit)
+            device_list_cache.put(key, page, generation)
+            
+        latest = _latest_metrics(session, [d['device_id'] for d in page['devices']])
+        liveness.refresh(session)
+        devices = []
+        for device in page['devices']:
+            values = latest.get(device['device_id'], {})
+            last_seen = liveness.last_seen(device['device_id'])
+            devices.append({
+                **device,
+                'last_seen': last_seen.isoformat() if last_seen else values.get('last_seen'),
+                'latest_system_metrics': values.get('system_metrics')
+            })
+            
+        return jsonify({
+            'devices': devices,
+            'next_cursor': page['next_cursor']
+        }), 200
+        
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query parameter: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/v1/devices/stale', methods=['GET'])
+def list_stale_devices():
+    """List devices that have not reported for longer than older_than"""
+    session = get_db_session()
+    try:
+        try:
+            older_than = parse_duration(request.args.get('older_than', '5m'))
+            limit = int(request.args.get('limit', 1000))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+            
+        liveness.refresh(session)
+        now = utcnow()
+        stale = liveness.stale(now - older_than, limit=limit)
+        
+        return jsonify({
+            'older_than_seconds': older_than.total_seconds(),
+            'devices': [{
+                'device_id': device_id,
+                'last_seen': last_seen.isoformat(),
+                'seconds_since_seen': (now - last_seen).total_seconds()
+            } for device_id, last_seen in stale]
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/v1/devices/liveness', methods=['GET'])
+def liveness_summary():
+    """Summarize how many devices are reporting"""
+    session = get_db_session()
+    try:
+        try:
+            older_than = parse_duration(request.args.get('older_than', '5m'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+            
+        liveness.refresh(session)
+        summary = liveness.summary(utcnow() - older_than)
+        total_devices = session.query(Device).count()
+        
+        return jsonify({
+            **summary,
+            'total_devices': total_devices,
+            'never_seen_devices': max(total_devices - summary['tracked_devices'], 0),
+            'older_than_seconds': older_than.total_seconds()
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/v1/devices/batch', methods=['POST'])
+def register_devices_batch():
+    """Register or update many devices in one transaction"""
+    session = get_db_session()
+    try:
+        data = request.get_json()
+        devices = data.get('devices') if data else None
+        
+        # Validate payload
+        if not isinstance(devices, list) or not devices:
+            return jsonify({'error': 'Missing required field: devices'}), 400
+        if len(devices) > MAX_BATCH_DEVICES:
+            return jsonify({
+                'error': f'Too many devices in one batch (max {MAX_BATCH_DEVICES})'
+            }), 400
+            
+        # Last entry wins when a name appears twice in the same batch
+        rows = {}
+        for index, entry in enumerate(devices):
+            if not isinstance(entry, dict) or not entry.get('name') or not entry.get('device_type'):
+                return jsonify({
+                    'error': f'Device at index {index} is missing required fields: name and device_type'
+                }), 400
+            rows[entry['name']] = {'name': entry['name'], 'device_type': entry['device_type']}
+        rows = list(rows.values())
+        
+        # Upsert against the unique index on name
+        for start in range(0, len(rows), BULK_CHUNK_SIZE):
+            chunk = rows[start:start + BULK_CHUNK_SIZE]
+            stmt = sqlite_insert(Device).values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Device.name],
+                set_={'device_type': stmt.excluded.device_type}
+            )
+            session.execute(stmt)
+            
+        # Resolve ids for every name in the batch
+        device_ids = {}
+        names = [row['name'] for row in rows]
+        for start in range(0, len(names), BULK_CHUNK_SIZE):
+            chunk = names[start:start + BULK_CHUNK_SIZE]
+            for device_id, name in session.execute(
+                select(Device.id, Device.name).where(Device.name.in_(chunk))
+            ):
+                device_ids[name] = device_id
+                
+        session.commit()
+        device_list_cache.invalidate()
+        
+        return jsonify({
+            'message': f'{len(device_ids)} devices registered',
+            'devices': device_ids
+        }), 200
+        
     except Exception as e:
         session.rollback()
         return jsonify({'error': str(e)}), 500
     finally:
         session.close()
 
+def _build_snapshot(session, device_id, data, timestamp):
+    """Snapshot with its system, collector and summary rows added to the session (crypto is stored separately)"""
+    snapshot = Snapshot(
+        device_id=device_id,
+        timestamp=timestamp,
+        interval_seconds=data.get('interval_seconds')
+    )
+    
+    # Add system metrics if provided
+    if 'system_metrics' in data:
+        session.add(SystemMetric(
+            snapshot=snapshot,
+            **{field: data['system_metrics'].get(field) for field in SYSTEM_FIELDS}
+        ))
+        
+    # Add collector self-instrumentation if provided
+    if 'collector_metrics' in data:
+        session.add(CollectorMetric(
+            snapshot=snapshot,
+            **{field: data['collector_metrics'].get(field) for field in COLLECTOR_FIELDS}
+        ))
+        
+    # Add high-frequency sample summaries if provided
+    for metric, summary in (data.get('summaries') or {}).items():
+        session.add(MetricSummary(
+            snapshot=snapshot,
+            metric=metric,
+            sample_count=summary.get('count', 0),
+            min=summary.get('min'),
+            max=summary.get('max'),
+            mean=summary.get('mean'),
+            last=summary.get('last'),
+            p95=summary.get('p95')
+        ))
+        
+    session.add(snapshot)
+    return snapshot
+
 @app.route('/v1/metrics', methods=['POST'])
 def upload_metrics():
     """Upload new metrics for a device"""
@@ -72,32 +385,20 @@ def upload_metrics():
             return jsonify({'error': 'Device not found'}), 404
             
         # Create new snapshot with metrics
-        snapshot = Snapshot(
-            device_id=device.id,
-            timestamp=datetime.utcnow()
-        )
+        snapshot = _build_snapshot(session, device.id, data, datetime.utcnow())
         
-        # Add system metrics if provided
-        if 'system_metrics' in data:
-            system_metrics = SystemMetric(
-                snapshot=snapshot,
-                thread_count=data['system_metrics'].get('thread_count'),
-                ram_usage_percent=data['system_metrics'].get('ram_usage_percent')
-            )
-            session.add(system_metrics)
-            
-        # Add crypto metrics if provided
+        # Crypto prices go to the shared market series, once per interval for all devices
         if 'crypto_metrics' in data:
-            crypto_metrics = CryptoMetric(
-                snapshot=snapshot,
-                bitcoin_price_usd=data['crypto_metrics'].get('bitcoin_price_usd'),
-                ethereum_price_usd=data['crypto_metrics'].get('ethereum_price_usd')
-            )
-            session.add(crypto_metrics)
+            insert_prices(session, price_rows(data['crypto_metrics'], snapshot.timestamp))
             
-        session.add(snapshot)
         session.commit()
         
+        # Update the last-seen index; persistence is batched
+        liveness.ensure_loaded(session)
+        liveness.touch(device.id, snapshot.timestamp)
+        if liveness.flush_due():
+            liveness.flush(session)
+        
         return jsonify({
             'message': 'Metrics uploaded successfully',
             'snapshot_id': snapshot.id
@@ -109,6 +410,133 @@ def upload_metrics():
     finally:
         session.close()
 
+@app.route('/v1/metrics/batch', methods=['POST'])
+def upload_metrics_batch():
+    """Upload many snapshots in one transaction, keeping their client timestamps"""
+    session = get_db_session()
+    try:
+        data = request.get_json()
+        snapshots = data.get('snapshots') if data else None
+        
+        # Validate payload
+        if not isinstance(snapshots, list) or not snapshots:
+            return jsonify({'error': 'Missing required field: snapshots'}), 400
+        if len(snapshots) > MAX_BATCH_SNAPSHOTS:
+            return jsonify({
+                'error': f'Too many snapshots in one batch (max {MAX_BATCH_SNAPSHOTS})'
+            }), 400
+        
+        # Invalid entries are rejected one by one; the rest of the batch is still stored
+        errors = {}
+        timestamps = {}
+        for index, entry in enumerate(snapshots):
+            if not isinstance(entry, dict) or not isinstance(entry.get('device_id'), int):
+                errors[index] = 'Missing device_id'
+                continue
+            try:
+                timestamps[index] = parse_timestamp(entry.get('timestamp')) or datetime.utcnow()
+            except (AttributeError, TypeError, ValueError):
+                errors[index] = 'Invalid timestamp'
+                
+        # Check every device exists with one query
+        device_ids = {snapshots[index]['device_id'] for index in timestamps}
+        known = set(session.execute(select(Device.id).where(Device.id.in_(device_ids))).scalars())
+        for index in list(timestamps):
+            if snapshots[index]['device_id'] not in known:
+                errors[index] = f"Device not found: {snapshots[index]['device_id']}"
+                del timestamps[index]
+                
+        if not timestamps:
+            return jsonify({
+                'error': 'No valid snapshots in batch',
+                'errors': [{'index': index, 'error': error} for index, error in sorted(errors.items())]
+            }), 400
+            
+        created = {}
+        market_rows = []
+        last_seen = {}
+        for index, timestamp in timestamps.items():
+            entry = snapshots[index]
+            created[index] = _build_snapshot(session, entry['device_id'], entry, timestamp)
+            if 'crypto_metrics' in entry:
+                market_rows.extend(price_rows(entry['crypto_metrics'], timestamp))
+            last_seen[entry['device_id']] = max(timestamp, last_seen.get(entry['device_id'], timestamp))
+        insert_prices(session, market_rows)
+        session.commit()
+        
+        # Update the last-seen index; persistence is batched
+        liveness.ensure_loaded(session)
+        for device_id, timestamp in last_seen.items():
+            liveness.touch(device_id, timestamp)
+        if liveness.flush_due():
+            liveness.flush(session)
+            
+        return jsonify({
+            'message': f'{len(created)} snapshots uploaded',
+            # One id per submitted entry, None where the entry was rejected
+            'snapshot_ids': [created[index].id if index in created else None for index in range(len(snapshots))],
+            'errors': [{'index': index, 'error': error} for index, error in sorted(errors.items())]
+        }), 201
+        
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+# Metric groups whose values may be suppressed at the source and carried forward on read
+# (crypto prices are already carried forward by the as-of join onto the market series)
+FILL_FIELDS = {
+    'system_metrics': (SystemMetric, SYSTEM_FIELDS),
+}
+
+def _previous_value(session, model, field, device_id, before):
+    """Last non-null value of a field reported by a device before a timestamp"""
+    column = getattr(model, field)
+    return session.execute(
+        select(column)
+        .join(Snapshot, Snapshot.id == model.snapshot_id)
+        .where(Snapshot.device_id == device_id, Snapshot.timestamp < before, column.is_not(None))
+        .order_by(Snapshot.timestamp.desc())
+        .limit(1)
+    ).scalar()
+
+def _fill_previous(session, results):
+    """Fill missing values in formatted results with each device's last reported value"""
+    by_device = {}
+    for result in results:
+        by_device.setdefault(result['device_id'], []).append(result)
+        
+    for device_id, rows in by_device.items():
+        rows.sort(key=lambda r: r['timestamp'])
+        oldest = datetime.fromisoformat(rows[0]['timestamp'])
+        carried = {}
+        for group, (model, fields) in FILL_FIELDS.items():
+            first = rows[0][group] or {}
+            for field in fields:
+                value = first.get(field)
+                if value is None:
+                    value = _previous_value(session, model, field, device_id, oldest)
+                carried[(group, field)] = value
+                
+        for row in rows:
+            for group, (model, fields) in FILL_FIELDS.items():
+                values = dict(row[group] or {})
+                for field in fields:
+                    if values.get(field) is None:
+                        values[field] = carried[(group, field)]
+                    carried[(group, field)] = values[field]
+                row[group] = values if any(v is not None for v in values.values()) else None
+
+def _crypto_metrics(snapshot, market_prices):
+    """Legacy per-snapshot prices if the snapshot has them, else the market prices as of its timestamp"""
+    if snapshot.crypto_metrics:
+        return {
+            'bitcoin_price_usd': snapshot.crypto_metrics.bitcoin_price_usd,
+            'ethereum_price_usd': snapshot.crypto_metrics.ethereum_price_usd
+        }
+    return market_prices.get(snapshot.timestamp)
+
 @app.route('/v1/metrics', methods=['GET'])
 def get_metrics():
     """Retrieve metrics with filtering options"""
@@ -133,9 +561,14 @@ def get_metrics():
         # Get results with related metrics
         snapshots = query.options(
             joinedload(Snapshot.system_metrics),
-            joinedload(Snapshot.crypto_metrics)
+            joinedload(Snapshot.crypto_metrics),
+            joinedload(Snapshot.collector_metrics),
+            selectinload(Snapshot.summaries)
         ).order_by(Snapshot.timestamp.desc()).limit(limit).all()
         
+        # Market prices as of each snapshot (one range read for the page)
+        market_prices = crypto_as_of(session, [s.timestamp for s in snapshots])
+        
         # Format response
         results = []
         for snapshot in snapshots:
@@ -143,17 +576,31 @@ def get_metrics():
                 'snapshot_id': snapshot.id,
                 'device_id': snapshot.device_id,
                 'timestamp': snapshot.timestamp.isoformat(),
+                'interval_seconds': snapshot.interval_seconds,
                 'system_metrics': {
-                    'thread_count': snapshot.system_metrics.thread_count,
-                    'ram_usage_percent': snapshot.system_metrics.ram_usage_percent
+                    field: getattr(snapshot.system_metrics, field) for field in SYSTEM_FIELDS
                 } if snapshot.system_metrics else None,
-                'crypto_metrics': {
-                    'bitcoin_price_usd': snapshot.crypto_metrics.bitcoin_price_usd,
-                    'ethereum_price_usd': snapshot.crypto_metrics.ethereum_price_usd
-                } if snapshot.crypto_metrics else None
+                'crypto_metrics': _crypto_metrics(snapshot, market_prices),
+                'collector_metrics': {
+                    field: getattr(snapshot.collector_metrics, field) for field in COLLECTOR_FIELDS
+                } if snapshot.collector_metrics else None,
+                'summaries': {
+                    summary.metric: {
+                        'count': summary.sample_count,
+                        'min': summary.min,
+                        'max': summary.max,
+                        'mean': summary.mean,
+                        'last': summary.last,
+                        'p95': summary.p95
+                    } for summary in snapshot.summaries
+                } or None
             }
             results.append(result)
             
+        # Reconstruct step-wise series from deadband-suppressed values
+        if request.args.get('fill') == 'previous':
+            _fill_previous(session, results)
+            
         return jsonify(results), 200
         
     except Exception as e:
@@ -161,6 +608,44 @@ def get_metrics():
     finally:
         session.close()
 
+@app.route('/v1/metrics/export', methods=['GET'])
+def export_metrics():
+    """Stream a device/time-range selection as Parquet or Arrow IPC"""
+    fmt = request.args.get('format', 'parquet')
+    if fmt not in FORMATS:
+        return jsonify({
+            'error': f"Unsupported format: {fmt}. Use one of: {', '.join(FORMATS)}"
+        }), 400
+
+    try:
+        device_ids = [int(d) for d in request.args.getlist('device_id')]
+        start_time = parse_timestamp(request.args.get('start_time'))
+        end_time = parse_timestamp(request.args.get('end_time'))
+        batch_size = parse_batch_size(request.args.get('batch_size', DEFAULT_BATCH_SIZE))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query parameter: {str(e)}'}), 400
+
+    def generate():
+        session = get_db_session()
+        try:
+            batches = iter_record_batches(
+                session,
+                device_ids=device_ids,
+                start_time=start_time,
+                end_time=end_time,
+                batch_size=batch_size
+            )
+            yield from stream_export(batches, fmt)
+        finally:
+            session.close()
+
+    extension = 'parquet' if fmt == 'parquet' else 'arrows'
+    return Response(
+        stream_with_context(generate()),
+        mimetype=FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename=metrics.{extension}'}
+    )
+
 @app.route('/v1/snapshots', methods=['GET'])
 def get_snapshots():
     """Retrieve snapshot summaries"""
@@ -178,6 +663,7 @@ def get_snapshots():
             
         # Get results
         snapshots = query.order_by(Snapshot.timestamp.desc()).limit(limit).all()
+        market_prices = crypto_as_of(session, [s.timestamp for s in snapshots])
         
         # Format response
         results = []
@@ -187,8 +673,9 @@ def get_snapshots():
                 'device_id': snapshot.device_id,
                 'device_name': snapshot.device.name,
                 'timestamp': snapshot.timestamp.isoformat(),
+                'interval_seconds': snapshot.interval_seconds,
                 'has_system_metrics': snapshot.system_metrics is not None,
-                'has_crypto_metrics': snapshot.crypto_metrics is not None
+                'has_crypto_metrics': _crypto_metrics(snapshot, market_prices) is not None
             }
             results.append(result)
             
@@ -199,6 +686,67 @@ def get_snapshots():
     finally:
         session.close()
 
+@app.route('/v1/market/symbols', methods=['GET'])
+def list_market_symbols():
+    """List the market symbol registry"""
+    session = get_db_session()
+    try:
+        symbols = session.query(MarketSymbol).order_by(MarketSymbol.id).all()
+        return jsonify({
+            'symbols': [{'symbol': s.symbol, 'enabled': s.enabled} for s in symbols]
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/v1/market/symbols', methods=['POST'])
+def add_market_symbols():
+    """Register symbols for the market ingester, or enable/disable them"""
+    session = get_db_session()
+    try:
+        data = request.get_json() or {}
+        symbols = data.get('symbols')
+        if not symbols or not isinstance(symbols, list):
+            return jsonify({'error': 'symbols must be a non-empty list'}), 400
+        
+        ids = register_symbols(session, [str(s).strip() for s in symbols if str(s).strip()],
+                               enabled=bool(data.get('enabled', True)))
+        session.commit()
+        return jsonify({'symbols': sorted(ids)}), 200
+        
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/v1/market/prices', methods=['GET'])
+def get_market_prices():
+    """Prices of many symbols on one time grid, returned column-wise"""
+    try:
+        symbols = [s for s in request.args.get('symbols', '').split(',') if s]
+        end_time = parse_timestamp(request.args.get('end_time')) or datetime.utcnow()
+        start_time = parse_timestamp(request.args.get('start_time')) or end_time - timedelta(days=1)
+        step = int(request.args.get('step', 60))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query parameter: {str(e)}'}), 400
+    
+    session = get_db_session()
+    try:
+        if not symbols:
+            symbols = enabled_symbols(session)
+        series = load_series(session, symbols, start_time, end_time, step=step)
+        return jsonify({
+            'step': series['step'],
+            'timestamps': [t.isoformat() for t in series['timestamps']],
+            'prices': series['prices']
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
 @app.route('/v1/devices/<int:device_id>/commands', methods=['POST'])
 def send_command(device_id):
     """Send a command to a specific device"""
@@ -248,15 +796,24 @@ def send_command(device_id):
                 
             force = command_params.get('force', False)
             
-            # In a real system, this would send the restart command to the device
-            # For now, we'll just log it and return success
-            app.logger.info(f"Restarting app '{app_name}' on device {device_id} (force={force})")
+            # Queue the command; the device picks it up by long-polling
+            command = Command(
+                device_id=device_id,
+                command_type=command_type,
+                params={'app_name': app_name, 'force': force},
+                status='queued'
+            )
+            session.add(command)
+            session.commit()
+            command_notifier.notify(device_id)
+            
+            app.logger.info(f"Queued restart of app '{app_name}' on device {device_id} (force={force}) as command {command.id}")
             
             response_data = {
                 'message': f"Restart command for app '{app_name}' sent successfully to device {device_id}",
-                'status': 'queued',
-                'command_id': int(time.time()),
-                'timestamp': datetime.now(UTC).isoformat(),
+                'status': command.status,
+                'command_id': command.id,
+                'timestamp': command.created_at.isoformat(),
                 'details': {
                     'app_name': app_name,
                     'force': force
@@ -280,5 +837,187 @@ def send_command(device_id):
     finally:
         session.close()
 
+@app.route('/v1/devices/<int:device_id>/tags', methods=['PUT'])
+def set_device_tags(device_id):
+    """Replace the tags of a device"""
+    session = get_db_session()
+    try:
+        data = request.get_json()
+        tags = data.get('tags') if data else None
+        if tags is None:
+            return jsonify({'error': 'Missing required field: tags'}), 400
+        try:
+            validate_tags(tags)
+        except InvalidCommand as e:
+            return jsonify({'error': str(e)}), 400
+            
+        if session.get(Device, device_id) is None:
+            return jsonify({'error': f'Device with ID {device_id} not found'}), 404
+            
+        session.query(DeviceTag).filter_by(device_id=device_id).delete()
+        session.add_all(DeviceTag(device_id=device_id, tag=tag) for tag in set(tags))
+        session.commit()
+        
+        return jsonify({'device_id': device_id, 'tags': sorted(set(tags))}), 200
+        
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/v1/devices/tags', methods=['POST'])
+def add_device_tags():
+    """Add tags to many devices in one transaction"""
+    session = get_db_session()
+    try:
+        data = request.get_json()
+        device_ids = data.get('device_ids') if data else None
+        tags = data.get('tags') if data else None
+        if device_ids is None or not tags:
+            return jsonify({'error': 'Missing required fields: device_ids and tags'}), 400
+        try:
+            validate_tags(tags, device_ids)
+        except InvalidCommand as e:
+            return jsonify({'error': str(e)}), 400
+            
+        # device_tags has no enforced foreign key; refuse to create orphan rows
+        ids = sorted(set(device_ids))
+        found = set()
+        for start in range(0, len(ids), BULK_CHUNK_SIZE):
+            found.update(session.scalars(
+                select(Device.id).where(Device.id.in_(ids[start:start + BULK_CHUNK_SIZE]))
+            ))
+        missing = [d for d in ids if d not in found]
+        if missing:
+            return jsonify({'error': f'Devices not found: {missing[:10]}', 'missing_device_ids': missing}), 404
+            
+        rows = [{'device_id': d, 'tag': t} for d in set(device_ids) for t in set(tags)]
+        for start in range(0, len(rows), BULK_CHUNK_SIZE):
+            stmt = sqlite_insert(DeviceTag).values(rows[start:start + BULK_CHUNK_SIZE])
+            session.execute(stmt.on_conflict_do_nothing())
+        session.commit()
+        
+        return jsonify({'message': f'Tagged {len(set(device_ids))} devices'}), 200
+        
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/v1/commands/fanout', methods=['POST'])
+def fan_out():
+    """Queue a command for every device matching a tag/type selector"""
+    session = get_db_session()
+    try:
+        data = request.get_json()
+        if not data or not data.get('command_type'):
+            return jsonify({'error': 'Missing required field: command_type'}), 400
+            
+        try:
+            batch, device_ids = fan_out_command(
+                session,
+                data['command_type'],
+                data.get('params', {}),
+                data.get('selector') or {}
+            )
+        except InvalidCommand as e:
+            return jsonify({'error': str(e)}), 400
+            
+        session.commit()
+        command_notifier.notify_many(device_ids)
+        
+        app.logger.info(f"Queued {data['command_type']} for {batch.target_count} devices as batch {batch.id}")
+        return jsonify(batch_to_dict(batch)), 201
+        
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/v1/commands/batches/<int:batch_id>', methods=['GET'])
+def get_command_batch(batch_id):
+    """Get aggregate progress of a fan-out"""
+    session = get_db_session()
+    try:
+        batch = session.get(CommandBatch, batch_id)
+        if not batch:
+            return jsonify({'error': f'Command batch with ID {batch_id} not found'}), 404
+        return jsonify(batch_to_dict(batch)), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/v1/devices/<int:device_id>/commands/poll', methods=['GET'])
+def poll_device_commands(device_id):
+    """Long-poll for queued commands; blocks until one arrives or timeout expires"""
+    session = get_db_session()
+    try:
+        try:
+            timeout = min(float(request.args.get('timeout', 30)), MAX_POLL_TIMEOUT)
+            limit = int(request.args.get('max', 10))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid query parameter: {str(e)}'}), 400
+            
+        # Check if device exists
+        if session.get(Device, device_id) is None:
+            return jsonify({'error': f'Device with ID {device_id} not found'}), 404
+        session.rollback()
+        
+        commands = poll_commands(session, command_notifier, device_id, max(timeout, 0), limit)
+        return jsonify({'commands': commands}), 200
+        
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/v1/commands/<int:command_id>', methods=['GET'])
+def get_command(command_id):
+    """Get the current state of a command"""
+    session = get_db_session()
+    try:
+        command = session.get(Command, command_id)
+        if not command:
+            return jsonify({'error': f'Command with ID {command_id} not found'}), 404
+        return jsonify(command_to_dict(command)), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
+@app.route('/v1/commands/<int:command_id>/status', methods=['POST'])
+def update_command_status(command_id):
+    """Report command progress from the device (acked, done or failed)"""
+    session = get_db_session()
+    try:
+        data = request.get_json()
+        if not data or not data.get('status'):
+            return jsonify({'error': 'Missing required field: status'}), 400
+            
+        command = session.get(Command, command_id)
+        if not command:
+            return jsonify({'error': f'Command with ID {command_id} not found'}), 404
+            
+        try:
+            transition_command(session, command, data['status'], data.get('result'))
+        except InvalidTransition as e:
+            return jsonify({'error': str(e), 'status': command.status}), 409
+            
+        session.commit()
+        return jsonify(command_to_dict(command)), 200
+        
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        session.close()
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000) 
\ No newline at end of file
@@ -0,0 +1,137 @@
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import time
+from datetime import datetime, UTC
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+def _json_default(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line.
+
+    Structured data passed as extra={'fields': {...}} is merged into the
+    object, so callers never pre-format payloads themselves; the (costly)
+    serialization runs on the listener thread.
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, UTC).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'), default=_json_default)
+
+
+class SampleRateFilter(logging.Filter):
+    """
+    Rate-limits per-sample records.
+
+    Records logged with extra={'sample': True} pass at most once per
+    interval seconds; the number dropped since the last one that passed is
+    attached to it as 'suppressed'. All other records pass unchanged.
+    """
+
+    def __init__(self, interval=60.0, clock=time.monotonic):
+        super().__init__()
+        self.interval = interval
+        self._clock = clock
+        self._last = None
+        self.suppressed = 0
+
+    def filter(self, record):
+        if not getattr(record, 'sample', False):
+            return True
+        now = self._clock()
+        if self._last is not None and now - self._last < self.interval:
+            self.suppressed += 1
+            return False
+        self._last = now
+        record.suppressed, self.suppressed = self.suppressed, 0
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of blocking or raising when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def gzip_namer(name):
+    return name + '.gz'
+
+
+def gzip_rotator(source, dest):
+    """Compress a rotated log file into dest and remove the original"""
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def setup_logging(path='logs/metrics.log', max_bytes=10 * 1024 * 1024, backup_count=5,
+                  sample_interval=60.0, queue_size=10000, name='MetricsCollector',
+                  also=('PriceFeed', 'MarketIngester')):
+    """
+    Route a logger through a background writer.
+
+    The calling thread only enqueues records; a QueueListener thread
+    formats them as JSON lines and writes them to the console and to a
+    size-rotated, gzip-compressed file. The loggers named in `also` (the
+    price feed and market ingester the collector runs in-process) share
+    the same pipeline. Returns (logger, listener); call listener.stop() on
+    shutdown to drain the queue.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    formatter = JsonFormatter()
+
+    # Set up rotating file handler; rotated files are compressed
+    file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.namer = gzip_namer
+    file_handler.rotator = gzip_rotator
+    file_handler.setFormatter(formatter)
+
+    # Set up console handler
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SampleRateFilter(sample_interval))
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+
+    # Set up loggers
+    for logger_name in (*also, name):
+        logger = logging.getLogger(logger_name)
+        logger.setLevel(logging.INFO)
+        logger.addHandler(queue_handler)
+    listener.start()
+
+    return logger, listener
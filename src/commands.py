@@ -0,0 +1,288 @@
+import threading
+import time
+from datetime import datetime, UTC
+
+from sqlalchemy import select, update, func, literal, insert, JSON
+
+from models import Command, CommandBatch, Device, DeviceTag
+
+# Command lifecycle; a command only ever moves forward through these states
+TRANSITIONS = {
+    'queued': {'delivered', 'failed'},
+    'delivered': {'acked', 'failed'},
+    'acked': {'done', 'failed'},
+    'done': set(),
+    'failed': set(),
+}
+COMMAND_STATES = tuple(TRANSITIONS)
+# device_tags.tag column width
+MAX_TAG_LENGTH = 100
+FINAL_STATES = {'done', 'failed'}
+
+
+class InvalidTransition(ValueError):
+    """Raised when a status update would move a command backwards or out of a final state"""
+
+
+class InvalidCommand(ValueError):
+    """Raised when a command type or its parameters are not supported"""
+
+
+def validate_command(command_type, params):
+    """Check a command against the supported types and return its normalized params"""
+    params = params or {}
+    if command_type == 'restart_app':
+        if not params.get('app_name'):
+            raise InvalidCommand('Missing required parameter: app_name')
+        return {'app_name': params['app_name'], 'force': params.get('force', False)}
+    raise InvalidCommand(f"Unsupported command type: {command_type}. Only 'restart_app' is supported.")
+
+
+def command_to_dict(command):
+    return {
+        'command_id': command.id,
+        'device_id': command.device_id,
+        'command_type': command.command_type,
+        'params': command.params or {},
+        'status': command.status,
+        'result': command.result,
+        'created_at': command.created_at.isoformat() if command.created_at else None,
+        'updated_at': command.updated_at.isoformat() if command.updated_at else None,
+        'delivered_at': command.delivered_at.isoformat() if command.delivered_at else None
+    }
+
+
+def batch_to_dict(batch):
+    return {
+        'batch_id': batch.id,
+        'command_type': batch.command_type,
+        'params': batch.params or {},
+        'selector': batch.selector or {},
+        'created_at': batch.created_at.isoformat() if batch.created_at else None,
+        'target_count': batch.target_count,
+        'counts': {state: getattr(batch, f'{state}_count') for state in COMMAND_STATES}
+    }
+
+
+def _shift_batch_counts(session, batch_id, from_status, to_status, count=1):
+    """Move count commands of a batch between per-state counters"""
+    from_column = getattr(CommandBatch, f'{from_status}_count')
+    to_column = getattr(CommandBatch, f'{to_status}_count')
+    session.execute(
+        update(CommandBatch)
+        .where(CommandBatch.id == batch_id)
+        .values({from_column: from_column - count, to_column: to_column + count})
+    )
+
+
+class CommandNotifier:
+    """
+    Wakes long-polling devices when a command is queued for them.
+
+    Each device has a version counter bumped on notify(); waiters pass the
+    version they saw before checking the queue, so a command queued between
+    the check and the wait is never missed. Only waiters for the notified
+    device are woken.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._conditions = {}
+        self._waiters = {}
+
+    def version(self, device_id):
+        with self._lock:
+            return self._versions.get(device_id, 0)
+
+    def notify(self, device_id):
+        with self._lock:
+            self._versions[device_id] = self._versions.get(device_id, 0) + 1
+            condition = self._conditions.get(device_id)
+        if condition is not None:
+            with condition:
+                condition.notify_all()
+
+    def notify_many(self, device_ids):
+        for device_id in device_ids:
+            self.notify(device_id)
+
+    def wait(self, device_id, seen_version, timeout):
+        """Block until device_id is notified after seen_version or timeout expires"""
+        with self._lock:
+            condition = self._conditions.setdefault(device_id, threading.Condition())
+            self._waiters[device_id] = self._waiters.get(device_id, 0) + 1
+        try:
+            with condition:
+                return condition.wait_for(
+                    lambda: self.version(device_id) != seen_version,
+                    timeout=timeout
+                )
+        finally:
+            with self._lock:
+                self._waiters[device_id] -= 1
+                # Drop idle conditions so memory tracks active pollers only
+                if not self._waiters[device_id]:
+                    del self._waiters[device_id]
+                    del self._conditions[device_id]
+
+
+def claim_commands(session, device_id, limit):
+    """Move up to limit queued commands for a device to delivered and return them"""
+    candidates = session.execute(
+        select(Command.id, Command.batch_id)
+        .where(Command.device_id == device_id, Command.status == 'queued')
+        .order_by(Command.id)
+        .limit(limit)
+    ).all()
+
+    now = datetime.now(UTC)
+    claimed = []
+    delivered_per_batch = {}
+    for command_id, batch_id in candidates:
+        # Conditional update so concurrent pollers never deliver a command twice
+        result = session.execute(
+            update(Command)
+            .where(Command.id == command_id, Command.status == 'queued')
+            .values(status='delivered', delivered_at=now, updated_at=now)
+        )
+        if result.rowcount == 1:
+            claimed.append(command_id)
+            if batch_id is not None:
+                delivered_per_batch[batch_id] = delivered_per_batch.get(batch_id, 0) + 1
+    for batch_id, count in delivered_per_batch.items():
+        _shift_batch_counts(session, batch_id, 'queued', 'delivered', count)
+    session.commit()
+
+    if not claimed:
+        return []
+    commands = session.execute(
+        select(Command).where(Command.id.in_(claimed)).order_by(Command.id)
+    ).scalars().all()
+    return [command_to_dict(command) for command in commands]
+
+
+def poll_commands(session, notifier, device_id, timeout, limit):
+    """Long-poll: return claimed commands as soon as any exist, or [] after timeout"""
+    deadline = time.monotonic() + timeout
+    while True:
+        seen_version = notifier.version(device_id)
+        commands = claim_commands(session, device_id, limit)
+        remaining = deadline - time.monotonic()
+        if commands or remaining <= 0:
+            return commands
+        # claim_commands committed, so no connection is held while waiting
+        notifier.wait(device_id, seen_version, remaining)
+
+
+def transition_command(session, command, status, result=None):
+    """Apply a status update, enforcing the command state machine"""
+    if status not in TRANSITIONS:
+        raise InvalidTransition(f"Unknown status: {status}. Use one of: {', '.join(COMMAND_STATES)}")
+    if status not in TRANSITIONS[command.status]:
+        raise InvalidTransition(f"Cannot move command {command.id} from {command.status} to {status}")
+
+    values = {'status': status, 'updated_at': datetime.now(UTC)}
+    if result is not None:
+        values['result'] = result
+    # Conditional update so concurrent reports never apply a transition twice
+    updated = session.execute(
+        update(Command)
+        .where(Command.id == command.id, Command.status == command.status)
+        .values(values)
+        .execution_options(synchronize_session=False)
+    )
+    if updated.rowcount != 1:
+        session.refresh(command)
+        raise InvalidTransition(f"Cannot move command {command.id} from {command.status} to {status}")
+
+    if command.batch_id is not None:
+        _shift_batch_counts(session, command.batch_id, command.status, status)
+    session.refresh(command)
+    return command
+
+
+def select_devices(selector):
+    """Build a select of device ids matching a fan-out selector"""
+    query = select(Device.id)
+    tags = selector.get('tags') or []
+    if tags:
+        # Devices carrying every listed tag
+        tagged = (
+            select(DeviceTag.device_id)
+            .where(DeviceTag.tag.in_(tags))
+            .group_by(DeviceTag.device_id)
+            .having(func.count() == len(set(tags)))
+        )
+        query = query.where(Device.id.in_(tagged))
+    if selector.get('device_type'):
+        query = query.where(Device.device_type == selector['device_type'])
+    if selector.get('device_ids'):
+        query = query.where(Device.id.in_(selector['device_ids']))
+    return query
+
+
+def _is_id_list(value):
+    return isinstance(value, list) and all(isinstance(d, int) and not isinstance(d, bool) for d in value)
+
+
+def validate_selector(selector):
+    """Check a fan-out selector's shape so bad input is a 400 rather than a failed query"""
+    if not isinstance(selector, dict):
+        raise InvalidCommand('Selector must be an object')
+    tags = selector.get('tags')
+    if tags is not None and (not isinstance(tags, list) or not all(isinstance(t, str) for t in tags)):
+        raise InvalidCommand('Selector tags must be a list of strings')
+    device_ids = selector.get('device_ids')
+    if device_ids is not None and not _is_id_list(device_ids):
+        raise InvalidCommand('Selector device_ids must be a list of integers')
+    device_type = selector.get('device_type')
+    if device_type is not None and not isinstance(device_type, str):
+        raise InvalidCommand('Selector device_type must be a string')
+    if not any(selector.get(key) for key in ('tags', 'device_type', 'device_ids')):
+        raise InvalidCommand('Selector must include tags, device_type or device_ids')
+
+
+def validate_tags(tags, device_ids=None):
+    """Check a tagging request's tags (and device_ids, when given) so bad input is a 400"""
+    if not isinstance(tags, list) or not all(isinstance(t, str) and t.strip() for t in tags):
+        raise InvalidCommand('tags must be a list of non-empty strings')
+    too_long = [t for t in tags if len(t) > MAX_TAG_LENGTH]
+    if too_long:
+        raise InvalidCommand(f'Tags longer than {MAX_TAG_LENGTH} characters: {too_long[0]!r}')
+    if device_ids is not None and (not device_ids or not _is_id_list(device_ids)):
+        raise InvalidCommand('device_ids must be a non-empty list of integers')
+
+
+def fan_out_command(session, command_type, params, selector):
+    """Queue one command per selected device in a single INSERT ... SELECT"""
+    validate_selector(selector)
+    params = validate_command(command_type, params)
+
+    batch = CommandBatch(command_type=command_type, params=params, selector=selector)
+    session.add(batch)
+    session.flush()
+
+    now = datetime.now(UTC)
+    targets = select_devices(selector).subquery()
+    session.execute(
+        insert(Command).from_select(
+            ['device_id', 'command_type', 'params', 'status', 'created_at', 'updated_at', 'batch_id'],
+            select(
+                targets.c.id,
+                literal(command_type),
+                literal(params, type_=JSON),
+                literal('queued'),
+                literal(now),
+                literal(now),
+                literal(batch.id)
+            )
+        )
+    )
+    device_ids = session.execute(
+        select(Command.device_id).where(Command.batch_id == batch.id)
+    ).scalars().all()
+
+    batch.target_count = len(device_ids)
+    batch.queued_count = len(device_ids)
+    return batch, device_ids
@@ -6,6 +6,7 @@ import plotly.graph_objs as go
 import pandas as pd
 from datetime import datetime, timedelta, UTC
 import time
+from functools import lru_cache
 from metrics_sdk import MetricsClient, SystemMetrics, CryptoMetrics
 
 # Initialize the metrics client with environment variable
@@ -15,6 +16,14 @@ client = MetricsClient(
     device_id=1
 )
 
+@lru_cache(maxsize=None)
+def get_command_client(device_id):
+    """One client per device, reused across button clicks"""
+    return MetricsClient(
+        base_url=API_URL,
+        device_id=device_id
+    )
+
 # Initialize the Dash app
 app = dash.Dash(__name__, title='Metrics Dashboard')
 
@@ -56,12 +65,10 @@ app.layout = html.Div([
                 html.Label('Select Device:'),
                 dcc.Dropdown(
                     id='device-selector',
-                    options=[
-                        {'label': 'Device 1', 'value': 1},
-                        {'label': 'Device 2', 'value': 2},
-                        {'label': 'Device 3', 'value': 3}
-                    ],
-                    value=1
+                    options=[],
+                    value=None,
+                    searchable=True,
+                    placeholder='Search devices...'
                 ),
             ], style={'width': '200px', 'margin': '10px'}),
             
@@ -303,13 +310,17 @@ def update_historical_data(time_range, n):
             }
         }
         
-        # Create crypto prices chart
+        # Create crypto prices chart: every registered symbol in one request
+        market = client.get_market_prices(
+            start_time=start_time,
+            end_time=end_time,
+            step=300 if time_range == '24H' else 1800
+        )
         crypto_fig = {
             'data': [
-                go.Scatter(x=df['timestamp'], y=df['bitcoin_price'], name='Bitcoin',
-                          mode='lines+markers'),
-                go.Scatter(x=df['timestamp'], y=df['ethereum_price'], name='Ethereum',
-                          mode='lines+markers')
+                go.Scatter(x=market.timestamps, y=prices, name=symbol.title(),
+                          mode='lines', connectgaps=True)
+                for symbol, prices in (market.prices.items() if market else [])
             ],
             'layout': {
                 'title': 'Cryptocurrency Prices Over Time',
@@ -336,6 +347,29 @@ def update_historical_data(time_range, n):
             []
         )
 
+# Callback for loading device options as the user searches
+@app.callback(
+    [Output('device-selector', 'options'),
+     Output('device-selector', 'value'),
+     Output('device-selector', 'placeholder')],
+    [Input('device-selector', 'search_value')],
+    [State('device-selector', 'value')]
+)
+def update_device_options(search_value, selected_device):
+    page = client.list_devices(prefix=search_value or None, limit=50)
+    options = [{'label': d['name'], 'value': d['device_id']} for d in page['devices']]
+    
+    # Nothing selected yet: default to the first listed device
+    if selected_device is None:
+        if not options:
+            return [], None, 'No devices found' if search_value else 'No devices registered'
+        return options, options[0]['value'], 'Search devices...'
+    
+    # Keep the current selection visible while searching
+    if all(o['value'] != selected_device for o in options):
+        options.insert(0, {'label': f'Device {selected_device}', 'value': selected_device})
+    return options, selected_device, 'Search devices...'
+
 # Callback for sending commands to devices
 @app.callback(
     Output('command-status', 'children'),
@@ -350,14 +384,13 @@ def send_device_command(n_clicks, device_id, app_name, force_restart):
         return html.Div("Ready to restart app", style={'color': 'gray'})
     
     # Validate inputs
+    if device_id is None:
+        return html.Div("Error: No device selected", style={'color': 'red'})
     if not app_name or app_name.strip() == '':
         return html.Div("Error: App name cannot be empty", style={'color': 'red'})
     
-    # Create a new client with the selected device ID
-    command_client = MetricsClient(
-        base_url=API_URL,
-        device_id=device_id
-    )
+    # Client for the selected device ID
+    command_client = get_command_client(device_id)
     
     try:
         # Use the specific restart_app method
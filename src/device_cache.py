@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+
+
+class DeviceListCache:
+    """
+    Small in-process LRU cache for device listing pages.
+
+    Pages are keyed by their query parameters and dropped wholesale whenever
+    a device is registered, so a cached page is never older than the last
+    registration handled by this process.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached page for key, or None"""
+        with self._lock:
+            page = self._entries.get(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def generation(self):
+        """Current invalidation generation; pass it back to put()"""
+        with self._lock:
+            return self._generation
+
+    def put(self, key, page, generation):
+        """Cache a page unless an invalidation happened since it was read"""
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = page
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        """Drop every cached page"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,262 @@
+import argparse
+import json
+import sys
+from datetime import datetime, UTC
+
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from sqlalchemy import select, or_, and_, Boolean, DateTime, Float, Integer, JSON
+from sqlalchemy.orm import sessionmaker
+
+from market import crypto_as_of
+from models import Snapshot, SystemMetric, CryptoMetric, MetricSummary, get_database_engine
+
+# Rows fetched per keyset page; each page becomes one Parquet row group / IPC batch
+DEFAULT_BATCH_SIZE = 50000
+# Larger requested pages are clamped to this, so one page stays bounded
+MAX_BATCH_SIZE = 200000
+# Snapshot ids per summary lookup (stays under SQLite's bound-parameter limit)
+SUMMARY_CHUNK_SIZE = 500
+
+# Exported columns, taken from the models so new metric columns are exported too
+SNAPSHOT_COLUMNS = (Snapshot.id, Snapshot.device_id, Snapshot.timestamp, Snapshot.interval_seconds)
+SYSTEM_COLUMNS = tuple(c for c in SystemMetric.__table__.columns if c.name not in ('id', 'snapshot_id'))
+PRICE_COLUMNS = (CryptoMetric.bitcoin_price_usd, CryptoMetric.ethereum_price_usd)
+SUMMARY_COLUMNS = tuple(c for c in MetricSummary.__table__.columns if c.name not in ('id', 'snapshot_id'))
+
+
+def _arrow_type(column):
+    """Arrow type for a model column; JSON values are exported as JSON text"""
+    if isinstance(column.type, JSON):
+        return pa.string()
+    if isinstance(column.type, Boolean):
+        return pa.bool_()
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    if isinstance(column.type, Float):
+        return pa.float64()
+    if isinstance(column.type, DateTime):
+        return pa.timestamp('us')
+    return pa.string()
+
+
+SUMMARY_TYPE = pa.list_(pa.struct([(c.name, _arrow_type(c)) for c in SUMMARY_COLUMNS]))
+
+EXPORT_SCHEMA = pa.schema(
+    [('snapshot_id', pa.int64())] +
+    [(c.name, _arrow_type(c)) for c in SNAPSHOT_COLUMNS[1:] + SYSTEM_COLUMNS + PRICE_COLUMNS] +
+    [('summaries', SUMMARY_TYPE)]
+)
+JSON_FIELDS = tuple(c.name for c in SYSTEM_COLUMNS if isinstance(c.type, JSON))
+
+FORMATS = {
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+
+def parse_timestamp(value):
+    """Parse an ISO-8601 string into the naive UTC datetime stored in the database"""
+    if value is None or isinstance(value, datetime):
+        parsed = value
+    else:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed is not None and parsed.tzinfo is not None:
+        parsed = parsed.astimezone(UTC).replace(tzinfo=None)
+    return parsed
+
+
+def _base_query(device_ids=None, start_time=None, end_time=None):
+    """Build the filtered select; filters map onto the (device_id, timestamp) index"""
+    query = (
+        select(
+            *SNAPSHOT_COLUMNS,
+            *(getattr(SystemMetric, c.name) for c in SYSTEM_COLUMNS),
+            *PRICE_COLUMNS
+        )
+        .outerjoin(SystemMetric, SystemMetric.snapshot_id == Snapshot.id)
+        .outerjoin(CryptoMetric, CryptoMetric.snapshot_id == Snapshot.id)
+    )
+    if device_ids:
+        query = query.where(Snapshot.device_id.in_(device_ids))
+    if start_time is not None:
+        query = query.where(Snapshot.timestamp >= start_time)
+    if end_time is not None:
+        query = query.where(Snapshot.timestamp <= end_time)
+    return query
+
+
+def _load_summaries(session, snapshot_ids):
+    """Summary rows of the given snapshots as {snapshot_id: [summary dict, ...]}"""
+    summaries = {}
+    for start in range(0, len(snapshot_ids), SUMMARY_CHUNK_SIZE):
+        chunk = snapshot_ids[start:start + SUMMARY_CHUNK_SIZE]
+        rows = session.execute(
+            select(MetricSummary.snapshot_id, *(getattr(MetricSummary, c.name) for c in SUMMARY_COLUMNS))
+            .where(MetricSummary.snapshot_id.in_(chunk))
+            .order_by(MetricSummary.snapshot_id, MetricSummary.metric)
+        )
+        for row in rows:
+            summaries.setdefault(row.snapshot_id, []).append(
+                {c.name: getattr(row, c.name) for c in SUMMARY_COLUMNS}
+            )
+    return summaries
+
+
+def parse_batch_size(value):
+    """Rows per page from user input, clamped to MAX_BATCH_SIZE; raises ValueError below 1"""
+    batch_size = int(value)
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be at least 1, got {batch_size}")
+    return min(batch_size, MAX_BATCH_SIZE)
+
+
+def iter_record_batches(session, device_ids=None, start_time=None, end_time=None,
+                        batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Yield the selection as Arrow record batches in (timestamp, id) order.
+
+    Pages are fetched with keyset pagination so every query is a bounded
+    index range scan (on (device_id, timestamp) when filtered by device,
+    (timestamp, id) otherwise) and at most one page is held in memory.
+    """
+    base = _base_query(device_ids, start_time, end_time)
+    last_key = None
+
+    while True:
+        query = base
+        if last_key is not None:
+            last_ts, last_id = last_key
+            query = query.where(or_(
+                Snapshot.timestamp > last_ts,
+                and_(Snapshot.timestamp == last_ts, Snapshot.id > last_id)
+            ))
+        rows = session.execute(
+            query.order_by(Snapshot.timestamp, Snapshot.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return
+
+        columns = [list(column) for column in zip(*rows)]
+        for field in JSON_FIELDS:
+            column = columns[EXPORT_SCHEMA.get_field_index(field)]
+            column[:] = [json.dumps(value) if value is not None else None for value in column]
+
+        # Legacy rows carry their own prices; the rest come from the market series
+        unpriced = [i for i, row in enumerate(rows) if row.bitcoin_price_usd is None and row.ethereum_price_usd is None]
+        market_prices = crypto_as_of(session, [rows[i].timestamp for i in unpriced])
+        for i in unpriced:
+            for metric, value in market_prices.get(rows[i].timestamp, {}).items():
+                columns[EXPORT_SCHEMA.get_field_index(metric)][i] = value
+
+        summaries = _load_summaries(session, [row.id for row in rows])
+        columns.append([summaries.get(row.id) for row in rows])
+
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, EXPORT_SCHEMA)],
+            schema=EXPORT_SCHEMA
+        )
+
+        if len(rows) < batch_size:
+            return
+        last_key = (rows[-1].timestamp, rows[-1].id)
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back to a generator"""
+
+    def __init__(self):
+        self._chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _open_writer(sink, fmt):
+    if fmt == 'parquet':
+        return pq.ParquetWriter(sink, EXPORT_SCHEMA, compression='zstd')
+    if fmt == 'arrow':
+        return ipc.new_stream(sink, EXPORT_SCHEMA)
+    raise ValueError(f"Unsupported export format: {fmt}. Use one of: {', '.join(FORMATS)}")
+
+
+def write_export(sink, batches, fmt='parquet'):
+    """Write record batches to a file-like sink; returns the number of rows written"""
+    rows = 0
+    writer = _open_writer(sink, fmt)
+    try:
+        for batch in batches:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    finally:
+        writer.close()
+    return rows
+
+
+def stream_export(batches, fmt='parquet'):
+    """Generate the encoded export chunk by chunk, one row group at a time"""
+    sink = _ChunkSink()
+    writer = _open_writer(pa.PythonFile(sink, mode='w'), fmt)
+    try:
+        for batch in batches:
+            writer.write_batch(batch)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    finally:
+        writer.close()
+    chunk = sink.drain()
+    if chunk:
+        yield chunk
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export metrics to Parquet or Arrow IPC')
+    parser.add_argument('--device-id', type=int, action='append', dest='device_ids',
+                        help='Device to export (repeatable, default: all devices)')
+    parser.add_argument('--start-time', help='ISO-8601 start of the range (inclusive)')
+    parser.add_argument('--end-time', help='ISO-8601 end of the range (inclusive)')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='parquet')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f'Rows per page (at most {MAX_BATCH_SIZE})')
+    parser.add_argument('--database', help='Database path (default: DATABASE_URL or metrics.db)')
+    parser.add_argument('-o', '--output', required=True, help='Output file path')
+    args = parser.parse_args(argv)
+    try:
+        batch_size = parse_batch_size(args.batch_size)
+    except ValueError as e:
+        parser.error(str(e))
+
+    engine = get_database_engine(args.database)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    try:
+        batches = iter_record_batches(
+            session,
+            device_ids=args.device_ids,
+            start_time=parse_timestamp(args.start_time),
+            end_time=parse_timestamp(args.end_time),
+            batch_size=batch_size
+        )
+        rows = write_export(args.output, batches, args.format)
+        print(f"Exported {rows} rows to {args.output}")
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,6 @@
-from models import Base, Device, get_database_engine
+from market import MARKET_SYMBOLS, backfill_from_snapshots, register_symbols
+from models import Base, CryptoMetric, Device, MarketSymbol, get_database_engine, upgrade_schema
+from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker
 import socket
 
@@ -9,8 +11,29 @@ def init_database():
     # Create all tables
     Base.metadata.create_all(engine)
     
+    # Bring columns and indexes on existing databases up to date
+    upgrade_schema(engine)
+    
+    # One-off backfill of last-seen times for devices that predate tracking
+    with engine.begin() as connection:
+        connection.execute(text(
+            "UPDATE devices SET last_seen_at = "
+            "(SELECT MAX(timestamp) FROM snapshots WHERE snapshots.device_id = devices.id) "
+            "WHERE last_seen_at IS NULL"
+        ))
+    
     # Create a session factory
     Session = sessionmaker(bind=engine)
+    
+    # Move legacy per-snapshot crypto prices into the shared market series
+    with Session() as session:
+        if session.query(MarketSymbol).first() is None:
+            register_symbols(session, MARKET_SYMBOLS)
+            session.commit()
+        if session.query(CryptoMetric).first() is not None:
+            moved = backfill_from_snapshots(session)
+            print(f"Moved {moved} legacy crypto metric rows into market prices")
+    
     session = Session()
     
     try:
@@ -0,0 +1,239 @@
+import atexit
+import heapq
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timedelta, UTC
+
+from sqlalchemy import select, update, bindparam, or_
+
+from models import Device
+
+_DURATION_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*$')
+_DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(value):
+    """Parse '90', '90s', '5m', '2h' or '1d' into a timedelta"""
+    match = _DURATION_PATTERN.match(value or '')
+    if not match:
+        raise ValueError(f"Invalid duration: {value!r}. Use e.g. 30s, 5m, 2h or 1d")
+    amount, unit = match.groups()
+    return timedelta(seconds=float(amount) * _DURATION_UNITS[unit])
+
+
+def utcnow():
+    """Naive UTC now, matching how snapshot timestamps are stored"""
+    return datetime.now(UTC).replace(tzinfo=None)
+
+
+def write_last_seen(session, last_seen):
+    """Move devices.last_seen_at forward to {device_id: timestamp} in one executemany (never backwards)"""
+    if not last_seen:
+        return
+    devices = Device.__table__
+    stmt = (
+        update(devices)
+        .where(devices.c.id == bindparam('device_id'))
+        .where(or_(devices.c.last_seen_at.is_(None), devices.c.last_seen_at < bindparam('seen_at')))
+        .values(last_seen_at=bindparam('seen_at'))
+    )
+    session.execute(stmt, [
+        {'device_id': device_id, 'seen_at': seen_at}
+        for device_id, seen_at in last_seen.items()
+    ])
+
+
+class LivenessTracker:
+    """
+    In-memory index of when each device last reported.
+
+    Last-seen times live in a dict plus a min-heap of (timestamp, device_id)
+    with lazy deletion: an update pushes a new entry in O(log n) and leaves
+    the old one behind to be skipped (and periodically compacted away).
+    Stale queries walk the heap in timestamp order and stop at the cutoff,
+    so they cost O(k log k) for k stale devices rather than a table scan.
+
+    Updates are persisted to devices.last_seen_at in batched writes once
+    flush_interval seconds or flush_threshold dirty devices have built up.
+    After start() a background thread also flushes every flush_interval
+    seconds, and once more at exit, so updates are not lost when ingest
+    goes quiet.
+
+    Other writers (the collector's SnapshotBuffer) update last_seen_at
+    directly, so refresh() reads back rows written since the newest one
+    already loaded, less refresh_lookback for writes that land out of
+    order. The background thread refreshes on every flush, and stale
+    queries refresh before they walk the heap.
+    """
+
+    def __init__(self, flush_interval=10.0, flush_threshold=1000, refresh_lookback=timedelta(minutes=1)):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.refresh_lookback = refresh_lookback
+        self._last_seen = {}
+        self._heap = []
+        self._newest = None
+        self._dirty = {}
+        self._last_flush = time.monotonic()
+        self._loaded = False
+        # Newest last_seen_at read from the database
+        self._synced = None
+        self._lock = threading.Lock()
+        self._session_factory = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.logger = logging.getLogger('Liveness')
+
+    def ensure_loaded(self, session):
+        """Seed the index from devices.last_seen_at on first use"""
+        if self._loaded:
+            return
+        rows = session.execute(
+            select(Device.id, Device.last_seen_at).where(Device.last_seen_at.is_not(None))
+        ).all()
+        with self._lock:
+            if self._loaded:
+                return
+            self._load(rows)
+            self._loaded = True
+
+    def refresh(self, session):
+        """Load last-seen times other writers stored since the last load"""
+        if not self._loaded:
+            self.ensure_loaded(session)
+            return
+        query = select(Device.id, Device.last_seen_at).where(Device.last_seen_at.is_not(None))
+        synced = self._synced
+        if synced is not None:
+            query = query.where(Device.last_seen_at > synced - self.refresh_lookback)
+        rows = session.execute(query).all()
+        with self._lock:
+            self._load(rows)
+
+    def _load(self, rows):
+        for device_id, last_seen in rows:
+            self._set(device_id, last_seen)
+            if self._synced is None or last_seen > self._synced:
+                self._synced = last_seen
+
+    def _set(self, device_id, timestamp):
+        current = self._last_seen.get(device_id)
+        if current is not None and current >= timestamp:
+            return False
+        self._last_seen[device_id] = timestamp
+        heapq.heappush(self._heap, (timestamp, device_id))
+        if self._newest is None or timestamp > self._newest:
+            self._newest = timestamp
+        # Superseded entries are skipped lazily; rebuild once they dominate
+        if len(self._heap) > 2 * len(self._last_seen) + 64:
+            self._heap = [(ts, device) for device, ts in self._last_seen.items()]
+            heapq.heapify(self._heap)
+        return True
+
+    def touch(self, device_id, timestamp):
+        """Record that a device reported at timestamp"""
+        with self._lock:
+            if self._set(device_id, timestamp):
+                self._dirty[device_id] = timestamp
+
+    def last_seen(self, device_id):
+        with self._lock:
+            return self._last_seen.get(device_id)
+
+    def flush_due(self):
+        with self._lock:
+            if not self._dirty:
+                return False
+            return (len(self._dirty) >= self.flush_threshold or
+                    time.monotonic() - self._last_flush >= self.flush_interval)
+
+    def flush(self, session):
+        """Write pending last-seen times in one executemany; returns the row count"""
+        with self._lock:
+            pending, self._dirty = self._dirty, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+
+        try:
+            write_last_seen(session, pending)
+            session.commit()
+        except Exception:
+            session.rollback()
+            # Put the updates back so the next flush retries them
+            with self._lock:
+                for device_id, seen_at in pending.items():
+                    if self._dirty.get(device_id, seen_at) <= seen_at:
+                        self._dirty[device_id] = seen_at
+            raise
+        return len(pending)
+
+    def start(self, session_factory):
+        """Flush pending writes from a background thread every flush_interval seconds"""
+        if self._thread is not None:
+            return
+        self._session_factory = session_factory
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='liveness-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=1.0):
+        """Stop the flush thread and write whatever is still pending"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+        atexit.unregister(self.stop)
+        self._flush_pending()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self._flush_pending(refresh=True)
+
+    def _flush_pending(self, refresh=False):
+        session = self._session_factory()
+        try:
+            self.flush(session)
+            if refresh:
+                self.refresh(session)
+        except Exception as e:
+            self.logger.warning(f"Error syncing last-seen times: {str(e)}")
+        finally:
+            session.close()
+
+    def stale(self, cutoff, limit=None):
+        """Devices last seen before cutoff, oldest first, as (device_id, last_seen)"""
+        results = []
+        with self._lock:
+            heap = self._heap
+            # Walk the heap array in order without popping from it
+            frontier = [(heap[0], 0)] if heap else []
+            while frontier:
+                (timestamp, device_id), index = heapq.heappop(frontier)
+                if timestamp >= cutoff:
+                    break
+                if self._last_seen.get(device_id) == timestamp:
+                    results.append((device_id, timestamp))
+                    if limit is not None and len(results) >= limit:
+                        break
+                for child in (2 * index + 1, 2 * index + 2):
+                    if child < len(heap):
+                        heapq.heappush(frontier, (heap[child], child))
+        return results
+
+    def summary(self, cutoff):
+        """Counts of tracked and stale devices plus the oldest/newest report"""
+        stale = self.stale(cutoff)
+        oldest = self.stale(datetime.max, limit=1)
+        with self._lock:
+            return {
+                'tracked_devices': len(self._last_seen),
+                'stale_devices': len(stale),
+                'oldest_last_seen': oldest[0][1].isoformat() if oldest else None,
+                'newest_last_seen': self._newest.isoformat() if self._newest else None,
+                'pending_writes': len(self._dirty)
+            }
@@ -0,0 +1,332 @@
+import argparse
+import logging
+import math
+import os
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import sessionmaker
+
+from models import CryptoMetric, MarketPrice, MarketSymbol, Snapshot, get_database_engine
+from price_feed import UpstreamError, fetch_symbols, upstream_breaker
+from scheduler import AlignedScheduler
+
+# Width of a market-price bucket; a symbol is stored at most once per bucket
+MARKET_INTERVAL = 60
+# Crypto metric names and the market symbols they are stored under
+PRICE_SYMBOLS = {
+    'bitcoin_price_usd': 'bitcoin',
+    'ethereum_price_usd': 'ethereum',
+}
+# Symbols registered (and fetched by the ingester) on a fresh database
+MARKET_SYMBOLS = [s.strip() for s in os.getenv('MARKET_SYMBOLS', 'bitcoin,ethereum').split(',') if s.strip()]
+# How old the last known price may be for an as-of lookup to use it
+AS_OF_TOLERANCE = timedelta(minutes=10)
+# Most points per symbol a series query returns; longer ranges get a wider step
+MAX_POINTS = 2000
+
+EPOCH = datetime(1970, 1, 1)
+
+logger = logging.getLogger('MarketIngester')
+
+
+def to_epoch(timestamp):
+    """Whole epoch seconds of a naive UTC timestamp"""
+    return (timestamp - EPOCH) // timedelta(seconds=1)
+
+
+def from_epoch(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def align(timestamp, interval=MARKET_INTERVAL):
+    """Epoch seconds of the start of the bucket containing a naive UTC timestamp"""
+    seconds = to_epoch(timestamp)
+    return seconds - seconds % interval
+
+
+def symbol_ids(session, symbols, create=True):
+    """
+    Registry ids by symbol.
+
+    Unknown symbols are registered (enabled) when create is set and left
+    out otherwise.
+    """
+    symbols = list(dict.fromkeys(symbols))
+    if not symbols:
+        return {}
+    ids = dict(session.execute(
+        select(MarketSymbol.symbol, MarketSymbol.id).where(MarketSymbol.symbol.in_(symbols))
+    ).all())
+    missing = [symbol for symbol in symbols if symbol not in ids]
+    if missing and create:
+        session.execute(
+            sqlite_insert(MarketSymbol).on_conflict_do_nothing(index_elements=['symbol']),
+            [{'symbol': symbol, 'enabled': True} for symbol in missing]
+        )
+        ids.update(session.execute(
+            select(MarketSymbol.symbol, MarketSymbol.id).where(MarketSymbol.symbol.in_(missing))
+        ).all())
+    return ids
+
+
+def register_symbols(session, symbols, enabled=True):
+    """Add symbols to the registry, or enable/disable existing ones"""
+    ids = symbol_ids(session, symbols)
+    if ids:
+        session.query(MarketSymbol).filter(MarketSymbol.id.in_(ids.values())).update(
+            {MarketSymbol.enabled: enabled}, synchronize_session=False
+        )
+    return ids
+
+
+def enabled_symbols(session):
+    return list(session.execute(
+        select(MarketSymbol.symbol).where(MarketSymbol.enabled.is_(True)).order_by(MarketSymbol.id)
+    ).scalars())
+
+
+def price_rows(crypto_values, timestamp):
+    """Market price rows for one crypto_metrics group observed at timestamp"""
+    bucket = align(timestamp)
+    return [
+        {'symbol': symbol, 'ts': bucket, 'price': crypto_values[metric]}
+        for metric, symbol in PRICE_SYMBOLS.items()
+        if crypto_values.get(metric) is not None
+    ]
+
+
+def insert_prices(session, rows):
+    """Store prices; the first writer of a (symbol, bucket) wins, every other device's copy is ignored"""
+    if not rows:
+        return
+    ids = symbol_ids(session, [row['symbol'] for row in rows])
+    session.execute(
+        sqlite_insert(MarketPrice).on_conflict_do_nothing(index_elements=['symbol_id', 'ts']),
+        [{'symbol_id': ids[row['symbol']], 'ts': row['ts'], 'price': row['price']} for row in rows]
+    )
+
+
+def crypto_as_of(session, timestamps, tolerance=AS_OF_TOLERANCE):
+    """
+    As-of join of market prices onto snapshot timestamps.
+
+    Returns {timestamp: crypto_metrics dict} with the last price of each
+    symbol at or before the timestamp (within tolerance); timestamps with
+    no price at all are left out. Dense selections load the covering range
+    once and bisect into it; sparse ones (few timestamps over a long span)
+    seek the (symbol_id, ts) primary key per timestamp instead.
+    """
+    timestamps = sorted(set(timestamps))
+    if not timestamps:
+        return {}
+    ids = symbol_ids(session, PRICE_SYMBOLS.values(), create=False)
+    if not ids:
+        return {}
+    window = int(tolerance.total_seconds())
+    start, end = to_epoch(timestamps[0]) - window, to_epoch(timestamps[-1])
+    buckets = (end - start) / MARKET_INTERVAL
+
+    if buckets <= 20 * len(timestamps):
+        series = {symbol_id: ([], []) for symbol_id in ids.values()}
+        rows = session.execute(
+            select(MarketPrice.symbol_id, MarketPrice.ts, MarketPrice.price)
+            .where(
+                MarketPrice.symbol_id.in_(list(series)),
+                MarketPrice.ts >= start,
+                MarketPrice.ts <= end
+            )
+            .order_by(MarketPrice.symbol_id, MarketPrice.ts)
+        )
+        for symbol_id, ts, price in rows:
+            series[symbol_id][0].append(ts)
+            series[symbol_id][1].append(price)
+
+        def lookup(symbol_id, ts):
+            times, prices = series[symbol_id]
+            i = bisect_right(times, ts) - 1
+            if i >= 0 and ts - times[i] <= window:
+                return prices[i]
+            return None
+    else:
+        def lookup(symbol_id, ts):
+            return session.execute(
+                select(MarketPrice.price)
+                .where(
+                    MarketPrice.symbol_id == symbol_id,
+                    MarketPrice.ts <= ts,
+                    MarketPrice.ts >= ts - window
+                )
+                .order_by(MarketPrice.ts.desc())
+                .limit(1)
+            ).scalar()
+
+    result = {}
+    for timestamp in timestamps:
+        ts = to_epoch(timestamp)
+        values = {
+            metric: lookup(ids[symbol], ts) if symbol in ids else None
+            for metric, symbol in PRICE_SYMBOLS.items()
+        }
+        if any(value is not None for value in values.values()):
+            result[timestamp] = values
+    return result
+
+
+def load_series(session, symbols, start, end, step=MARKET_INTERVAL, max_points=MAX_POINTS):
+    """
+    Many symbols' prices on one shared time grid, in a single query.
+
+    The range is cut into step-second buckets (widened so no series has
+    more than max_points) and each bucket holds the last price stored in
+    it, or None. Returns {'step', 'timestamps', 'prices': {symbol: [...]}}
+    with one list entry per timestamp; unknown symbols get all-None lists.
+    """
+    step = max(int(step), MARKET_INTERVAL)
+    span = max(to_epoch(end) - to_epoch(start), 0)
+    if span / step > max_points:
+        step = math.ceil(span / max_points / MARKET_INTERVAL) * MARKET_INTERVAL
+    first = align(start, step)
+    last = to_epoch(end)
+    count = (last - first) // step + 1
+
+    symbols = list(dict.fromkeys(symbols))
+    ids = symbol_ids(session, symbols, create=False)
+    names = {symbol_id: symbol for symbol, symbol_id in ids.items()}
+    prices = {symbol: [None] * count for symbol in symbols}
+    if ids:
+        rows = session.execute(
+            select(MarketPrice.symbol_id, MarketPrice.ts, MarketPrice.price)
+            .where(
+                MarketPrice.symbol_id.in_(list(names)),
+                MarketPrice.ts >= first,
+                MarketPrice.ts <= last
+            )
+            .order_by(MarketPrice.symbol_id, MarketPrice.ts)
+        )
+        for symbol_id, ts, price in rows:
+            prices[names[symbol_id]][(ts - first) // step] = price
+
+    return {
+        'step': step,
+        'timestamps': [from_epoch(first + i * step) for i in range(count)],
+        'prices': prices
+    }
+
+
+def _stored_buckets(session, prices):
+    """The (symbol, ts) buckets of price rows that market_prices holds"""
+    if not prices:
+        return set()
+    buckets = [price['ts'] for price in prices]
+    return set(session.execute(
+        select(MarketSymbol.symbol, MarketPrice.ts)
+        .join(MarketSymbol, MarketSymbol.id == MarketPrice.symbol_id)
+        .where(MarketSymbol.symbol.in_({price['symbol'] for price in prices}))
+        .where(MarketPrice.ts.between(min(buckets), max(buckets)))
+    ).all())
+
+
+def backfill_from_snapshots(session, batch_size=5000):
+    """
+    Move legacy per-snapshot CryptoMetric prices into market_prices.
+
+    Works through crypto_metrics in id-keyset batches. A batch's rows are
+    deleted once every price bucket they map to is stored in market_prices
+    (a bucket another snapshot already filled counts), so reruns pick up
+    where an interrupted one stopped. Returns the legacy rows removed.
+    """
+    moved = 0
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select(CryptoMetric.id, Snapshot.timestamp, CryptoMetric.bitcoin_price_usd, CryptoMetric.ethereum_price_usd)
+            .join(Snapshot, Snapshot.id == CryptoMetric.snapshot_id)
+            .where(CryptoMetric.id > last_id)
+            .order_by(CryptoMetric.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return moved
+        prices = []
+        for row in rows:
+            prices.extend(price_rows({
+                'bitcoin_price_usd': row.bitcoin_price_usd,
+                'ethereum_price_usd': row.ethereum_price_usd
+            }, row.timestamp))
+        insert_prices(session, prices)
+        if {(price['symbol'], price['ts']) for price in prices} <= _stored_buckets(session, prices):
+            batch = (CryptoMetric.id > last_id) & (CryptoMetric.id <= rows[-1].id)
+            moved += session.execute(delete(CryptoMetric).where(batch)).rowcount
+        else:
+            logger.error(f"Market prices missing after backfill of crypto_metrics {last_id + 1}-{rows[-1].id}; "
+                         f"keeping the legacy rows")
+        session.commit()
+        last_id = rows[-1].id
+
+
+class MarketIngester:
+    """
+    Fetches every enabled registry symbol once per interval.
+
+    All symbols go upstream in batched requests (see fetch_symbols) and
+    land in the series with one multi-row insert; a circuit breaker stops
+    the fetches while upstream is failing or rate limiting.
+    """
+
+    def __init__(self, session_factory, fetch=fetch_symbols, breaker=None, timeout=10.0):
+        self.session_factory = session_factory
+        self._fetch = fetch
+        self.breaker = breaker or upstream_breaker()
+        self.timeout = timeout
+
+    def run_once(self, timestamp):
+        """Fetch and store prices for the bucket containing timestamp; returns rows offered"""
+        with self.session_factory() as session:
+            symbols = enabled_symbols(session)
+        if not symbols or not self.breaker.allow():
+            return 0
+        try:
+            prices = self._fetch(symbols, timeout=self.timeout)
+        except UpstreamError as e:
+            self.breaker.record_failure(e.retry_after)
+            logger.warning(f"Market fetch failed ({self.breaker.state}): {str(e)}")
+            return 0
+        self.breaker.record_success()
+
+        bucket = align(timestamp)
+        rows = [{'symbol': symbol, 'ts': bucket, 'price': price} for symbol, price in prices.items()]
+        with self.session_factory() as session, session.begin():
+            insert_prices(session, rows)
+        return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fetch registered market symbols once per interval')
+    parser.add_argument('--interval', type=float, default=MARKET_INTERVAL, help='Seconds between fetches')
+    parser.add_argument('--symbols', help='Comma-separated CoinGecko ids to register before starting')
+    parser.add_argument('--once', action='store_true', help='Fetch a single time and exit')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    Session = sessionmaker(bind=get_database_engine())
+    if args.symbols:
+        with Session() as session, session.begin():
+            register_symbols(session, [s.strip() for s in args.symbols.split(',') if s.strip()])
+
+    ingester = MarketIngester(Session)
+    if args.once:
+        logger.info(f"Stored {ingester.run_once(datetime.utcnow())} prices")
+        return
+    scheduler = AlignedScheduler(args.interval)
+    while True:
+        tick = scheduler.wait()
+        if tick is None:
+            break
+        logger.info(f"Stored {ingester.run_once(tick.scheduled)} prices")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,117 +1,306 @@
-import psutil
-import requests
+import os
 import logging
-import json
-from datetime import datetime
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+import signal
 import socket
 from sqlalchemy.orm import sessionmaker
-from models import get_database_engine, Device, Snapshot, SystemMetric, CryptoMetric
-
-# Configure logging
-def setup_logging():
-    # Create a formatter
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    
-    # Set up file handler
-    file_handler = logging.FileHandler('logs/metrics.log')
-    file_handler.setFormatter(formatter)
-    
-    # Set up console handler
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
-    
-    # Set up logger
-    logger = logging.getLogger('MetricsCollector')
-    logger.setLevel(logging.INFO)
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    
-    return logger
-
-def get_system_metrics():
-    return {
-        'thread_count': len(psutil.Process().threads()),
-        'ram_usage_percent': psutil.virtual_memory().percent
-    }
-
-def get_crypto_prices():
-    try:
-        response = requests.get('https://api.coingecko.com/api/v3/simple/price?ids=bitcoin,ethereum&vs_currencies=usd')
-        data = response.json()
-        return {
-            'bitcoin_price_usd': data['bitcoin']['usd'],
-            'ethereum_price_usd': data['ethereum']['usd']
-        }
-    except Exception as e:
-        return {
-            'bitcoin_price_usd': None,
-            'ethereum_price_usd': None
-        }
+from models import get_database_engine, Device
+from metrics_sdk.deadband import DeadbandFilter, parse_deadbands
+from collector_logging import setup_logging
+from overhead import OverheadMonitor
+from pressure import PressurePolicy
+from scheduler import AlignedScheduler, monotonic_deadline
+from sources import SOURCES
+from storage import SnapshotBuffer
 
-def main():
-    logger = setup_logging()
-    
+# Seconds between stored snapshots, aligned to wall-clock boundaries
+SNAPSHOT_INTERVAL = float(os.getenv('COLLECTOR_SNAPSHOT_INTERVAL', 60))
+# Upper bound of the random per-host delay after each boundary, to spread load
+SNAPSHOT_JITTER = float(os.getenv('COLLECTOR_SNAPSHOT_JITTER', 0))
+
+# Per-metric change thresholds, e.g. 'ram_usage_percent=1,bitcoin_price_usd=0.1%'
+DEADBANDS = os.getenv('COLLECTOR_DEADBANDS', '')
+# Seconds after which an unchanged metric is stored anyway
+MAX_SILENCE = float(os.getenv('COLLECTOR_MAX_SILENCE', 300))
+
+# Snapshots are written in bulk every FLUSH_SAMPLES snapshots or FLUSH_INTERVAL
+# seconds, whichever comes first; a crash loses at most one flush window
+FLUSH_SAMPLES = int(os.getenv('COLLECTOR_FLUSH_SAMPLES', 60))
+FLUSH_INTERVAL = float(os.getenv('COLLECTOR_FLUSH_INTERVAL', 60))
+
+# CPU budget for the collector process, in percent of one core; above it the
+# snapshot and source intervals are stretched up to MAX_BACKOFF times
+OVERHEAD_BUDGET = float(os.getenv('COLLECTOR_OVERHEAD_BUDGET', 1.0))
+MAX_BACKOFF = int(os.getenv('COLLECTOR_MAX_BACKOFF', 8))
+
+# Host CPU / RAM percent at which the host counts as under pressure: cheap
+# sources and snapshots then run PRESSURE_SPEEDUP times faster and expensive
+# sources (price fetches, process scans) PRESSURE_BACKOFF times slower
+PRESSURE_CPU = float(os.getenv('COLLECTOR_PRESSURE_CPU', 90))
+PRESSURE_RAM = float(os.getenv('COLLECTOR_PRESSURE_RAM', 90))
+PRESSURE_SPEEDUP = float(os.getenv('COLLECTOR_PRESSURE_SPEEDUP', 4))
+PRESSURE_BACKOFF = float(os.getenv('COLLECTOR_PRESSURE_BACKOFF', 4))
+
+# Log file rotation, and the minimum seconds between logged per-snapshot records
+LOG_FILE = os.getenv('COLLECTOR_LOG_FILE', 'logs/metrics.log')
+LOG_MAX_BYTES = int(os.getenv('COLLECTOR_LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv('COLLECTOR_LOG_BACKUPS', 5))
+LOG_SAMPLE_INTERVAL = float(os.getenv('COLLECTOR_LOG_SAMPLE_INTERVAL', 60))
+
+DEFAULT_SOURCES = ('system', 'processes', 'crypto')
+
+def build_sources():
+    """
+    Instantiate the configured source plugins.
+
+    COLLECTOR_SOURCES selects plugins by name (e.g. 'system_hf,crypto' for
+    1 Hz sampling with per-snapshot summaries), and
+    COLLECTOR_<NAME>_INTERVAL / COLLECTOR_<NAME>_TIMEOUT override each
+    source's schedule.
+    """
+    names = os.getenv('COLLECTOR_SOURCES', ','.join(DEFAULT_SOURCES)).split(',')
+    sources = []
+    for name in (n.strip() for n in names if n.strip()):
+        if name not in SOURCES:
+            raise ValueError(f"Unknown collector source: {name}. Available: {', '.join(SOURCES)}")
+        prefix = f'COLLECTOR_{name.upper()}_'
+        sources.append(SOURCES[name](
+            interval=os.getenv(prefix + 'INTERVAL'),
+            timeout=os.getenv(prefix + 'TIMEOUT')
+        ))
+    return sources
+
+class _SourceState:
+    def __init__(self, source):
+        self.source = source
+        self.next_due = 0.0
+        self.future = None
+        self.started_at = None
+        self.timed_out = False
+        self.values = None
+        self.collected_at = None
+        self.last_latency = None
+
+class SourceRunner:
+    """
+    Runs each source concurrently on its own interval.
+
+    Every source gets a dedicated worker slot and at most one collection in
+    flight, so a slow or hung source never delays another. A collection that
+    overruns its timeout is reported and its group treated as missing until
+    the source recovers; the latest values of each group are merged into
+    snapshots by latest().
+    """
+
+    def __init__(self, sources, logger=None):
+        self.logger = logger or logging.getLogger('MetricsCollector')
+        self._states = [_SourceState(source) for source in sources]
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(len(self._states), 1),
+            thread_name_prefix='collector-source'
+        )
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='collector-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        # A hung source thread cannot be interrupted; don't block shutdown on it
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            for state in self._states:
+                self._check(state, now)
+            next_due = min((s.next_due for s in self._states), default=now + 1)
+            self._stop.wait(max(min(next_due - now, 1.0), 0.01))
+
+    def _check(self, state, now):
+        source = state.source
+        if state.future is not None:
+            if state.future.done():
+                state.future = None
+            elif not state.timed_out and now - state.started_at > source.timeout:
+                state.timed_out = True
+                self.logger.warning(f"Source {source.name} exceeded its {source.timeout}s timeout")
+            return
+        if now >= state.next_due:
+            state.started_at = now
+            state.timed_out = False
+            # Aligned boundaries keep per-source schedules from drifting
+            state.next_due = monotonic_deadline(source.interval)
+            state.future = self._executor.submit(self._collect, state)
+
+    def _collect(self, state):
+        started = time.monotonic()
+        try:
+            values = state.source.collect()
+        except Exception as e:
+            self.logger.error(f"Error collecting {state.source.name} metrics: {str(e)}")
+            return
+        latency = time.monotonic() - started
+        with self._lock:
+            state.last_latency = latency
+            # A result that arrives after the timeout is still fresher than nothing
+            state.values = values
+            state.collected_at = time.monotonic()
+
+    def latest(self):
+        """Latest values per group, omitting groups whose source has gone stale"""
+        now = time.monotonic()
+        groups = {}
+        with self._lock:
+            for state in self._states:
+                source = state.source
+                if state.values is None:
+                    continue
+                if now - state.collected_at > 2 * source.interval + source.timeout:
+                    continue
+                groups.setdefault(source.group, {}).update(state.values)
+        return groups
+
+    def summaries(self):
+        """Per-metric summaries from sampling sources since the previous call"""
+        summaries = {}
+        for state in self._states:
+            summaries.update(state.source.summarize())
+        return summaries
+
+    def set_intervals(self, interval_for):
+        """Reschedule every source at interval_for(source) seconds"""
+        with self._lock:
+            for state in self._states:
+                state.source.interval = interval_for(state.source)
+
+    def intervals(self):
+        """Current interval of each source, in seconds"""
+        with self._lock:
+            return {s.source.name: s.source.interval for s in self._states}
+
+    def latencies(self):
+        """Duration of each source's last successful collection, in seconds"""
+        with self._lock:
+            return {s.source.name: s.last_latency for s in self._states if s.last_latency is not None}
+
+def apply_deadbands(deadband_filter, groups, summaries):
+    """Drop values within their deadband; returns the groups and summaries left to store"""
+    filtered = {}
+    for group, values in groups.items():
+        reported = deadband_filter.filter(values)
+        if reported:
+            filtered[group] = {name: reported.get(name) for name in values}
+    return filtered, deadband_filter.filter_summaries(summaries, bool(filtered))
+
+def run(logger):
     # Set up database connection
     engine = get_database_engine()
     Session = sessionmaker(bind=engine)
-    session = Session()
-    
-    # Get or create device
+
+    # Look up the device once; only its id is kept between snapshots
     hostname = socket.gethostname()
-    device = session.query(Device).filter_by(name=hostname).first()
-    
-    if not device:
+    with Session() as session:
+        device_id = session.query(Device.id).filter_by(name=hostname).scalar()
+
+    if device_id is None:
         logger.error(f"Device {hostname} not found in database. Please run init_db.py first.")
         return
-    
-    while True:
-        try:
-            # Collect metrics
-            system_metrics_data = get_system_metrics()
-            crypto_prices_data = get_crypto_prices()
-            
-            # Create new snapshot
-            snapshot = Snapshot(
-                device=device,
-                timestamp=datetime.utcnow()
-            )
-            
-            # Create system metrics
-            system_metrics = SystemMetric(
-                snapshot=snapshot,
-                **system_metrics_data
-            )
-            
-            # Create crypto metrics
-            crypto_metrics = CryptoMetric(
-                snapshot=snapshot,
-                **crypto_prices_data
-            )
-            
-            # Add to session and commit
-            session.add(snapshot)
-            session.add(system_metrics)
-            session.add(crypto_metrics)
-            session.commit()
-            
-            # Create metrics payload for logging
-            metrics = {
-                'timestamp': snapshot.timestamp.isoformat(),
-                'system': system_metrics_data,
-                **crypto_prices_data
-            }
-            
-            # Log metrics
-            logger.info(f"Collected and stored metrics: {json.dumps(metrics, indent=2)}")
-            
-            # Wait for 60 seconds before next collection
-            time.sleep(60)
-            
-        except Exception as e:
-            logger.error(f"Error collecting metrics: {str(e)}")
-            session.rollback()
-            time.sleep(60)
+
+    runner = SourceRunner(build_sources(), logger)
+    runner.start()
+    scheduler = AlignedScheduler(SNAPSHOT_INTERVAL, jitter=SNAPSHOT_JITTER)
+    deadbands = parse_deadbands(DEADBANDS)
+    deadband_filter = DeadbandFilter(deadbands, MAX_SILENCE) if deadbands else None
+    buffer = SnapshotBuffer(Session, max_samples=FLUSH_SAMPLES, flush_interval=FLUSH_INTERVAL, logger=logger)
+    monitor = OverheadMonitor(OVERHEAD_BUDGET, MAX_BACKOFF)
+    policy = PressurePolicy(PRESSURE_CPU, PRESSURE_RAM, speedup=PRESSURE_SPEEDUP, backoff=PRESSURE_BACKOFF)
+
+    def apply_intervals():
+        scheduler.set_interval(policy.snapshot_interval(SNAPSHOT_INTERVAL, monitor.factor))
+        runner.set_intervals(lambda source: policy.source_interval(source, monitor.factor))
+
+    # Stop at the next tick on SIGTERM so pending snapshots are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+
+    try:
+        while True:
+            tick = scheduler.wait()
+            if tick is None:
+                break
+            if tick.skipped:
+                logger.warning(f"Collector fell behind: coalesced {tick.skipped} missed ticks (lag {tick.lag:.3f}s)")
+            monitor.observe_lag(tick.lag)
+            # Interval this tick was scheduled at, before any adjustment below
+            interval = scheduler.interval
+
+            try:
+                groups = runner.latest()
+                summaries = runner.summaries()
+
+                # Sample cheap metrics faster and expensive ones slower while the host is loaded
+                if policy.update(groups.get('system_metrics')):
+                    apply_intervals()
+                    if policy.under_pressure:
+                        logger.warning(f"Host under pressure, snapshot interval now {scheduler.interval}s")
+                    else:
+                        logger.info(f"Host pressure cleared, snapshot interval back to {scheduler.interval}s")
+
+                # Change-only reporting: skip the snapshot if nothing left its band
+                if deadband_filter is not None:
+                    groups, summaries = apply_deadbands(deadband_filter, groups, summaries)
+                    if not groups and not summaries:
+                        buffer.flush_if_due()
+                        continue
+
+                # The collector's own overhead since the last stored snapshot
+                groups['collector_metrics'] = {
+                    **monitor.report(buffer.last_flush_seconds, runner.latencies()),
+                    'source_intervals': runner.intervals(),
+                    'under_pressure': policy.under_pressure
+                }
+                if monitor.adjust():
+                    apply_intervals()
+                    logger.warning(
+                        f"Collector CPU at {monitor.window_cpu_percent:.2f}% (budget {OVERHEAD_BUDGET}%), "
+                        f"running at {monitor.factor}x the configured intervals"
+                    )
+
+                # Stamp the snapshot with the aligned boundary so devices line up
+                written = buffer.add(device_id, tick.scheduled, groups, summaries, interval)
+                if written:
+                    logger.info(f"Flushed {written} snapshots in {buffer.last_flush_seconds:.3f}s")
+
+                # Per-snapshot record; rate-limited and serialized off this thread
+                metrics = {
+                    'timestamp': tick.scheduled,
+                    'interval_seconds': interval,
+                    **groups
+                }
+                if summaries:
+                    metrics['summaries'] = {m: summary.to_dict() for m, summary in summaries.items()}
+                logger.info("Collected metrics", extra={'fields': metrics, 'sample': True})
+
+            except Exception as e:
+                logger.error(f"Error collecting metrics: {str(e)}")
+    finally:
+        runner.stop(wait=False)
+        # Don't lose the pending window on a clean shutdown
+        buffer.flush()
+
+def main():
+    logger, log_listener = setup_logging(LOG_FILE, LOG_MAX_BYTES, LOG_BACKUPS, LOG_SAMPLE_INTERVAL)
+    try:
+        run(logger)
+    finally:
+        log_listener.stop()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
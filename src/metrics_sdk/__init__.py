@@ -3,7 +3,18 @@ Metrics SDK for interacting with the Metrics Collection API.
 """
 
 from .client import MetricsClient
-from .models import SystemMetrics, CryptoMetrics, MetricsSnapshot
+from .models import SystemMetrics, CryptoMetrics, CollectorMetrics, MetricSummary, MetricsSnapshot, MarketPrices
+from .deadband import Deadband, DeadbandFilter
+from .transport import Transport, HTTPTransport, FlaskTestTransport
+from .uploader import BackgroundUploader
+from .offline_store import OfflineStore
+from .replay import BackgroundReplayer
+from .breaker import CircuitBreaker, CircuitOpenError
+from .async_client import AsyncMetricsClient
+from .async_transport import AsyncHTTPTransport
 
 __version__ = '0.1.0'
-__all__ = ['MetricsClient', 'SystemMetrics', 'CryptoMetrics', 'MetricsSnapshot'] 
\ No newline at end of file
+__all__ = ['MetricsClient', 'SystemMetrics', 'CryptoMetrics', 'CollectorMetrics', 'MetricSummary', 'MetricsSnapshot',
+           'MarketPrices', 'Deadband', 'DeadbandFilter', 'Transport', 'HTTPTransport', 'FlaskTestTransport',
+           'BackgroundUploader', 'OfflineStore', 'BackgroundReplayer', 'CircuitBreaker', 'CircuitOpenError',
+           'AsyncMetricsClient', 'AsyncHTTPTransport'] 
\ No newline at end of file
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import ssl
+from datetime import datetime
+from typing import Dict, List, Optional, Union
+
+import requests
+
+from .models import MetricsSnapshot, SystemMetrics, CryptoMetrics, MetricSummary
+from .deadband import Deadband, DeadbandFilter
+from .transport import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from .async_transport import AsyncHTTPTransport, DEFAULT_MAX_CONNECTIONS
+from .breaker import backoff_delay, breaker_for, upload_failed, upload_result, DEFAULT_FAILURE_THRESHOLD, DEFAULT_MAX_BACKOFF
+from .serialization import batch_payload, build_snapshot, command_payload, metrics_params, parse_metrics, restart_params
+
+
+class AsyncMetricsClient:
+    """
+    asyncio client for the Metrics API.
+
+    Mirrors MetricsClient (post_metrics, get_metrics, send_command,
+    restart_app) with coroutines, so one event loop can drive requests for
+    many devices over a shared, bounded connection pool. Pass the same
+    transport to every client that should share the pool, and use the
+    client (and transport) from a single event loop. Uploads share the
+    sync client's circuit breaker for the base URL.
+    """
+
+    def __init__(self, base_url: str, device_id: int,
+                 max_retries: int = 3,
+                 retry_delay: float = 1.0,
+                 deadbands: Optional[Dict[str, Deadband]] = None,
+                 max_silence: float = 300.0,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 verify: Union[bool, str, ssl.SSLContext] = True,
+                 proxy: Optional[str] = None,
+                 transport: Optional[AsyncHTTPTransport] = None,
+                 failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 max_backoff: float = DEFAULT_MAX_BACKOFF):
+        """
+        Initialize the async metrics client.
+
+        Args:
+            base_url: Base URL of the metrics API
+            device_id: ID of the device sending metrics
+            max_retries: Maximum number of upload attempts
+            retry_delay: Delay before the first retry in seconds (doubles, jittered)
+            deadbands: Per-metric change thresholds (see metrics_sdk.deadband)
+            max_silence: Seconds after which a metric is re-sent even if unchanged
+            max_connections: Most concurrent requests to the API
+            connect_timeout: Seconds to wait for a connection to the API
+            read_timeout: Seconds to wait for each response
+            verify: False to skip TLS verification, a CA bundle path, or an SSLContext
+            proxy: Proxy URL (default: from HTTP(S)_PROXY / NO_PROXY)
+            transport: Shared AsyncHTTPTransport (overrides the five settings above)
+            failure_threshold: Consecutive failed uploads that open the circuit
+            max_backoff: Longest retry delay and longest open circuit period
+        """
+        self.base_url = base_url.rstrip('/')
+        self.device_id = device_id
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        self.deadband_filter = DeadbandFilter(deadbands, max_silence) if deadbands else None
+        self._owns_transport = transport is None
+        self.transport = transport or AsyncHTTPTransport(
+            self.base_url, max_connections, connect_timeout, read_timeout, verify=verify, proxy=proxy
+        )
+        self.breaker = breaker_for(self.base_url, failure_threshold=failure_threshold, max_reset_timeout=max_backoff)
+        self.logger = logging.getLogger('MetricsSDK')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Close the connection pool if this client created it."""
+        if self._owns_transport:
+            await self.transport.aclose()
+
+    async def _upload_with_retry(self, path: str, payload: dict) -> bool:
+        """POST with retries; True once the API has stored it."""
+        for attempt in range(self.max_retries):
+            if not self.breaker.allow():
+                self.logger.info("Circuit open, not contacting the API")
+                return False
+
+            try:
+                response = await self.transport.post(path, json=payload)
+                stored = upload_result(self.breaker, response, self.logger)
+                if stored is not None:
+                    return stored
+
+            except requests.RequestException as e:
+                upload_failed(self.breaker, e, attempt, self.logger)
+
+            if attempt < self.max_retries - 1:
+                await asyncio.sleep(backoff_delay(self.retry_delay, attempt, self.max_backoff))
+
+        return False
+
+    async def post_metrics(self,
+                           system_metrics: Optional[SystemMetrics] = None,
+                           crypto_metrics: Optional[CryptoMetrics] = None,
+                           summaries: Optional[Dict[str, MetricSummary]] = None) -> bool:
+        """
+        Upload metrics to the API.
+
+        Unlike MetricsClient there is no offline store: a snapshot that
+        cannot be uploaded after max_retries is reported as False.
+
+        Returns:
+            bool: True if the upload succeeded or nothing needed sending
+            because every value was within its deadband
+        """
+        snapshot = build_snapshot(self.device_id, system_metrics, crypto_metrics, summaries, self.deadband_filter)
+        if snapshot is None:
+            return True
+        return await self._upload_with_retry("/v1/metrics", snapshot.to_dict())
+
+    async def upload_snapshots(self, snapshots: List[MetricsSnapshot], batch_size: int = 100) -> int:
+        """
+        Upload many snapshots (of any devices) as concurrent batch requests.
+
+        Args:
+            snapshots: Snapshots to upload; their timestamps are kept
+            batch_size: Snapshots per request
+
+        Returns:
+            Number of snapshots the API stored
+        """
+        batches = [snapshots[i:i + batch_size] for i in range(0, len(snapshots), batch_size)]
+        results = await asyncio.gather(*(
+            self._upload_with_retry("/v1/metrics/batch", batch_payload(batch)) for batch in batches
+        ))
+        return sum(len(batch) for batch, stored in zip(batches, results) if stored)
+
+    async def get_metrics(self,
+                          start_time: Optional[datetime] = None,
+                          end_time: Optional[datetime] = None,
+                          limit: int = 100,
+                          fill: Optional[str] = None) -> List[MetricsSnapshot]:
+        """
+        Get metrics from the API.
+
+        Returns:
+            List of MetricsSnapshot objects (empty on failure)
+        """
+        try:
+            response = await self.transport.get("/v1/metrics", params=metrics_params(start_time, end_time, limit, fill))
+            response.raise_for_status()
+            return parse_metrics(response.json())
+        except Exception as e:
+            self.logger.error(f"Error getting metrics: {str(e)}")
+            return []
+
+    async def send_command(self, command_type: str, params: Optional[dict] = None) -> dict:
+        """
+        Send a command to the device.
+
+        Returns:
+            Response from the API as a dictionary
+        """
+        try:
+            response = await self.transport.post(
+                f"/v1/devices/{self.device_id}/commands",
+                json=command_payload(command_type, params)
+            )
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"Error sending command: {str(e)}")
+            return {'error': str(e), 'status': 'failed'}
+
+    async def restart_app(self, app_name: str, force: bool = False) -> dict:
+        """Restart a specific application on the device."""
+        return await self.send_command('restart_app', restart_params(app_name, force))
@@ -0,0 +1,168 @@
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+
+# Consecutive failed uploads that open the circuit
+DEFAULT_FAILURE_THRESHOLD = 3
+# First open period; each further consecutive opening doubles it
+DEFAULT_RESET_TIMEOUT = 5.0
+# Longest open period, and longest sleep between upload retries
+DEFAULT_MAX_BACKOFF = 300.0
+
+_breakers: Dict[str, 'CircuitBreaker'] = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.RequestException):
+    """The API's circuit is open, so no request was made"""
+
+
+def backoff_delay(base: float, attempt: int, cap: float = DEFAULT_MAX_BACKOFF) -> float:
+    """
+    Seconds to wait before retry number attempt + 1.
+
+    Doubles per attempt up to cap, and is jittered to between half and all
+    of that, so clients that failed together do not retry together.
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def retry_after(response) -> Optional[float]:
+    """Seconds from a Retry-After header, if the API sent one"""
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def upload_result(breaker: 'CircuitBreaker', response, logger) -> Optional[bool]:
+    """
+    Record an upload response with the circuit breaker and classify it.
+
+    Shared by the sync and async clients. Returns True when the API stored
+    the upload, False when it rejected it for good (a 4xx other than 429,
+    not worth retrying), and None when the attempt should be retried.
+    """
+    if response.status_code == 429 or response.status_code >= 500:
+        breaker.record_failure(retry_after(response))
+        return None
+    breaker.record_success()
+    if 200 <= response.status_code < 300:
+        # A batch upload lists the entries the API rejected; the rest were stored
+        try:
+            body = response.json() if response.content else None
+        except ValueError:
+            body = None
+        for error in (body.get('errors') if isinstance(body, dict) else None) or []:
+            logger.error(f"Snapshot {error['index']} of batch rejected: {error['error']}")
+        return True
+    if 400 <= response.status_code < 500:
+        logger.error(f"Upload rejected: {_error_message(response)}")
+        return False
+    return None
+
+
+def _error_message(response) -> str:
+    """The API's error field, or the raw body when it is not JSON (e.g. from a proxy)"""
+    try:
+        body = response.json()
+    except ValueError:
+        return response.text[:200] or f"HTTP {response.status_code}"
+    return body.get('error') if isinstance(body, dict) else str(body)
+
+
+def upload_failed(breaker: 'CircuitBreaker', error: Exception, attempt: int, logger) -> None:
+    """Record an upload that got no response (connection error, timeout)"""
+    breaker.record_failure()
+    logger.warning(f"Upload attempt {attempt + 1} failed: {str(error)}")
+
+
+def breaker_for(base_url: str, **kwargs) -> 'CircuitBreaker':
+    """
+    Process-wide circuit breaker for an API base URL.
+
+    Every client of the same API shares what is known about its health.
+    Settings are fixed by the first caller.
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(base_url)
+        if breaker is None:
+            breaker = _breakers[base_url] = CircuitBreaker(**kwargs)
+        return breaker
+
+
+class CircuitBreaker:
+    """
+    Stops uploads to an API that keeps failing.
+
+    After failure_threshold consecutive failures (or one response carrying
+    Retry-After) the circuit opens and allow() refuses calls. The open
+    period starts at reset_timeout, doubles with each consecutive opening
+    up to max_reset_timeout, and is jittered; a Retry-After longer than
+    that is honoured. Then a single trial call is let through (half-open)
+    and its outcome closes or re-opens the circuit.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT,
+                 max_reset_timeout: float = DEFAULT_MAX_BACKOFF,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._openings = 0
+        self._opened_until = 0.0
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and self._clock() >= self._opened_until:
+                return self.HALF_OPEN
+            return self._state
+
+    def retry_in(self) -> float:
+        """Seconds until the next call is allowed (0 when closed)"""
+        with self._lock:
+            return max(self._opened_until - self._clock(), 0.0) if self._state != self.CLOSED else 0.0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._clock() < self._opened_until or self._trial_running:
+                return False
+            self._state = self.HALF_OPEN
+            self._trial_running = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._openings = 0
+            self._trial_running = False
+
+    def record_failure(self, retry_after: Optional[float] = None) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == self.OPEN and not retry_after:
+                return  # a call started before the circuit opened
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold or retry_after:
+                self._state = self.OPEN
+                open_for = backoff_delay(self.reset_timeout, self._openings, self.max_reset_timeout)
+                self._openings += 1
+                self._opened_until = self._clock() + max(open_for, retry_after or 0)
@@ -1,12 +1,18 @@
-import os
-import json
 import time
-from datetime import datetime, UTC
-from typing import List, Optional
+from datetime import datetime
+from typing import Dict, List, Optional
 import requests
 from pathlib import Path
 import logging
-from .models import MetricsSnapshot, SystemMetrics, CryptoMetrics
+from .models import MetricsSnapshot, SystemMetrics, CryptoMetrics, MetricSummary, MarketPrices
+from .deadband import Deadband, DeadbandFilter
+from .transport import Transport, HTTPTransport, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, DEFAULT_POOL_SIZE
+from .uploader import BackgroundUploader
+from .offline_store import OfflineStore, open_store
+from .replay import replayer_for, DEFAULT_REPLAY_RATE, DEFAULT_RETRY_INTERVAL
+from .breaker import (CircuitOpenError, backoff_delay, breaker_for, upload_failed, upload_result,
+                      DEFAULT_FAILURE_THRESHOLD, DEFAULT_MAX_BACKOFF)
+from .serialization import batch_payload, build_snapshot, command_payload, metrics_params, parse_metrics, restart_params
 
 class MetricsClient:
     """Client for interacting with the Metrics API."""
@@ -14,103 +20,247 @@ class MetricsClient:
     def __init__(self, base_url: str, device_id: int, 
                  offline_storage_path: str = "offline_metrics",
                  max_retries: int = 3,
-                 retry_delay: float = 1.0):
+                 retry_delay: float = 1.0,
+                 deadbands: Optional[Dict[str, Deadband]] = None,
+                 max_silence: float = 300.0,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 transport: Optional[Transport] = None,
+                 background_upload: bool = False,
+                 queue_size: int = 1000,
+                 batch_size: int = 100,
+                 flush_interval: float = 1.0,
+                 backpressure: str = BackgroundUploader.DROP_OLDEST,
+                 replay_rate: float = DEFAULT_REPLAY_RATE,
+                 replay_retry_interval: float = DEFAULT_RETRY_INTERVAL,
+                 failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 max_backoff: float = DEFAULT_MAX_BACKOFF,
+                 offline_max_bytes: Optional[int] = None,
+                 offline_max_age: Optional[float] = None,
+                 offline_policy: str = OfflineStore.DROP_OLDEST):
         """
         Initialize the metrics client.
         
         Args:
             base_url: Base URL of the metrics API
             device_id: ID of the device sending metrics
-            offline_storage_path: Path to store metrics when offline
+            offline_storage_path: Directory of the offline log (shared by
+                every client using the same directory)
             max_retries: Maximum number of retry attempts
-            retry_delay: Delay between retries in seconds
+            retry_delay: Delay before the first retry in seconds; doubles
+                per attempt (up to max_backoff) and is jittered
+            deadbands: Per-metric change thresholds; values within the band
+                are not uploaded (see metrics_sdk.deadband)
+            max_silence: Seconds after which a metric is re-sent even if unchanged
+            connect_timeout: Seconds to wait for a connection to the API
+            read_timeout: Seconds to wait for each response
+            pool_size: Keep-alive connections kept per API host (shared by
+                every client using the same base URL)
+            transport: Send requests through this instead of HTTP (e.g. a
+                FlaskTestTransport in tests)
+            background_upload: Queue post_metrics() calls and upload them in
+                batches from a background thread (see BackgroundUploader);
+                call flush() or close() before exiting
+            queue_size: Snapshots queued in memory in background mode
+            batch_size: Most snapshots per batch upload
+            flush_interval: Longest a queued snapshot waits before upload
+            backpressure: What a full queue does: 'block', 'drop_oldest' or 'spill'
+            replay_rate: Most stored snapshots replayed per second
+            replay_retry_interval: Seconds between replay attempts while the
+                API is unreachable
+            failure_threshold: Consecutive failed uploads that open the
+                circuit for this API (see metrics_sdk.breaker)
+            max_backoff: Longest retry delay and longest open circuit period
+            offline_max_bytes: Cap on the offline log's size (None: unbounded)
+            offline_max_age: Seconds after which stored metrics are evicted
+                (None: kept until uploaded)
+            offline_policy: What the size cap does: 'drop_oldest' or
+                'downsample' (merge old snapshots into coarser summaries);
+                see offline_stats() for what was lost
+        
+        Construction does no I/O beyond opening the offline log. Stored
+        metrics are replayed by a background thread shared by every client
+        using the same storage directory (see replay_status()); its
+        settings come from the first such client.
+        
+        Uploads go through a circuit breaker shared by every client of the
+        same base URL. While it is open, post_metrics() stores snapshots
+        offline without trying the network.
         """
         self.base_url = base_url.rstrip('/')
         self.device_id = device_id
         self.offline_storage_path = Path(offline_storage_path)
         self.max_retries = max_retries
         self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.deadband_filter = DeadbandFilter(deadbands, max_silence) if deadbands else None
+        self.transport = transport or HTTPTransport(self.base_url, connect_timeout, read_timeout, pool_size)
+        self.breaker = breaker_for(self.base_url, failure_threshold=failure_threshold, max_reset_timeout=max_backoff)
         
-        # Create offline storage directory
-        self.offline_storage_path.mkdir(parents=True, exist_ok=True)
+        # Open (or create) the offline log
+        self.offline_store = open_store(
+            self.offline_storage_path,
+            max_bytes=offline_max_bytes,
+            max_age=offline_max_age,
+            policy=offline_policy
+        )
         
         # Set up logging
         self.logger = logging.getLogger('MetricsSDK')
         self.logger.setLevel(logging.INFO)
         
-        # Try to upload any stored offline metrics
-        self._upload_stored_metrics()
+        # Upload stored offline metrics in the background
+        self.replayer = replayer_for(
+            self.offline_store,
+            self._upload_records,
+            batch_size=batch_size,
+            rate=replay_rate,
+            retry_interval=replay_retry_interval
+        )
+        
+        self.uploader = BackgroundUploader(
+            self._upload_batch,
+            self._store_offline,
+            max_queue=queue_size,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            policy=backpressure,
+            max_retries=max_retries,
+            retry_delay=retry_delay
+        ) if background_upload else None
     
     def _store_offline(self, snapshot: MetricsSnapshot) -> None:
         """Store metrics offline for later upload."""
-        timestamp = snapshot.timestamp.strftime('%Y%m%d_%H%M%S_%f')
-        filepath = self.offline_storage_path / f"metrics_{timestamp}.json"
-        
-        with open(filepath, 'w') as f:
-            json.dump(snapshot.to_dict(), f)
-        
-        self.logger.info(f"Stored metrics offline: {filepath}")
+        self.offline_store.append(snapshot.to_dict())
+        self.replayer.notify_stored()
+        self.logger.info(f"Stored metrics offline: {self.offline_storage_path}")
     
-    def _upload_stored_metrics(self) -> None:
-        """Try to upload any stored offline metrics."""
-        if not self.offline_storage_path.exists():
-            return
-            
-        for filepath in self.offline_storage_path.glob("metrics_*.json"):
+    def _upload_records(self, records: List[dict]) -> bool:
+        """Upload stored snapshots in one batch; raises on errors worth retrying."""
+        snapshots = []
+        for record in records:
             try:
-                with open(filepath, 'r') as f:
-                    data = json.load(f)
-                
-                snapshot = MetricsSnapshot.from_dict(data)
-                success = self._upload_with_retry(snapshot)
-                
-                if success:
-                    os.remove(filepath)
-                    self.logger.info(f"Successfully uploaded and removed stored metrics: {filepath}")
-                    
+                snapshots.append(MetricsSnapshot.from_dict(record))
             except Exception as e:
-                self.logger.error(f"Error processing stored metrics {filepath}: {str(e)}")
+                self.logger.error(f"Skipping unreadable stored metrics: {str(e)}")
+        return self._upload_batch(snapshots) if snapshots else True
+    
+    def replay_status(self) -> dict:
+        """
+        Progress of the offline backlog replay.
+        
+        Returns:
+            Dict with 'state' ('idle', 'replaying', 'waiting' or 'stopped'),
+            'pending_bytes', 'replayed', 'rejected', 'lag_seconds' (age of the
+            oldest stored snapshot) and 'last_error'
+        """
+        return self.replayer.status()
+    
+    def offline_stats(self) -> dict:
+        """
+        State of the offline log.
+        
+        Returns:
+            Dict with 'pending_bytes', 'segments', and the number of stored
+            snapshots 'evicted' by the limits, 'downsampled' into coarser
+            summaries, and lost to 'corrupt' records
+        """
+        return self.offline_store.stats()
     
     def _upload_with_retry(self, snapshot: MetricsSnapshot) -> bool:
         """Upload metrics with retry logic."""
         for attempt in range(self.max_retries):
+            if not self.breaker.allow():
+                self.logger.info("Circuit open, not contacting the API")
+                return False
+            
             try:
-                response = requests.post(
-                    f"{self.base_url}/v1/metrics",
+                response = self.transport.post(
+                    "/v1/metrics",
                     json=snapshot.to_dict()
                 )
-                
-                if response.status_code == 201:
-                    return True
-                    
-                if response.status_code == 400:  # Bad request, don't retry
-                    self.logger.error(f"Bad request: {response.json().get('error')}")
-                    return False
+                stored = upload_result(self.breaker, response, self.logger)
+                if stored is not None:
+                    if stored:
+                        self.replayer.notify_uploaded()
+                    return stored
                     
             except requests.RequestException as e:
-                self.logger.warning(f"Upload attempt {attempt + 1} failed: {str(e)}")
+                upload_failed(self.breaker, e, attempt, self.logger)
             
             if attempt < self.max_retries - 1:
-                time.sleep(self.retry_delay * (attempt + 1))  # Exponential backoff
+                time.sleep(backoff_delay(self.retry_delay, attempt, self.max_backoff))
         
         return False
     
+    def _upload_batch(self, snapshots: List[MetricsSnapshot]) -> bool:
+        """Upload many snapshots in one request; raises on errors worth retrying."""
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Circuit open for {self.base_url}, retry in {self.breaker.retry_in():.0f}s")
+        try:
+            response = self.transport.post(
+                "/v1/metrics/batch",
+                json=batch_payload(snapshots)
+            )
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+        stored = upload_result(self.breaker, response, self.logger)
+        if stored is None:
+            raise requests.HTTPError(f"API unavailable ({response.status_code})", response=response)
+        if stored:
+            self.replayer.notify_uploaded()
+        return stored
+    
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until every queued snapshot has been uploaded (background mode).
+        
+        Returns:
+            bool: False if the timeout expired first
+        """
+        return self.uploader.flush(timeout) if self.uploader else True
+    
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Flush and stop the background uploader; unsent snapshots are stored offline."""
+        if self.uploader:
+            self.uploader.close(timeout)
+        self.offline_store.sync()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
     def post_metrics(self, 
                     system_metrics: Optional[SystemMetrics] = None,
-                    crypto_metrics: Optional[CryptoMetrics] = None) -> bool:
+                    crypto_metrics: Optional[CryptoMetrics] = None,
+                    summaries: Optional[Dict[str, MetricSummary]] = None) -> bool:
         """
         Upload metrics to the API.
         
+        Args:
+            system_metrics: Latest system metrics
+            crypto_metrics: Latest crypto prices
+            summaries: Per-metric statistics over high-frequency samples
+        
         Returns:
-            bool: True if upload was successful (immediately or stored for later)
+            bool: True if upload was successful (immediately, queued in
+            background mode, or stored for later)
+            or nothing needed sending because every value was within its deadband
         """
-        snapshot = MetricsSnapshot(
-            device_id=self.device_id,
-            timestamp=datetime.now(UTC),
-            system_metrics=system_metrics,
-            crypto_metrics=crypto_metrics
-        )
+        snapshot = build_snapshot(self.device_id, system_metrics, crypto_metrics, summaries, self.deadband_filter)
+        if snapshot is None:
+            return True
         
+        # In background mode the worker uploads (and stores offline on failure)
+        if self.uploader:
+            self.uploader.submit(snapshot)
+            return True
+            
         # Try to upload immediately
         success = self._upload_with_retry(snapshot)
         
@@ -123,7 +273,8 @@ class MetricsClient:
     def get_metrics(self, 
                    start_time: Optional[datetime] = None,
                    end_time: Optional[datetime] = None,
-                   limit: int = 100) -> List[MetricsSnapshot]:
+                   limit: int = 100,
+                   fill: Optional[str] = None) -> List[MetricsSnapshot]:
         """
         Get metrics from the API.
         
@@ -131,26 +282,202 @@ class MetricsClient:
             start_time: Start time for filtering metrics
             end_time: End time for filtering metrics
             limit: Maximum number of metrics to return
+            fill: 'previous' to fill values suppressed by deadbands with the
+                last reported value (step-wise series)
             
         Returns:
             List of MetricsSnapshot objects
         """
+        try:
+            response = self.transport.get("/v1/metrics", params=metrics_params(start_time, end_time, limit, fill))
+            response.raise_for_status()
+            return parse_metrics(response.json())
+        except Exception as e:
+            self.logger.error(f"Error getting metrics: {str(e)}")
+            return []
+            
+    def list_devices(self,
+                     prefix: Optional[str] = None,
+                     device_type: Optional[str] = None,
+                     cursor: Optional[str] = None,
+                     limit: int = 100) -> dict:
+        """
+        List registered devices, one page at a time.
+        
+        Args:
+            prefix: Only return devices whose name starts with this
+            device_type: Only return devices of this type
+            cursor: next_cursor from the previous page
+            limit: Maximum number of devices to return
+            
+        Returns:
+            Dict with 'devices' and 'next_cursor' (None on the last page)
+        """
         params = {'limit': limit}
         
+        if prefix:
+            params['prefix'] = prefix
+        if device_type:
+            params['device_type'] = device_type
+        if cursor:
+            params['cursor'] = cursor
+            
+        try:
+            response = self.transport.get("/v1/devices", params=params)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            self.logger.error(f"Error listing devices: {str(e)}")
+            return {'devices': [], 'next_cursor': None}
+    
+    def get_stale_devices(self, older_than: str = '5m', limit: int = 1000) -> List[dict]:
+        """
+        List devices that have not reported recently.
+        
+        Args:
+            older_than: Silence threshold such as '90s', '5m' or '1h'
+            limit: Maximum number of devices to return
+            
+        Returns:
+            List of dicts with device_id, last_seen and seconds_since_seen, oldest first
+        """
+        try:
+            response = self.transport.get(
+                "/v1/devices/stale",
+                params={'older_than': older_than, 'limit': limit}
+            )
+            response.raise_for_status()
+            return response.json().get('devices', [])
+        except Exception as e:
+            self.logger.error(f"Error getting stale devices: {str(e)}")
+            return []
+    
+    def register_devices(self, devices: List[dict]) -> dict:
+        """
+        Register or update many devices in one request.
+        
+        Args:
+            devices: List of dicts with 'name' and 'device_type'
+            
+        Returns:
+            Mapping of device name to device ID (empty on failure)
+        """
+        try:
+            response = self.transport.post(
+                "/v1/devices/batch",
+                json={'devices': devices}
+            )
+            response.raise_for_status()
+            return response.json().get('devices', {})
+        except Exception as e:
+            self.logger.error(f"Error registering devices: {str(e)}")
+            return {}
+    
+    def list_market_symbols(self) -> List[dict]:
+        """
+        List the market symbol registry.
+        
+        Returns:
+            List of dicts with 'symbol' and 'enabled'
+        """
+        try:
+            response = self.transport.get("/v1/market/symbols")
+            response.raise_for_status()
+            return response.json().get('symbols', [])
+        except Exception as e:
+            self.logger.error(f"Error listing market symbols: {str(e)}")
+            return []
+    
+    def add_market_symbols(self, symbols: List[str], enabled: bool = True) -> List[str]:
+        """
+        Register market symbols (CoinGecko ids) for fetching, or enable/disable them.
+        
+        Args:
+            symbols: Symbols to register
+            enabled: False to stop fetching the symbols
+            
+        Returns:
+            The registered symbols (empty on failure)
+        """
+        try:
+            response = self.transport.post(
+                "/v1/market/symbols",
+                json={'symbols': symbols, 'enabled': enabled}
+            )
+            response.raise_for_status()
+            return response.json().get('symbols', [])
+        except Exception as e:
+            self.logger.error(f"Error adding market symbols: {str(e)}")
+            return []
+    
+    def get_market_prices(self,
+                          symbols: Optional[List[str]] = None,
+                          start_time: Optional[datetime] = None,
+                          end_time: Optional[datetime] = None,
+                          step: int = 60) -> Optional[MarketPrices]:
+        """
+        Get many symbols' price series in one request.
+        
+        Args:
+            symbols: Symbols to return (default: every enabled symbol)
+            start_time: Start of the range (default: a day before end_time)
+            end_time: End of the range (default: now)
+            step: Seconds between points; widened by the server for long ranges
+            
+        Returns:
+            MarketPrices with one shared timestamp column, or None on failure
+        """
+        params = {'step': step}
+        
+        if symbols:
+            params['symbols'] = ','.join(symbols)
         if start_time:
             params['start_time'] = start_time.isoformat()
         if end_time:
             params['end_time'] = end_time.isoformat()
             
         try:
-            response = requests.get(f"{self.base_url}/v1/metrics", params=params)
+            response = self.transport.get("/v1/market/prices", params=params)
             response.raise_for_status()
+            return MarketPrices.from_dict(response.json())
+        except Exception as e:
+            self.logger.error(f"Error getting market prices: {str(e)}")
+            return None
+    
+    def export_metrics(self,
+                       output_path: str,
+                       start_time: Optional[datetime] = None,
+                       end_time: Optional[datetime] = None,
+                       fmt: str = 'parquet') -> bool:
+        """
+        Stream a columnar export of this device's metrics to a file.
+        
+        Args:
+            output_path: File to write the export to
+            start_time: Start time for filtering metrics
+            end_time: End time for filtering metrics
+            fmt: 'parquet' or 'arrow' (Arrow IPC stream)
             
-            data = response.json()
-            return [MetricsSnapshot.from_dict(item) for item in data]
+        Returns:
+            bool: True if the export was written completely
+        """
+        params = {'device_id': self.device_id, 'format': fmt}
+        
+        if start_time:
+            params['start_time'] = start_time.isoformat()
+        if end_time:
+            params['end_time'] = end_time.isoformat()
+            
+        try:
+            with self.transport.get("/v1/metrics/export", params=params, stream=True) as response:
+                response.raise_for_status()
+                with open(output_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+            return True
         except Exception as e:
-            self.logger.error(f"Error getting metrics: {str(e)}")
-            return []
+            self.logger.error(f"Error exporting metrics: {str(e)}")
+            return False
             
     def send_command(self, command_type: str, params: Optional[dict] = None) -> dict:
         """
@@ -163,21 +490,15 @@ class MetricsClient:
         Returns:
             Response from the API as a dictionary
         """
-        if params is None:
-            params = {}
-            
-        payload = {
-            'command_type': command_type,
-            'params': params
-        }
+        payload = command_payload(command_type, params)
         
         try:
             # Add debug logging
             self.logger.info(f"Sending command to {self.base_url}/v1/devices/{self.device_id}/commands")
             self.logger.info(f"Payload: {payload}")
             
-            response = requests.post(
-                f"{self.base_url}/v1/devices/{self.device_id}/commands", 
+            response = self.transport.post(
+                f"/v1/devices/{self.device_id}/commands", 
                 json=payload,
                 headers={'Content-Type': 'application/json'}
             )
@@ -192,6 +513,115 @@ class MetricsClient:
             self.logger.error(f"Error sending command: {str(e)}")
             return {'error': str(e), 'status': 'failed'}
             
+    def poll_commands(self, timeout: float = 30.0, max_commands: int = 10) -> List[dict]:
+        """
+        Wait for commands addressed to this device.
+        
+        The server holds the request open until a command is queued or the
+        timeout expires, so an idle device can call this in a loop without
+        busy polling. Returned commands are marked delivered.
+        
+        Args:
+            timeout: Seconds the server may hold the request open
+            max_commands: Maximum number of commands to claim at once
+            
+        Returns:
+            List of command dicts (empty if the timeout expired)
+        """
+        try:
+            response = self.transport.get(
+                f"/v1/devices/{self.device_id}/commands/poll",
+                params={'timeout': timeout, 'max': max_commands},
+                timeout=timeout + 10
+            )
+            response.raise_for_status()
+            return response.json().get('commands', [])
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"Error polling commands: {str(e)}")
+            return []
+            
+    def update_command_status(self, command_id: int, status: str,
+                              result: Optional[dict] = None) -> dict:
+        """
+        Report progress on a delivered command.
+        
+        Args:
+            command_id: ID of the command
+            status: 'acked', 'done' or 'failed'
+            result: Optional details about the outcome
+            
+        Returns:
+            Updated command as a dictionary
+        """
+        payload = {'status': status}
+        if result is not None:
+            payload['result'] = result
+            
+        try:
+            response = self.transport.post(
+                f"/v1/commands/{command_id}/status",
+                json=payload
+            )
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"Error updating command {command_id}: {str(e)}")
+            return {'error': str(e), 'status': 'failed'}
+            
+    def fan_out_command(self, command_type: str, params: Optional[dict] = None,
+                        tags: Optional[List[str]] = None,
+                        device_type: Optional[str] = None,
+                        device_ids: Optional[List[int]] = None) -> dict:
+        """
+        Send one command to every device matching a selector.
+        
+        Args:
+            command_type: Type of command to send (e.g., 'restart_app')
+            params: Additional parameters for the command
+            tags: Only target devices carrying all of these tags
+            device_type: Only target devices of this type
+            device_ids: Only target these devices
+            
+        Returns:
+            Batch summary with 'batch_id', 'target_count' and per-state 'counts'
+        """
+        selector = {}
+        if tags:
+            selector['tags'] = tags
+        if device_type:
+            selector['device_type'] = device_type
+        if device_ids:
+            selector['device_ids'] = device_ids
+            
+        try:
+            response = self.transport.post(
+                "/v1/commands/fanout",
+                json={'command_type': command_type, 'params': params or {}, 'selector': selector}
+            )
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"Error fanning out command: {str(e)}")
+            return {'error': str(e), 'status': 'failed'}
+            
+    def get_command_batch(self, batch_id: int) -> dict:
+        """
+        Get delivery progress of a fan-out.
+        
+        Args:
+            batch_id: ID returned by fan_out_command
+            
+        Returns:
+            Batch summary with per-state 'counts'
+        """
+        try:
+            response = self.transport.get(f"/v1/commands/batches/{batch_id}")
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"Error getting command batch {batch_id}: {str(e)}")
+            return {'error': str(e), 'status': 'failed'}
+            
     def restart_app(self, app_name: str, force: bool = False) -> dict:
         """
         Restart a specific application on the device.
@@ -203,7 +633,4 @@ class MetricsClient:
         Returns:
             Response from the API as a dictionary
         """
-        return self.send_command('restart_app', {
-            'app_name': app_name,
-            'force': force
-        }) 
\ No newline at end of file
+        return self.send_command('restart_app', restart_params(app_name, force)) 
\ No newline at end of file
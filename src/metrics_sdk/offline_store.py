@@ -0,0 +1,469 @@
+import atexit
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Appended records are fsynced every SYNC_EVERY records, or on the first
+# append more than SYNC_INTERVAL seconds after the last fsync
+DEFAULT_SYNC_EVERY = 32
+DEFAULT_SYNC_INTERVAL = 1.0
+# A new segment file is started once the current one reaches this size
+DEFAULT_SEGMENT_BYTES = 1024 * 1024
+# Smallest segment a max_bytes cap shrinks segments to
+MIN_SEGMENT_BYTES = 4096
+
+# Default width of the windows the downsample policy merges snapshots
+# into; each further pass over a segment doubles it, up to 2**MAX_DOWNSAMPLE_LEVEL times
+DEFAULT_DOWNSAMPLE_WINDOW = 300.0
+MAX_DOWNSAMPLE_LEVEL = 6
+
+# Record header: payload length, CRC-32 of the payload
+_HEADER = struct.Struct('<II')
+_CURSOR_FILE = 'cursor.json'
+_REWRITE_FILE = 'rewrite.tmp'
+
+_stores: Dict[Path, 'OfflineStore'] = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(path, **kwargs) -> 'OfflineStore':
+    """
+    Process-wide store for a storage directory.
+
+    Every client using the same directory appends to (and replays from)
+    the same log. Settings are fixed by the first caller.
+    """
+    path = Path(path).resolve()
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None or not path.exists():
+            if store is not None:
+                store.close()
+            store = _stores[path] = OfflineStore(path, **kwargs)
+        return store
+
+
+class OfflineStore:
+    """
+    Append-only log of snapshots waiting for upload.
+
+    Records are written to numbered segment files as length | crc32 |
+    JSON payload and read back in the order they were appended. The read
+    position lives in a small cursor file: committing a replayed batch
+    only rewrites the cursor, and a fully consumed segment is deleted
+    whole. Appends are fsynced in groups, so a crash loses at most the
+    records since the last fsync; a torn record at the end of the log is
+    cut off when the store is opened, and a corrupt record ends the read
+    of its segment.
+
+    Files left in the directory by older SDK versions (metrics_*.json, one
+    snapshot each) are moved into the log when the store is opened.
+
+    The log can be bounded by age and size. Limits are applied to whole
+    segments when the store is opened and each time a segment fills up:
+      - max_age: segments last written longer ago are evicted
+      - max_bytes: with the 'drop_oldest' policy the oldest segments are
+        evicted, skipping any a replay has read but not yet committed; with 'downsample' the oldest unread segments are first
+        rewritten with their snapshots merged into one summary per device
+        and window (see downsample()), the window doubling on each pass,
+        and segments are evicted only if that is not enough
+    evicted counts the stored snapshots dropped and downsampled those
+    folded into a merged one, so what is stored plus both counters equals
+    what was appended.
+    """
+
+    DROP_OLDEST = 'drop_oldest'
+    DOWNSAMPLE = 'downsample'
+    POLICIES = (DROP_OLDEST, DOWNSAMPLE)
+
+    def __init__(self, path,
+                 segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+                 sync_every: int = DEFAULT_SYNC_EVERY,
+                 sync_interval: float = DEFAULT_SYNC_INTERVAL,
+                 max_bytes: Optional[int] = None,
+                 max_age: Optional[float] = None,
+                 policy: str = DROP_OLDEST,
+                 downsample_window: float = DEFAULT_DOWNSAMPLE_WINDOW):
+        """
+        Args:
+            path: Directory holding the segments
+            segment_bytes: Size at which a new segment is started (at most a
+                quarter of max_bytes, so the cap can be applied in segments,
+                but no less than MIN_SEGMENT_BYTES)
+            sync_every: Most appended records between fsyncs
+            sync_interval: Seconds after which the next append is fsynced
+            max_bytes: Most bytes of unreplayed records to keep (None: no limit)
+            max_age: Seconds after which stored records are evicted (None: no limit)
+            policy: 'drop_oldest' or 'downsample' (see class docstring)
+            downsample_window: Seconds covered by a merged snapshot on the
+                first downsampling pass
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown offline store policy: {policy}. Use one of: {', '.join(self.POLICIES)}")
+        self.path = Path(path)
+        self.segment_bytes = (min(segment_bytes, max(max_bytes // 4, MIN_SEGMENT_BYTES))
+                              if max_bytes else segment_bytes)
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.policy = policy
+        self.downsample_window = downsample_window
+        self.corrupt = 0
+        self.evicted = 0
+        self.downsampled = 0
+        self.logger = logging.getLogger('MetricsSDK')
+
+        self._lock = threading.RLock()
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        # Last segment of a read() not yet committed
+        self._reading: Optional[int] = None
+        self._next_seq = 0
+        self._levels: Dict[int, int] = {}
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        (self.path / _REWRITE_FILE).unlink(missing_ok=True)
+        self._segments = sorted(
+            int(p.stem.split('_', 1)[1]) for p in self.path.glob('segment_*.log')
+        )
+        self._sizes = {seq: self._segment_path(seq).stat().st_size for seq in self._segments}
+        self._cursor = self._load_cursor()
+        for seq in [seq for seq in self._segments if seq < self._cursor[0]]:
+            self._remove_segment(seq)
+        if self._segments:
+            self._recover_tail(self._segments[-1])
+        self._migrate_legacy_files()
+        self._close_file()
+        self._enforce_limits()
+        atexit.register(self.close)
+
+    def append(self, record: dict) -> None:
+        """Add a record to the end of the log"""
+        payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        data = _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._file is None or self._sizes[self._segments[-1]] >= self.segment_bytes:
+                self._roll()
+            self._file.write(data)
+            self._sizes[self._segments[-1]] += len(data)
+            self._unsynced += 1
+            if (self._unsynced >= self.sync_every
+                    or time.monotonic() - self._last_sync >= self.sync_interval):
+                self.sync()
+
+    def read(self, max_records: int) -> Tuple[List[dict], Tuple[int, int]]:
+        """
+        Oldest unconsumed records, without consuming them.
+
+        Returns:
+            The records and the position to commit() once they are handled
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+            records = []
+            seq, offset = self._cursor
+            for segment in [s for s in self._segments if s >= seq]:
+                if segment > seq:
+                    seq, offset = segment, 0
+                with open(self._segment_path(seq), 'rb') as f:
+                    f.seek(offset)
+                    while len(records) < max_records:
+                        try:
+                            payload = _read_record(f)
+                        except ValueError:
+                            self.logger.error(f"Corrupt offline record in segment {seq} at byte {offset}; "
+                                              f"skipping the rest of the segment")
+                            self.corrupt += 1
+                            offset = self._sizes[seq]
+                            if seq == self._segments[-1]:
+                                self._close_file()
+                            break
+                        if payload is None:
+                            break
+                        records.append(json.loads(payload))
+                        offset = f.tell()
+                if len(records) >= max_records:
+                    break
+            self._reading = seq if records else None
+            return records, (seq, offset)
+
+    def commit(self, position: Tuple[int, int]) -> None:
+        """Mark everything before position (from read()) as consumed"""
+        with self._lock:
+            seq, offset = position
+            for consumed in [s for s in self._segments if s < seq]:
+                self._remove_segment(consumed)
+            if seq in self._sizes and offset >= self._sizes[seq]:
+                # Consumed to the end; the next append starts a new segment
+                self._remove_segment(seq)
+                seq, offset = seq + 1, 0
+            self._cursor = (seq, offset)
+            self._reading = None
+            self._save_cursor()
+
+    def pending_bytes(self) -> int:
+        """Size of the records not yet consumed"""
+        with self._lock:
+            return sum(self._sizes.values()) - (self._cursor[1] if self._cursor[0] in self._sizes else 0)
+
+    def stats(self) -> dict:
+        """Size of the backlog and how many snapshots the limits have cost"""
+        with self._lock:
+            return {
+                'pending_bytes': self.pending_bytes(),
+                'segments': len(self._segments),
+                'evicted': self.evicted,
+                'downsampled': self.downsampled,
+                'corrupt': self.corrupt
+            }
+
+    def sync(self) -> None:
+        """fsync appended records"""
+        with self._lock:
+            if self._file is not None and self._unsynced:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._unsynced = 0
+            self._last_sync = time.monotonic()
+
+    def close(self) -> None:
+        """fsync and close the open segment; a later append reopens it"""
+        with self._lock:
+            self._close_file()
+
+    def _segment_path(self, seq: int) -> Path:
+        return self.path / f"segment_{seq:010d}.log"
+
+    def _roll(self) -> None:
+        """Start a new segment for appends"""
+        self._close_file()
+        self._enforce_limits()
+        # Numbers are not reused, so a position read before an eviction stays valid
+        seq = max(self._segments[-1] + 1 if self._segments else 0, self._cursor[0], self._next_seq)
+        self._next_seq = seq + 1
+        self._file = open(self._segment_path(seq), 'ab')
+        self._segments.append(seq)
+        self._sizes[seq] = 0
+        self._fsync_dir()
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def _remove_segment(self, seq: int) -> None:
+        if self._segments and seq == self._segments[-1]:
+            self._close_file()
+        self._segment_path(seq).unlink(missing_ok=True)
+        self._segments.remove(seq)
+        del self._sizes[seq]
+        self._levels.pop(seq, None)
+
+    def _enforce_limits(self) -> None:
+        """Apply max_age and max_bytes; every segment is closed when this runs"""
+        # Segments a replay has read but not committed are left alone, or
+        # their snapshots would be counted as both evicted and replayed
+        reading = -1 if self._reading is None else max(self._cursor[0], self._reading)
+        if self.max_age is not None:
+            cutoff = time.time() - self.max_age
+            for seq in list(self._segments):
+                if seq > reading and self._segment_path(seq).stat().st_mtime < cutoff:
+                    self._evict(seq, 'older than max_age')
+        if self.max_bytes is None:
+            return
+        if self.policy == self.DOWNSAMPLE:
+            # Segments a replay may be reading keep their byte offsets
+            unread = max(self._cursor[0], reading)
+            for seq in list(self._segments):
+                if self.pending_bytes() <= self.max_bytes:
+                    break
+                if seq > unread and self._levels.get(seq, 0) < MAX_DOWNSAMPLE_LEVEL:
+                    self._downsample(seq)
+        for seq in list(self._segments):
+            if self.pending_bytes() <= self.max_bytes:
+                break
+            if seq > reading:
+                self._evict(seq, 'over max_bytes')
+
+    def _evict(self, seq: int, reason: str) -> None:
+        offset = self._cursor[1] if seq == self._cursor[0] else 0
+        count = len(self._records(seq, offset))
+        self._remove_segment(seq)
+        self.evicted += count
+        self.logger.warning(f"Evicted {count} stored snapshots ({reason})")
+
+    def _downsample(self, seq: int) -> None:
+        """Rewrite a segment with its snapshots merged into coarser windows"""
+        level = self._levels.get(seq, 0)
+        path = self._segment_path(seq)
+        written = path.stat()
+        records = self._records(seq)
+        merged = downsample(records, self.downsample_window * 2 ** level)
+        tmp = self.path / _REWRITE_FILE
+        with open(tmp, 'wb') as f:
+            for record in merged:
+                payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
+                f.write(_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        # Keep the segment's age for max_age
+        os.utime(path, (written.st_atime, written.st_mtime))
+        self._fsync_dir()
+        self._sizes[seq] = path.stat().st_size
+        self._levels[seq] = level + 1
+        self.downsampled += len(records) - len(merged)
+
+    def _records(self, seq: int, offset: int = 0) -> List[dict]:
+        """The readable records of a segment from offset"""
+        records = []
+        with open(self._segment_path(seq), 'rb') as f:
+            f.seek(offset)
+            try:
+                while (payload := _read_record(f)) is not None:
+                    records.append(json.loads(payload))
+            except ValueError:
+                pass
+        return records
+
+    def _load_cursor(self) -> Tuple[int, int]:
+        try:
+            with open(self.path / _CURSOR_FILE) as f:
+                cursor = json.load(f)
+            return int(cursor['segment']), int(cursor['offset'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return (self._segments[0] if self._segments else 0), 0
+
+    def _save_cursor(self) -> None:
+        tmp = self.path / f"{_CURSOR_FILE}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'segment': self._cursor[0], 'offset': self._cursor[1]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path / _CURSOR_FILE)
+
+    def _fsync_dir(self) -> None:
+        """Persist created and renamed directory entries"""
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _recover_tail(self, seq: int) -> None:
+        """Cut off a record torn by a crash mid-append"""
+        path = self._segment_path(seq)
+        valid = 0
+        with open(path, 'rb') as f:
+            try:
+                while _read_record(f) is not None:
+                    valid = f.tell()
+            except ValueError:
+                pass
+        if valid < self._sizes[seq]:
+            self.logger.warning(f"Truncating {self._sizes[seq] - valid} torn bytes from {path}")
+            os.truncate(path, valid)
+            self._sizes[seq] = valid
+        if self._cursor[0] == seq and self._cursor[1] > valid:
+            self._cursor = (seq, valid)
+
+    def _migrate_legacy_files(self) -> None:
+        legacy = sorted(self.path.glob('metrics_*.json'))
+        if not legacy:
+            return
+        migrated = []
+        for filepath in legacy:
+            try:
+                with open(filepath, 'r') as f:
+                    self.append(json.load(f))
+                migrated.append(filepath)
+            except (OSError, ValueError) as e:
+                self.logger.error(f"Could not migrate stored metrics {filepath}: {str(e)}")
+        self.sync()
+        for filepath in migrated:
+            filepath.unlink()
+        self.logger.info(f"Moved {len(migrated)} stored metrics files into the offline log")
+
+
+def _read_record(f) -> Optional[bytes]:
+    """Next payload in a segment; None at its end, ValueError if torn or corrupt"""
+    header = f.read(_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _HEADER.size:
+        raise ValueError('Truncated record header')
+    length, crc = _HEADER.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length or zlib.crc32(payload) != crc:
+        raise ValueError('Record checksum mismatch')
+    return payload
+
+
+def downsample(records: List[dict], window: float) -> List[dict]:
+    """
+    Merge snapshot records into one per device and window of `window` seconds.
+
+    A merged snapshot keeps the last record's values, timestamp and
+    collector metrics, and summarizes every numeric metric over the
+    records it replaces. Summaries already present are merged, so repeated
+    passes keep count, min, max, mean and last exact; p95 becomes the
+    largest p95 merged (an upper bound).
+    """
+    groups: Dict[tuple, List[dict]] = {}
+    for record in records:
+        try:
+            bucket = int(datetime.fromisoformat(record['timestamp']).timestamp() // window)
+        except (KeyError, TypeError, ValueError):
+            bucket = None
+        groups.setdefault((record.get('device_id'), bucket), []).append(record)
+    return [_merge_records(group, window) if len(group) > 1 else group[0] for group in groups.values()]
+
+
+def _merge_records(records: List[dict], window: float) -> dict:
+    summaries: Dict[str, dict] = {}
+    for record in records:
+        values = {
+            name: {'count': 1, 'min': value, 'max': value, 'mean': value, 'last': value, 'p95': value}
+            for section in ('system_metrics', 'crypto_metrics')
+            for name, value in (record.get(section) or {}).items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        }
+        # Sample summaries describe the interval better than its last value
+        values.update(record.get('summaries') or {})
+        for name, summary in values.items():
+            summaries[name] = _merge_summary(summaries[name], summary) if name in summaries else dict(summary)
+    merged = dict(records[-1])
+    merged['summaries'] = summaries
+    merged['interval_seconds'] = window
+    return merged
+
+
+def _merge_summary(earlier: dict, later: dict) -> dict:
+    count = (earlier.get('count') or 0) + (later.get('count') or 0)
+    means = [(s['mean'], s.get('count') or 0) for s in (earlier, later) if s.get('mean') is not None]
+    weight = sum(n for _, n in means)
+    return {
+        'count': count,
+        'min': _pick(min, earlier.get('min'), later.get('min')),
+        'max': _pick(max, earlier.get('max'), later.get('max')),
+        'mean': sum(m * n for m, n in means) / weight if weight else None,
+        'last': later.get('last') if later.get('last') is not None else earlier.get('last'),
+        'p95': _pick(max, earlier.get('p95'), later.get('p95'))
+    }
+
+
+def _pick(choose, *values):
+    values = [value for value in values if value is not None]
+    return choose(values) if values else None
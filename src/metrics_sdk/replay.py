@@ -0,0 +1,179 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime, UTC
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from .offline_store import OfflineStore
+
+# Most stored snapshots replayed per second, so a large backlog does not
+# flood the API (or the device's uplink) when it comes back
+DEFAULT_REPLAY_RATE = 500.0
+# Seconds to wait before retrying after a replay upload failed
+DEFAULT_RETRY_INTERVAL = 30.0
+
+_replayers: Dict[Path, 'BackgroundReplayer'] = {}
+_replayers_lock = threading.Lock()
+
+
+def replayer_for(store: OfflineStore, send_batch: Callable[[List[dict]], bool], **kwargs) -> 'BackgroundReplayer':
+    """
+    Process-wide replayer for an offline store.
+
+    The first client to open a storage directory starts its replayer; later
+    clients get the same one, so a backlog is replayed once per process
+    rather than once per client. Settings are fixed by the first caller.
+    """
+    with _replayers_lock:
+        replayer = _replayers.get(store.path)
+        if replayer is None or replayer.store is not store:
+            if replayer is not None:
+                replayer.stop()
+            replayer = _replayers[store.path] = BackgroundReplayer(store, send_batch, **kwargs)
+        return replayer
+
+
+class BackgroundReplayer:
+    """
+    Uploads an offline store's backlog from a background thread.
+
+    Batches are read oldest first, sent, and committed once the API has
+    stored (or rejected) them, at no more than `rate` snapshots per second.
+    When an upload fails the batch stays stored and is retried after
+    retry_interval, or as soon as a live upload succeeds.
+    """
+
+    IDLE = 'idle'
+    REPLAYING = 'replaying'
+    WAITING = 'waiting'
+    STOPPED = 'stopped'
+
+    def __init__(self,
+                 store: OfflineStore,
+                 send_batch: Callable[[List[dict]], bool],
+                 batch_size: int = 100,
+                 rate: float = DEFAULT_REPLAY_RATE,
+                 retry_interval: float = DEFAULT_RETRY_INTERVAL):
+        """
+        Args:
+            store: Offline store to replay
+            send_batch: Uploads stored records; returns True when stored,
+                False when rejected for good, and raises on transient failures
+            batch_size: Most records per upload
+            rate: Most records replayed per second
+            retry_interval: Seconds to wait after a failed upload
+        """
+        self.store = store
+        self._send_batch = send_batch
+        self.batch_size = batch_size
+        self.rate = rate
+        self.retry_interval = retry_interval
+
+        self.state = self.IDLE
+        self.replayed = 0
+        self.rejected = 0
+        self.last_error: Optional[str] = None
+        self._oldest: Optional[datetime] = None
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._idle = threading.Condition()
+        self.logger = logging.getLogger('MetricsSDK')
+        self._thread = threading.Thread(target=self._run, name='metrics-replay', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def wake(self) -> None:
+        """Look for stored snapshots now instead of waiting"""
+        self._wake.set()
+
+    def notify_uploaded(self) -> None:
+        """A live upload succeeded; retry now if waiting out a failure"""
+        if self.state == self.WAITING:
+            self._wake.set()
+
+    def notify_stored(self) -> None:
+        """A snapshot was stored; replay it unless waiting out a failure"""
+        if self.state == self.IDLE:
+            self._wake.set()
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Wait until the backlog is replayed; False on timeout or if the API is unreachable"""
+        self.wake()
+        with self._idle:
+            self._idle.wait_for(lambda: self.state != self.REPLAYING and not self._wake.is_set(), timeout)
+            return self.state == self.IDLE
+
+    def stop(self, timeout: float = 1.0) -> None:
+        """Stop replaying; an unfinished batch is replayed again next time"""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        atexit.unregister(self.stop)
+
+    def status(self) -> dict:
+        """
+        Replay progress.
+
+        lag_seconds is the age of the oldest snapshot still stored (None
+        when nothing is waiting).
+        """
+        pending = self.store.pending_bytes()
+        oldest = self._oldest if pending else None
+        return {
+            'state': self.state,
+            'pending_bytes': pending,
+            'replayed': self.replayed,
+            'rejected': self.rejected,
+            'lag_seconds': (datetime.now(UTC) - oldest).total_seconds() if oldest else None,
+            'last_error': self.last_error
+        }
+
+    def _set_state(self, state: str) -> None:
+        with self._idle:
+            self.state = state
+            self._idle.notify_all()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._set_state(self.REPLAYING)
+            self._wake.clear()
+            drained = self._replay()
+            self._set_state(self.IDLE if drained else self.WAITING)
+            self._wake.wait(None if drained else self.retry_interval)
+        self._set_state(self.STOPPED)
+
+    def _replay(self) -> bool:
+        """Replay until the store is empty (True) or an upload fails (False)"""
+        while not self._stop.is_set():
+            records, position = self.store.read(self.batch_size)
+            if not records:
+                return True
+            self._oldest = _parse_timestamp(records[0].get('timestamp'))
+            started = time.monotonic()
+            try:
+                stored = self._send_batch(records)
+            except Exception as e:
+                self.last_error = str(e)
+                self.logger.warning(f"Replay of stored metrics failed: {str(e)}")
+                return False
+            self.store.commit(position)
+            if stored:
+                self.replayed += len(records)
+            else:
+                self.rejected += len(records)
+                self.logger.error(f"Dropped {len(records)} stored metrics the API rejected")
+            self.last_error = None
+            # Rate limit
+            self._stop.wait(max(len(records) / self.rate - (time.monotonic() - started), 0))
+        return False
+
+
+def _parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=UTC)
@@ -0,0 +1,91 @@
+"""
+Request payloads and response parsing shared by MetricsClient and AsyncMetricsClient.
+"""
+
+from datetime import datetime, UTC
+from typing import Dict, List, Optional
+
+from .deadband import DeadbandFilter
+from .models import MetricsSnapshot, SystemMetrics, CryptoMetrics, MetricSummary
+
+
+def _apply_deadband(deadband_filter: DeadbandFilter, metrics, model):
+    """Drop values within their deadband; None if nothing in the group changed."""
+    if metrics is None:
+        return None
+    values = metrics.to_dict()
+    reported = deadband_filter.filter(values)
+    if not reported:
+        return None
+    return model(**{name: reported.get(name) for name in values})
+
+
+def build_snapshot(device_id: int,
+                   system_metrics: Optional[SystemMetrics] = None,
+                   crypto_metrics: Optional[CryptoMetrics] = None,
+                   summaries: Optional[Dict[str, MetricSummary]] = None,
+                   deadband_filter: Optional[DeadbandFilter] = None) -> Optional[MetricsSnapshot]:
+    """
+    Snapshot to upload, stamped now.
+
+    With a deadband filter, values within their band are left out; None
+    means nothing needs sending.
+    """
+    if deadband_filter is not None:
+        system_metrics = _apply_deadband(deadband_filter, system_metrics, SystemMetrics)
+        crypto_metrics = _apply_deadband(deadband_filter, crypto_metrics, CryptoMetrics)
+        if summaries:
+            summaries = deadband_filter.filter_summaries(
+                summaries, system_metrics is not None or crypto_metrics is not None
+            )
+        if system_metrics is None and crypto_metrics is None and not summaries:
+            return None
+
+    return MetricsSnapshot(
+        device_id=device_id,
+        timestamp=datetime.now(UTC),
+        system_metrics=system_metrics,
+        crypto_metrics=crypto_metrics,
+        summaries=summaries
+    )
+
+
+def batch_payload(snapshots: List[MetricsSnapshot]) -> dict:
+    """Body of POST /v1/metrics/batch"""
+    return {'snapshots': [snapshot.to_dict() for snapshot in snapshots]}
+
+
+def metrics_params(start_time: Optional[datetime] = None,
+                   end_time: Optional[datetime] = None,
+                   limit: int = 100,
+                   fill: Optional[str] = None) -> dict:
+    """Query parameters of GET /v1/metrics"""
+    params = {'limit': limit}
+
+    if fill:
+        params['fill'] = fill
+
+    if start_time:
+        params['start_time'] = start_time.isoformat()
+    if end_time:
+        params['end_time'] = end_time.isoformat()
+    return params
+
+
+def parse_metrics(data: list) -> List[MetricsSnapshot]:
+    return [MetricsSnapshot.from_dict(item) for item in data]
+
+
+def command_payload(command_type: str, params: Optional[dict] = None) -> dict:
+    """Body of POST /v1/devices/<id>/commands"""
+    return {
+        'command_type': command_type,
+        'params': params or {}
+    }
+
+
+def restart_params(app_name: str, force: bool = False) -> dict:
+    return {
+        'app_name': app_name,
+        'force': force
+    }
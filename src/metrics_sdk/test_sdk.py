@@ -3,16 +3,31 @@ from unittest.mock import patch, MagicMock
 from datetime import datetime, UTC
 import tempfile
 import shutil
+import os
 import json
 from pathlib import Path
 import requests
 import logging
+import threading
+import time
+import asyncio
+
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
 
 from .client import MetricsClient
-from .models import SystemMetrics, CryptoMetrics, MetricsSnapshot
+from .models import SystemMetrics, CryptoMetrics, CollectorMetrics, MetricSummary, MetricsSnapshot, MarketPrices
+from .deadband import Deadband, DeadbandFilter, parse_deadbands
+from .transport import HTTPTransport, FlaskTestTransport
+from .uploader import BackgroundUploader
+from .offline_store import OfflineStore, MIN_SEGMENT_BYTES, downsample
+from .breaker import CircuitBreaker, backoff_delay
+from .async_client import AsyncMetricsClient
+from .async_transport import AsyncHTTPTransport
 
 # Disable logging during tests
 logging.getLogger('MetricsSDK').setLevel(logging.CRITICAL)
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
 class TestMetricsSDK(unittest.TestCase):
     def setUp(self):
@@ -23,6 +38,8 @@ class TestMetricsSDK(unittest.TestCase):
             device_id=1,
             offline_storage_path=self.temp_dir
         )
+        # Forget upload failures recorded by earlier tests
+        self.client.breaker.record_success()
         
     def tearDown(self):
         """Clean up after each test."""
@@ -50,6 +67,28 @@ class TestMetricsSDK(unittest.TestCase):
         self.assertEqual(snapshot.device_id, 1)
         self.assertIsNotNone(snapshot.timestamp)
         
+    def test_host_metrics_serialization(self):
+        """Optional host metrics round-trip and are omitted when not collected."""
+        self.assertEqual(
+            SystemMetrics(thread_count=10, ram_usage_percent=75.5).to_dict(),
+            {'thread_count': 10, 'ram_usage_percent': 75.5}
+        )
+        original = MetricsSnapshot(
+            device_id=1,
+            timestamp=datetime.now(UTC),
+            system_metrics=SystemMetrics(
+                thread_count=900, ram_usage_percent=40.0, process_count=120,
+                cpu_percent=12.5, cpu_per_core=[10.0, 15.0], load_1=0.5,
+                top_processes=[{'pid': 1, 'name': 'init', 'rss_bytes': 1024}]
+            ),
+            collector_metrics=CollectorMetrics(cpu_percent=0.3, rss_bytes=1024, source_latencies={'system': 0.001}),
+            interval_seconds=15.0
+        )
+        restored = MetricsSnapshot.from_dict(original.to_dict())
+        self.assertEqual(restored.system_metrics, original.system_metrics)
+        self.assertEqual(restored.collector_metrics, original.collector_metrics)
+        self.assertEqual(restored.interval_seconds, 15.0)
+        
     def test_metrics_serialization(self):
         """Test serialization and deserialization of metrics."""
         original = MetricsSnapshot(
@@ -69,7 +108,25 @@ class TestMetricsSDK(unittest.TestCase):
         self.assertEqual(restored.system_metrics.thread_count, original.system_metrics.thread_count)
         self.assertEqual(restored.crypto_metrics.bitcoin_price_usd, original.crypto_metrics.bitcoin_price_usd)
         
-    @patch('requests.post')
+    def test_metric_summary(self):
+        """Test summary statistics and their round trip through a snapshot."""
+        summary = MetricSummary.from_values([float(v) for v in range(1, 101)])
+        self.assertEqual(summary.count, 100)
+        self.assertEqual(summary.min, 1.0)
+        self.assertEqual(summary.max, 100.0)
+        self.assertEqual(summary.mean, 50.5)
+        self.assertEqual(summary.last, 100.0)
+        self.assertEqual(summary.p95, 95.0)
+        
+        original = MetricsSnapshot(
+            device_id=1,
+            timestamp=datetime.now(UTC),
+            summaries={'ram_usage_percent': summary}
+        )
+        restored = MetricsSnapshot.from_dict(original.to_dict())
+        self.assertEqual(restored.summaries['ram_usage_percent'], summary)
+        
+    @patch.object(HTTPTransport, 'post')
     def test_post_metrics_success(self, mock_post):
         """Test successful metrics upload."""
         # Mock successful response
@@ -83,7 +140,7 @@ class TestMetricsSDK(unittest.TestCase):
         self.assertTrue(success)
         self.assertTrue(mock_post.called)
         
-    @patch('requests.post')
+    @patch.object(HTTPTransport, 'post')
     def test_post_metrics_offline_storage(self, mock_post):
         """Test offline storage when upload fails."""
         # Mock failed response
@@ -96,16 +153,12 @@ class TestMetricsSDK(unittest.TestCase):
         # Should still return True as metrics are stored offline
         self.assertTrue(success)
         
-        # Check if file was stored
-        stored_files = list(Path(self.temp_dir).glob("metrics_*.json"))
-        self.assertEqual(len(stored_files), 1)
+        # Check the snapshot was stored
+        stored, _ = self.client.offline_store.read(10)
+        self.assertEqual(len(stored), 1)
+        self.assertEqual(stored[0]['system_metrics']['thread_count'], 10)
         
-        # Verify stored data
-        with open(stored_files[0], 'r') as f:
-            stored_data = json.load(f)
-            self.assertEqual(stored_data['system_metrics']['thread_count'], 10)
-        
-    @patch('requests.get')
+    @patch.object(HTTPTransport, 'get')
     def test_get_metrics(self, mock_get):
         """Test metrics retrieval."""
         # Mock successful response
@@ -129,7 +182,7 @@ class TestMetricsSDK(unittest.TestCase):
         self.assertEqual(metrics[0].system_metrics.thread_count, 10)
         self.assertTrue(mock_get.called)
         
-    @patch('requests.get')
+    @patch.object(HTTPTransport, 'get')
     def test_get_metrics_error(self, mock_get):
         """Test metrics retrieval error handling."""
         # Mock failed response
@@ -140,5 +193,740 @@ class TestMetricsSDK(unittest.TestCase):
         self.assertEqual(len(metrics), 0)
         self.assertTrue(mock_get.called)
 
+    @patch.object(HTTPTransport, 'get')
+    def test_list_devices(self, mock_get):
+        """Test device listing passes filters and returns the page."""
+        page = {
+            'devices': [{'device_id': 7, 'name': 'web-01', 'device_type': 'server'}],
+            'next_cursor': 'web-01'
+        }
+        mock_get.return_value = MagicMock(status_code=200, json=lambda: page)
+        
+        result = self.client.list_devices(prefix='web', limit=1)
+        
+        self.assertEqual(result, page)
+        self.assertEqual(mock_get.call_args.kwargs['params'], {'limit': 1, 'prefix': 'web'})
+        
+    @patch.object(HTTPTransport, 'get')
+    def test_get_stale_devices(self, mock_get):
+        """Test stale device query."""
+        stale = [{'device_id': 3, 'last_seen': '2024-01-01T00:00:00', 'seconds_since_seen': 600.0}]
+        mock_get.return_value = MagicMock(status_code=200, json=lambda: {'devices': stale})
+        
+        result = self.client.get_stale_devices(older_than='5m')
+        
+        self.assertEqual(result, stale)
+        self.assertEqual(mock_get.call_args.kwargs['params']['older_than'], '5m')
+        
+    @patch.object(HTTPTransport, 'post')
+    def test_register_devices(self, mock_post):
+        """Test bulk device registration returns the id mapping."""
+        mock_post.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {'devices': {'host-a': 1, 'host-b': 2}}
+        )
+        
+        mapping = self.client.register_devices([
+            {'name': 'host-a', 'device_type': 'workstation'},
+            {'name': 'host-b', 'device_type': 'server'}
+        ])
+        
+        self.assertEqual(mapping, {'host-a': 1, 'host-b': 2})
+        self.assertTrue(mock_post.call_args.args[0].endswith('/v1/devices/batch'))
+        
+    @patch.object(HTTPTransport, 'get')
+    def test_get_market_prices(self, mock_get):
+        """Test many symbols come back column-wise from one request."""
+        mock_get.return_value = MagicMock(status_code=200, json=lambda: {
+            'step': 60,
+            'timestamps': ['2024-01-01T00:00:00', '2024-01-01T00:01:00'],
+            'prices': {'bitcoin': [50000.0, None], 'solana': [100.0, 101.0]}
+        })
+        
+        prices = self.client.get_market_prices(symbols=['bitcoin', 'solana'])
+        
+        self.assertIsInstance(prices, MarketPrices)
+        self.assertEqual(prices.timestamps[1], datetime(2024, 1, 1, 0, 1))
+        self.assertEqual(prices.prices['solana'], [100.0, 101.0])
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(mock_get.call_args.kwargs['params']['symbols'], 'bitcoin,solana')
+        
+    @patch.object(HTTPTransport, 'get')
+    def test_export_metrics(self, mock_get):
+        """Test streaming a columnar export to disk."""
+        mock_response = MagicMock()
+        mock_response.iter_content.return_value = [b'PAR1', b'data', b'PAR1']
+        mock_get.return_value.__enter__.return_value = mock_response
+        
+        output_path = Path(self.temp_dir) / 'export.parquet'
+        success = self.client.export_metrics(str(output_path), fmt='parquet')
+        
+        self.assertTrue(success)
+        self.assertEqual(output_path.read_bytes(), b'PAR1dataPAR1')
+        self.assertEqual(mock_get.call_args.kwargs['params']['format'], 'parquet')
+
+    @patch.object(HTTPTransport, 'get')
+    def test_poll_commands(self, mock_get):
+        """Test long-polling returns delivered commands."""
+        command = {'command_id': 5, 'command_type': 'restart_app', 'status': 'delivered'}
+        mock_get.return_value = MagicMock(status_code=200, json=lambda: {'commands': [command]})
+        
+        commands = self.client.poll_commands(timeout=5)
+        
+        self.assertEqual(commands, [command])
+        self.assertTrue(mock_get.call_args.args[0].endswith('/v1/devices/1/commands/poll'))
+        # Client-side timeout must outlast the server-side hold
+        self.assertGreater(mock_get.call_args.kwargs['timeout'], 5)
+        
+    @patch.object(HTTPTransport, 'get')
+    def test_poll_commands_error(self, mock_get):
+        """Test polling error handling."""
+        mock_get.side_effect = requests.RequestException("Connection failed")
+        
+        self.assertEqual(self.client.poll_commands(timeout=1), [])
+
+    @patch.object(HTTPTransport, 'post')
+    def test_fan_out_command(self, mock_post):
+        """Test fan-out sends the selector and returns the batch."""
+        batch = {'batch_id': 3, 'target_count': 2000, 'counts': {'queued': 2000}}
+        mock_post.return_value = MagicMock(status_code=201, json=lambda: batch)
+        
+        result = self.client.fan_out_command('restart_app', {'app_name': 'nginx'}, tags=['web'])
+        
+        self.assertEqual(result, batch)
+        self.assertEqual(mock_post.call_args.kwargs['json']['selector'], {'tags': ['web']})
+
+    def test_deadband_filter(self):
+        """Test values within the band are suppressed until the heartbeat."""
+        now = [0.0]
+        deadband_filter = DeadbandFilter(
+            {'ram_usage_percent': Deadband(absolute=1.0), 'bitcoin_price_usd': Deadband(percent=1.0)},
+            max_silence=60,
+            clock=lambda: now[0]
+        )
+        
+        self.assertEqual(deadband_filter.filter({'ram_usage_percent': 50.0}), {'ram_usage_percent': 50.0})
+        self.assertEqual(deadband_filter.filter({'ram_usage_percent': 50.8}), {})
+        self.assertEqual(deadband_filter.filter({'ram_usage_percent': 51.5}), {'ram_usage_percent': 51.5})
+        
+        deadband_filter.filter({'bitcoin_price_usd': 50000.0})
+        self.assertEqual(deadband_filter.filter({'bitcoin_price_usd': 50400.0}), {})
+        self.assertEqual(deadband_filter.filter({'bitcoin_price_usd': 50600.0}), {'bitcoin_price_usd': 50600.0})
+        
+        # Heartbeat after max_silence even without change
+        now[0] = 61.0
+        self.assertEqual(deadband_filter.filter({'ram_usage_percent': 51.5}), {'ram_usage_percent': 51.5})
+        
+    def test_parse_deadbands(self):
+        deadbands = parse_deadbands('ram_usage_percent=1, bitcoin_price_usd=0.5%')
+        self.assertEqual(deadbands['ram_usage_percent'], Deadband(absolute=1.0))
+        self.assertEqual(deadbands['bitcoin_price_usd'], Deadband(percent=0.5))
+        
+    @patch.object(HTTPTransport, 'post')
+    def test_post_metrics_deadband_suppression(self, mock_post):
+        """Test unchanged metrics are not uploaded."""
+        mock_post.return_value = MagicMock(status_code=201)
+        client = MetricsClient(
+            base_url='http://localhost:5000',
+            device_id=1,
+            offline_storage_path=self.temp_dir,
+            deadbands={'ram_usage_percent': Deadband(absolute=1.0), 'thread_count': Deadband(absolute=0)}
+        )
+        
+        client.post_metrics(system_metrics=SystemMetrics(thread_count=10, ram_usage_percent=50.0))
+        client.post_metrics(system_metrics=SystemMetrics(thread_count=10, ram_usage_percent=50.5))
+        self.assertEqual(mock_post.call_count, 1)
+        
+        client.post_metrics(system_metrics=SystemMetrics(thread_count=12, ram_usage_percent=50.5))
+        self.assertEqual(mock_post.call_count, 2)
+        sent = mock_post.call_args.kwargs['json']['system_metrics']
+        self.assertEqual(sent, {'thread_count': 12, 'ram_usage_percent': None})
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    def test_clients_share_pooled_session(self):
+        """Clients of one API reuse the same keep-alive pool."""
+        first = MetricsClient('http://pool-test:5000', 1, offline_storage_path=self.temp_dir)
+        second = MetricsClient('http://pool-test:5000/', 2, offline_storage_path=self.temp_dir)
+        self.assertIs(first.transport.session, second.transport.session)
+
+    @patch('requests.Session.request')
+    def test_requests_have_timeouts(self, mock_request):
+        mock_request.return_value = MagicMock(status_code=200, json=lambda: {'commands': []})
+        client = MetricsClient('http://timeout-test:5000', 1, offline_storage_path=self.temp_dir,
+                               connect_timeout=2.0, read_timeout=5.0)
+        
+        client.get_stale_devices()
+        self.assertEqual(mock_request.call_args.kwargs['timeout'], (2.0, 5.0))
+        
+        # Long polls extend the read timeout past the server's hold time
+        client.poll_commands(timeout=30)
+        self.assertEqual(mock_request.call_args.kwargs['timeout'], (2.0, 40))
+
+    def test_flask_test_transport(self):
+        """The client can run against an in-process Flask app."""
+        app = Flask(__name__)
+        received = []
+
+        @app.route('/v1/metrics', methods=['POST'])
+        def upload():
+            received.append(request.get_json())
+            return jsonify({'snapshot_id': len(received)}), 201
+
+        @app.route('/v1/devices/stale', methods=['GET'])
+        def stale():
+            return jsonify({'devices': [{'device_id': 1, 'older_than': request.args['older_than']}]})
+
+        client = MetricsClient('http://unused', 1, offline_storage_path=self.temp_dir,
+                               transport=FlaskTestTransport(app))
+        
+        self.assertTrue(client.post_metrics(system_metrics=SystemMetrics(thread_count=4, ram_usage_percent=10.0)))
+        self.assertEqual(received[0]['system_metrics']['thread_count'], 4)
+        self.assertEqual(client.get_stale_devices(older_than='1h'), [{'device_id': 1, 'older_than': '1h'}])
+        self.assertEqual(client.offline_store.read(1)[0], [])
+        self.assertEqual(client.get_command_batch(99)['status'], 'failed')  # 404 surfaces as an error
+
+class TestBackgroundUploader(unittest.TestCase):
+    def snapshot(self, i):
+        return MetricsSnapshot(device_id=1, timestamp=datetime(2024, 1, 1, 0, 0, i % 60),
+                               system_metrics=SystemMetrics(thread_count=i, ram_usage_percent=1.0))
+
+    def uploader(self, send, **kwargs):
+        self.spilled = []
+        uploader = BackgroundUploader(send, self.spilled.append, retry_delay=0.01, **kwargs)
+        self.addCleanup(uploader.close, 1.0)
+        return uploader
+
+    def test_snapshots_are_sent_in_batches(self):
+        batches = []
+        uploader = self.uploader(lambda batch: batches.append(batch) or True, batch_size=100, flush_interval=10)
+        for i in range(250):
+            uploader.submit(self.snapshot(i))
+        self.assertTrue(uploader.flush(5))
+        self.assertEqual([len(b) for b in batches], [100, 100, 50])
+        self.assertEqual([s.system_metrics.thread_count for b in batches for s in b], list(range(250)))
+
+    def test_partial_batch_is_sent_after_flush_interval(self):
+        sent = threading.Event()
+        uploader = self.uploader(lambda batch: sent.set() or True, batch_size=100, flush_interval=0.05)
+        uploader.submit(self.snapshot(0))
+        self.assertTrue(sent.wait(2))
+
+    def test_failed_batches_are_retried_then_spilled(self):
+        attempts = []
+
+        def send(batch):
+            attempts.append(len(batch))
+            if len(attempts) < 3:
+                raise requests.ConnectionError('API down')
+            return True
+
+        uploader = self.uploader(send, max_retries=3)
+        uploader.submit(self.snapshot(0))
+        uploader.flush(5)
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(uploader.sent, 1)
+
+        def always_down(batch):
+            raise requests.ConnectionError('API down')
+
+        send_fails = self.uploader(always_down, max_retries=2)
+        send_fails.submit(self.snapshot(1))
+        send_fails.flush(5)
+        self.assertEqual(len(self.spilled), 1)
+
+    def test_backpressure_policies(self):
+        release = threading.Event()
+
+        def stalled(batch):
+            release.wait(5)
+            return True
+
+        # The worker holds one batch in flight; the queue itself holds max_queue more
+        drop = self.uploader(stalled, max_queue=3, batch_size=1, policy='drop_oldest')
+        for i in range(10):
+            drop.submit(self.snapshot(i))
+            time.sleep(0.01)
+        self.assertEqual(drop.dropped, 6)
+        self.assertEqual([s.system_metrics.thread_count for s in drop._queue], [7, 8, 9])
+
+        spill = self.uploader(stalled, max_queue=3, batch_size=1, policy='spill')
+        for i in range(10):
+            spill.submit(self.snapshot(i))
+            time.sleep(0.01)
+        self.assertEqual(len(self.spilled), 6)
+
+        block = self.uploader(stalled, max_queue=1, batch_size=1, policy='block', block_timeout=0.1)
+        block.submit(self.snapshot(0))
+        time.sleep(0.05)
+        block.submit(self.snapshot(1))
+        started = time.monotonic()
+        self.assertFalse(block.submit(self.snapshot(2)))  # waits block_timeout, then spills
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        release.set()
+
+    def test_client_background_mode_does_not_block(self):
+        """post_metrics returns immediately while the API is failing; close() spills to disk."""
+        app = Flask(__name__)
+
+        @app.route('/v1/metrics/batch', methods=['POST'])
+        def upload_batch():
+            return jsonify({'error': 'unavailable'}), 503
+
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        client = MetricsClient('http://unavailable', 1, offline_storage_path=temp_dir, retry_delay=0.5,
+                               transport=FlaskTestTransport(app), background_upload=True)
+        started = time.monotonic()
+        for i in range(5):
+            client.post_metrics(system_metrics=SystemMetrics(thread_count=i, ram_usage_percent=1.0))
+        self.assertLess(time.monotonic() - started, 0.1)
+        client.close(timeout=0.2)
+        self.assertEqual(len(client.offline_store.read(10)[0]), 5)
+
+class TestOfflineStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    def store(self, **kwargs):
+        store = OfflineStore(self.temp_dir, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def segments(self):
+        return sorted(Path(self.temp_dir).glob('segment_*.log'))
+
+    def test_replay_in_order_and_consumed_segments_are_deleted(self):
+        store = self.store(segment_bytes=200)
+        for i in range(20):
+            store.append({'i': i})
+        self.assertGreater(len(self.segments()), 1)
+
+        replayed = []
+        while True:
+            records, position = store.read(6)
+            if not records:
+                break
+            replayed.extend(r['i'] for r in records)
+            store.commit(position)
+        self.assertEqual(replayed, list(range(20)))
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(store.pending_bytes(), 0)
+
+        # Uncommitted reads are replayed again after a restart
+        store.append({'i': 20})
+        store.append({'i': 21})
+        store.read(1)
+        store.close()
+        self.assertEqual([r['i'] for r in self.store().read(10)[0]], [20, 21])
+
+    def test_torn_and_corrupt_records(self):
+        store = self.store(segment_bytes=20)
+        for i in range(4):
+            store.append({'i': i})
+        store.close()
+        first, last = self.segments()[0], self.segments()[-1]
+        with open(last, 'ab') as f:
+            f.write(b'\x20\x00\x00')  # crash mid-append
+        self.assertEqual([r['i'] for r in self.store().read(10)[0]], [0, 1, 2, 3])
+
+        # Flip a byte in the first segment's second record
+        data = bytearray(first.read_bytes())
+        data[-2] ^= 0xFF
+        first.write_bytes(bytes(data))
+        store = self.store()
+        self.assertEqual([r['i'] for r in store.read(10)[0]], [0, 2, 3])
+        self.assertEqual(store.corrupt, 1)
+
+    def test_legacy_files_are_migrated(self):
+        for i in range(3):
+            with open(Path(self.temp_dir) / f"metrics_20240101_00000{i}_000000.json", 'w') as f:
+                json.dump({'i': i}, f)
+        store = self.store()
+        self.assertEqual([r['i'] for r in store.read(10)[0]], [0, 1, 2])
+        self.assertEqual(list(Path(self.temp_dir).glob('metrics_*.json')), [])
+
+    def snapshot_record(self, i, ram=None):
+        return MetricsSnapshot(device_id=1, timestamp=datetime(2024, 1, 1, i // 60, i % 60),
+                               system_metrics=SystemMetrics(thread_count=i, ram_usage_percent=ram if ram is not None else i)).to_dict()
+
+    def test_drop_oldest_bounds_the_log(self):
+        store = self.store(max_bytes=4000)
+        for i in range(300):
+            store.append(self.snapshot_record(i))
+        kept = [r['system_metrics']['thread_count'] for r in store.read(1000)[0]]
+        # Limits apply to full segments; the one being written adds at most max_bytes / 4
+        self.assertLessEqual(store.pending_bytes(), 5000)
+        self.assertEqual(kept, list(range(300 - len(kept), 300)))
+        self.assertEqual(store.stats()['evicted'], 300 - len(kept))
+
+    def test_drop_oldest_skips_segments_being_replayed(self):
+        store = self.store(max_bytes=10000)
+        for i in range(100):
+            store.append(self.snapshot_record(i))
+        batch, position = store.read(10)
+
+        for i in range(100, 400):
+            store.append(self.snapshot_record(i))
+        store.commit(position)
+        rest = store.read(1000)[0]
+        # The batch in flight was neither evicted nor read again
+        self.assertGreater(rest[0]['system_metrics']['thread_count'], 9)
+        self.assertEqual(len(batch) + len(rest) + store.stats()['evicted'], 400)
+
+    def test_small_max_bytes_keeps_a_minimum_segment_size(self):
+        self.assertEqual(self.store(max_bytes=10).segment_bytes, MIN_SEGMENT_BYTES)
+        self.assertEqual(self.store(max_bytes=10, segment_bytes=100).segment_bytes, 100)
+
+    def test_downsample_merges_old_snapshots(self):
+        store = self.store(max_bytes=8000, policy='downsample', downsample_window=300)
+        for i in range(600):  # one snapshot a minute
+            store.append(self.snapshot_record(i))
+        records = store.read(10000)[0]
+        stats = store.stats()
+        self.assertGreater(stats['downsampled'], 0)
+        self.assertLessEqual(stats['pending_bytes'], 10000)
+
+        # Every appended snapshot is kept, folded into another or evicted
+        self.assertEqual(len(records) + stats['downsampled'] + stats['evicted'], 600)
+        timestamps = [r['timestamp'] for r in records]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(records[-1], self.snapshot_record(599))
+        merged = next(r for r in records if 'summaries' in r)
+        summary = merged['summaries']['ram_usage_percent']
+        self.assertEqual(summary['max'], merged['system_metrics']['ram_usage_percent'])
+        self.assertEqual(summary['mean'], (summary['min'] + summary['max']) / 2)
+
+    def test_max_age_evicts_old_segments(self):
+        store = self.store()
+        for i in range(5):
+            store.append(self.snapshot_record(i))
+        store.close()
+        for segment in self.segments():
+            os.utime(segment, (time.time() - 7200, time.time() - 7200))
+        store = self.store(max_age=3600)
+        self.assertEqual(store.read(10)[0], [])
+        self.assertEqual(store.stats()['evicted'], 5)
+
+    def test_downsample_keeps_summary_statistics_exact(self):
+        first = self.snapshot_record(0, ram=10.0)
+        first['summaries'] = {'ram_usage_percent': {'count': 3, 'min': 5.0, 'max': 10.0, 'mean': 8.0,
+                                                    'last': 10.0, 'p95': 10.0}}
+        second = self.snapshot_record(1, ram=20.0)
+        merged, = downsample([first, second], 300)
+        self.assertEqual(merged['summaries']['ram_usage_percent'],
+                         {'count': 4, 'min': 5.0, 'max': 20.0, 'mean': 11.0, 'last': 20.0, 'p95': 20.0})
+        self.assertEqual(merged['summaries']['thread_count']['count'], 2)
+        self.assertEqual(merged['timestamp'], second['timestamp'])
+        self.assertEqual(merged['interval_seconds'], 300)
+
+    def stored_snapshots(self, count):
+        store = self.store()
+        for i in range(count):
+            store.append(MetricsSnapshot(device_id=1, timestamp=datetime(2024, 1, 1),
+                                         system_metrics=SystemMetrics(thread_count=i, ram_usage_percent=1.0)).to_dict())
+        store.close()
+
+    def test_client_replays_stored_metrics_in_background(self):
+        app = Flask(__name__)
+        batches = []
+        entered, release = threading.Event(), threading.Event()
+
+        @app.route('/v1/metrics/batch', methods=['POST'])
+        def upload_batch():
+            entered.set()
+            release.wait(5)
+            batches.append([s['system_metrics']['thread_count'] for s in request.get_json()['snapshots']])
+            return jsonify({'snapshot_ids': []}), 201
+
+        self.stored_snapshots(250)
+        started = time.monotonic()
+        client = MetricsClient('http://unused', 1, offline_storage_path=self.temp_dir,
+                               transport=FlaskTestTransport(app), batch_size=100)
+        self.assertLess(time.monotonic() - started, 0.5)  # does not wait for the replay
+
+        # Further clients of the same directory share the replayer
+        again = MetricsClient('http://unused', 2, offline_storage_path=self.temp_dir,
+                              transport=FlaskTestTransport(app))
+        self.assertIs(again.replayer, client.replayer)
+
+        self.assertTrue(entered.wait(5))
+        status = client.replay_status()
+        self.assertEqual(status['state'], 'replaying')
+        self.assertGreater(status['pending_bytes'], 0)
+        self.assertGreater(status['lag_seconds'], 0)
+
+        release.set()
+        self.assertTrue(client.replayer.wait_idle(5))
+        self.assertEqual([len(b) for b in batches], [100, 100, 50])
+        self.assertEqual([i for b in batches for i in b], list(range(250)))
+        status = client.replay_status()
+        self.assertEqual((status['replayed'], status['pending_bytes'], status['lag_seconds']), (250, 0, None))
+
+    def test_replay_is_rate_limited_and_waits_out_failures(self):
+        app = Flask(__name__)
+        up = threading.Event()
+
+        @app.route('/v1/metrics/batch', methods=['POST'])
+        def upload_batch():
+            if not up.is_set():
+                return jsonify({'error': 'unavailable'}), 503
+            return jsonify({'snapshot_ids': []}), 201
+
+        self.stored_snapshots(40)
+        client = MetricsClient('http://recovering', 1, offline_storage_path=self.temp_dir,
+                               transport=FlaskTestTransport(app), batch_size=10,
+                               replay_rate=100, replay_retry_interval=60, failure_threshold=100)
+        self.assertFalse(client.replayer.wait_idle(5))
+        self.assertEqual(client.replay_status()['state'], 'waiting')
+        self.assertIsNotNone(client.replay_status()['last_error'])
+
+        up.set()
+        started = time.monotonic()
+        self.assertTrue(client.replayer.wait_idle(5))
+        # 40 snapshots at 100/s
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual(client.replay_status()['replayed'], 40)
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_open_half_open_closed(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, max_reset_timeout=25, clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        self.assertTrue(5 <= breaker.retry_in() <= 10)  # jittered
+
+        now[0] = 10
+        self.assertTrue(breaker.allow())   # the single half-open trial
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertTrue(10 <= breaker.retry_in() <= 20)  # doubled
+
+        now[0] = 30
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertTrue(12.5 <= breaker.retry_in() <= 25)  # capped
+
+        now[0] = 60
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+        # Retry-After opens at once and sets the minimum wait
+        breaker.record_failure(retry_after=120)
+        self.assertEqual(breaker.retry_in(), 120)
+
+    def test_backoff_delay(self):
+        delays = [backoff_delay(1.0, attempt, cap=10) for attempt in range(6)]
+        for attempt, delay in enumerate(delays):
+            ceiling = min(10, 2 ** attempt)
+            self.assertTrue(ceiling / 2 <= delay <= ceiling)
+
+    def test_open_circuit_sends_writes_offline(self):
+        app = Flask(__name__)
+        calls = []
+
+        @app.route('/v1/metrics', methods=['POST'])
+        def upload():
+            calls.append(1)
+            return jsonify({'error': 'overloaded'}), 503, {'Retry-After': '120'}
+
+        @app.route('/v1/metrics/batch', methods=['POST'])
+        def upload_batch():
+            calls.append(1)
+            return jsonify({'snapshot_ids': []}), 201
+
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        client = MetricsClient('http://overloaded', 1, offline_storage_path=temp_dir, retry_delay=0.01,
+                               transport=FlaskTestTransport(app))
+        for i in range(5):
+            self.assertTrue(client.post_metrics(system_metrics=SystemMetrics(thread_count=i, ram_usage_percent=1.0)))
+        self.assertEqual(len(calls), 1)  # no retries, no further requests
+        self.assertEqual(client.breaker.state, 'open')
+        self.assertEqual(len(client.offline_store.read(10)[0]), 5)
+        self.assertFalse(client.replayer.wait_idle(5))
+        self.assertEqual(len(calls), 1)
+
+class StubAPI:
+    """Just enough of the metrics API on a local port for the async client."""
+    def __init__(self):
+        self.snapshots = []
+        self.batches = 0
+        self.commands = []
+        self.active = 0
+        self.max_active = 0
+        self.delay = 0.0
+        # (body, status) returned for uploads instead of storing them
+        self.reject = None
+        self._lock = threading.Lock()
+        app = Flask(__name__)
+
+        def track(handler):
+            def wrapper(*args, **kwargs):
+                with self._lock:
+                    self.active += 1
+                    self.max_active = max(self.max_active, self.active)
+                try:
+                    time.sleep(self.delay)
+                    return handler(*args, **kwargs)
+                finally:
+                    with self._lock:
+                        self.active -= 1
+            wrapper.__name__ = handler.__name__
+            return wrapper
+
+        @app.route('/v1/metrics', methods=['POST'])
+        @track
+        def upload():
+            if self.reject is not None:
+                return self.reject
+            self.snapshots.append(request.get_json())
+            return jsonify({'snapshot_id': len(self.snapshots)}), 201
+
+        @app.route('/v1/metrics/batch', methods=['POST'])
+        @track
+        def upload_batch():
+            self.batches += 1
+            self.snapshots.extend(request.get_json()['snapshots'])
+            return jsonify({'message': 'ok'}), 201
+
+        @app.route('/v1/metrics', methods=['GET'])
+        def get_metrics():
+            return jsonify([{
+                'device_id': 1,
+                'timestamp': '2024-01-01T00:00:00',
+                'system_metrics': {'thread_count': 10, 'ram_usage_percent': 75.5},
+                'limit': int(request.args['limit'])
+            }][:int(request.args['limit'])])
+
+        @app.route('/v1/devices/<int:device_id>/commands', methods=['POST'])
+        def send_command(device_id):
+            self.commands.append((device_id, request.get_json()))
+            return jsonify({'command_id': len(self.commands), 'status': 'pending'}), 201
+
+        @app.route('/v1/empty', methods=['DELETE'])
+        def empty():
+            return '', 204
+
+        @app.route('/v1/moved', methods=['GET'])
+        def moved():
+            return '', 301, {'Location': '/v1/metrics?limit=1'}
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+class TestAsyncMetricsClient(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.api = StubAPI()
+        self.addCleanup(self.api.close)
+
+    async def test_same_surface_as_sync_client(self):
+        async with AsyncMetricsClient(self.api.url, device_id=7) as client:
+            self.assertTrue(await client.post_metrics(
+                system_metrics=SystemMetrics(thread_count=10, ram_usage_percent=75.5),
+                crypto_metrics=CryptoMetrics(bitcoin_price_usd=50000.0, ethereum_price_usd=3000.0)
+            ))
+            metrics = await client.get_metrics(limit=1)
+            result = await client.restart_app('nginx', force=True)
+
+        self.assertEqual(self.api.snapshots[0]['device_id'], 7)
+        self.assertEqual(self.api.snapshots[0]['crypto_metrics']['bitcoin_price_usd'], 50000.0)
+        self.assertEqual(metrics[0].system_metrics.thread_count, 10)
+        self.assertEqual(result['status'], 'pending')
+        self.assertEqual(self.api.commands, [(7, {'command_type': 'restart_app', 'params': {'app_name': 'nginx', 'force': True}})])
+
+    async def test_concurrent_uploads_respect_connection_limit(self):
+        """Hundreds of devices upload concurrently over a bounded pool."""
+        self.api.delay = 0.02
+        transport = AsyncHTTPTransport(self.api.url, max_connections=4)
+        clients = [AsyncMetricsClient(self.api.url, device_id=i, transport=transport) for i in range(100)]
+        results = await asyncio.gather(*(
+            client.post_metrics(system_metrics=SystemMetrics(thread_count=i, ram_usage_percent=1.0))
+            for i, client in enumerate(clients)
+        ))
+        await transport.aclose()
+        self.assertTrue(all(results))
+        self.assertEqual(sorted(s['device_id'] for s in self.api.snapshots), list(range(100)))
+        self.assertLessEqual(self.api.max_active, 4)
+
+    async def test_batched_uploads(self):
+        snapshots = [
+            MetricsSnapshot(device_id=i % 10, timestamp=datetime(2024, 1, 1, 0, i // 60, i % 60),
+                            system_metrics=SystemMetrics(thread_count=i, ram_usage_percent=1.0))
+            for i in range(250)
+        ]
+        async with AsyncMetricsClient(self.api.url, device_id=1) as client:
+            stored = await client.upload_snapshots(snapshots, batch_size=100)
+        self.assertEqual(stored, 250)
+        self.assertEqual(self.api.batches, 3)
+        # Batches arrive in any order; client timestamps are kept
+        self.assertIn('2024-01-01T00:00:00', [s['timestamp'] for s in self.api.snapshots])
+
+    async def test_unreachable_api(self):
+        self.api.close()
+        client = AsyncMetricsClient(self.api.url, device_id=1, max_retries=2, retry_delay=0.01)
+        self.assertFalse(await client.post_metrics(system_metrics=SystemMetrics(thread_count=1, ram_usage_percent=1.0)))
+        self.assertEqual(await client.get_metrics(), [])
+        self.assertEqual((await client.send_command('reboot'))['status'], 'failed')
+        await client.aclose()
+
+    async def test_non_json_rejection_is_logged(self):
+        """A proxy's HTML error page (or an empty 413) is a rejected upload, not an exception"""
+        async with AsyncMetricsClient(self.api.url, device_id=1, max_retries=1) as client:
+            for body in ('<html><body>413 Request Entity Too Large</body></html>', ''):
+                self.api.reject = (body, 413)
+                with self.assertLogs('MetricsSDK', 'ERROR') as logs:
+                    self.assertFalse(await client.post_metrics(
+                        system_metrics=SystemMetrics(thread_count=1, ram_usage_percent=1.0)))
+                self.assertIn(body[:20] or 'HTTP 413', logs.output[-1])
+        self.assertEqual(self.api.snapshots, [])
+
+    async def test_transport_empty_response_and_redirect(self):
+        transport = AsyncHTTPTransport(self.api.url, read_timeout=2)
+        # No body and no Content-Length must not wait for the read timeout
+        started = time.monotonic()
+        response = await transport.request('DELETE', '/v1/empty')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response.content, b'')
+        self.assertLess(time.monotonic() - started, 1)
+
+        response = await transport.get('/v1/moved')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['device_id'], 1)
+        await transport.aclose()
+
+    async def test_transport_does_not_resend_post_after_drop(self):
+        """A connection dropped after the request was sent is not retried"""
+        received = []
+
+        async def handle(reader, writer):
+            received.append(await reader.readuntil(b'\r\n\r\n'))
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        transport = AsyncHTTPTransport(f'http://127.0.0.1:{port}')
+        with self.assertRaises(requests.ConnectionError):
+            await transport.post('/v1/metrics', json={'device_id': 1})
+        await transport.aclose()
+        server.close()
+        await server.wait_closed()
+        self.assertEqual(len(received), 1)
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
@@ -0,0 +1,108 @@
+import json
+import threading
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Seconds to wait for a TCP connection and for each read from the server
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 30.0
+# Keep-alive connections held open per API host
+DEFAULT_POOL_SIZE = 10
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def shared_session(base_url: str, pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """
+    Process-wide session for an API base URL.
+
+    Every client talking to the same API reuses its pooled keep-alive
+    connections, so only the first call pays for the TCP (and TLS)
+    handshake. The pool size is fixed by the first caller.
+    """
+    with _sessions_lock:
+        session = _sessions.get(base_url)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[base_url] = session
+        return session
+
+
+class Transport:
+    """Sends the client's HTTP requests; paths are relative to the API base URL."""
+
+    def request(self, method: str, path: str, **kwargs):
+        raise NotImplementedError
+
+    def get(self, path: str, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+
+class HTTPTransport(Transport):
+    """Requests over a shared, pooled keep-alive session with connect and read timeouts."""
+
+    def __init__(self, base_url: str,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 pool_size: int = DEFAULT_POOL_SIZE):
+        self.base_url = base_url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = shared_session(self.base_url, pool_size)
+
+    def request(self, method: str, path: str, timeout: Optional[float] = None, **kwargs):
+        """timeout overrides the read timeout for one call (e.g. a long poll)"""
+        return self.session.request(
+            method,
+            f"{self.base_url}{path}",
+            timeout=(self.connect_timeout, timeout if timeout is not None else self.read_timeout),
+            **kwargs
+        )
+
+
+class _TestResponse:
+    """The parts of requests.Response the client uses, over a Flask test response."""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.get_data()
+        self.text = response.get_data(as_text=True)
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self._response.request.path}", response=self)
+
+    def iter_content(self, chunk_size: int = 1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._response.close()
+
+
+class FlaskTestTransport(Transport):
+    """Calls a Flask app in-process through its test client, for tests."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method: str, path: str, params: Optional[dict] = None,
+                timeout: Optional[float] = None, stream: bool = False, **kwargs):
+        return _TestResponse(self.client.open(path, method=method, query_string=params, **kwargs))
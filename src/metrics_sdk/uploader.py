@@ -0,0 +1,219 @@
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, List, Optional
+
+from .models import MetricsSnapshot
+from .breaker import CircuitOpenError, backoff_delay
+
+
+class BackgroundUploader:
+    """
+    Uploads snapshots from a background thread in batches.
+
+    submit() only appends to a bounded in-memory queue; a worker thread
+    sends up to batch_size queued snapshots per request, at least every
+    flush_interval seconds, retrying transient failures with backoff.
+    Batches that still fail, or that meet an open circuit, are handed to
+    spill (the client's offline store) so nothing is lost; batches the API
+    rejects outright are dropped.
+
+    When the queue is full the backpressure policy decides:
+      - 'block': submit() waits for room (up to block_timeout, then spills)
+      - 'drop_oldest': the oldest queued snapshot is discarded
+      - 'spill': the new snapshot goes straight to spill
+    """
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    SPILL = 'spill'
+    POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+    def __init__(self,
+                 send_batch: Callable[[List[MetricsSnapshot]], bool],
+                 spill: Callable[[MetricsSnapshot], None],
+                 max_queue: int = 1000,
+                 batch_size: int = 100,
+                 flush_interval: float = 1.0,
+                 policy: str = DROP_OLDEST,
+                 block_timeout: Optional[float] = None,
+                 max_retries: int = 3,
+                 retry_delay: float = 1.0):
+        """
+        Args:
+            send_batch: Uploads a batch; returns True when stored, False when
+                rejected for good, and raises on transient failures
+            spill: Stores one snapshot for later upload
+            max_queue: Snapshots held in memory before backpressure applies
+            batch_size: Most snapshots sent in one request
+            flush_interval: Longest a queued snapshot waits for a fuller batch
+            policy: 'block', 'drop_oldest' or 'spill' (see class docstring)
+            block_timeout: Seconds a blocked submit() waits before spilling
+                (None waits indefinitely)
+            max_retries: Attempts per batch before it is spilled
+            retry_delay: Delay before the first retry (doubles per attempt, jittered)
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {policy}. Use one of: {', '.join(self.POLICIES)}")
+        self._send_batch = send_batch
+        self._spill = spill
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._flush_requested = False
+        self._closed = False
+        self._stop = threading.Event()
+
+        self.sent = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.spilled = 0
+
+        self.logger = logging.getLogger('MetricsSDK')
+        self._thread = threading.Thread(target=self._run, name='metrics-uploader', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, snapshot: MetricsSnapshot) -> bool:
+        """Queue a snapshot for upload; False if it was not queued (spilled or uploader closed)"""
+        with self._changed:
+            if self._closed:
+                return False
+            if len(self._queue) >= self.max_queue:
+                if self.policy == self.DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                elif self.policy == self.BLOCK:
+                    deadline = None if self.block_timeout is None else time.monotonic() + self.block_timeout
+                    while len(self._queue) >= self.max_queue and not self._closed:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            break
+                        self._changed.wait(remaining)
+            if len(self._queue) < self.max_queue and not self._closed:
+                self._queue.append(snapshot)
+                # Wake the worker to start the flush_interval clock, or to send a full batch
+                if len(self._queue) == 1 or len(self._queue) >= self.batch_size:
+                    self._changed.notify_all()
+                return True
+        self._spill_one(snapshot)
+        return False
+
+    def pending(self) -> int:
+        """Snapshots queued or being uploaded"""
+        with self._lock:
+            return len(self._queue) + self._in_flight
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Send everything queued now; True once the queue has drained"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            self._flush_requested = True
+            self._changed.notify_all()
+            while self._queue or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+            return True
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Flush, stop the worker, and spill whatever could not be sent in time"""
+        with self._changed:
+            if self._closed:
+                return
+        self.flush(timeout)
+        with self._changed:
+            self._closed = True
+            self._stop.set()
+            self._changed.notify_all()
+        self._thread.join(timeout)
+        atexit.unregister(self.close)
+        with self._lock:
+            leftover, self._queue = list(self._queue), deque()
+        for snapshot in leftover:
+            self._spill_one(snapshot)
+
+    def stats(self) -> dict:
+        return {
+            'pending': self.pending(),
+            'sent': self.sent,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'spilled': self.spilled
+        }
+
+    def _next_batch(self) -> Optional[List[MetricsSnapshot]]:
+        """Wait until a batch is due; None once closed and drained"""
+        with self._changed:
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if self._stop.is_set():
+                    return None
+                if self._queue and (len(self._queue) >= self.batch_size or self._flush_requested
+                                    or self._closed or time.monotonic() >= deadline):
+                    break
+                if not self._queue:
+                    if self._closed:
+                        return None
+                    self._flush_requested = False
+                    self._changed.wait()
+                    deadline = time.monotonic() + self.flush_interval
+                else:
+                    self._changed.wait(max(deadline - time.monotonic(), 0))
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            self._in_flight = len(batch)
+            # Room was freed for blocked submitters
+            self._changed.notify_all()
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._upload(batch)
+            finally:
+                with self._changed:
+                    self._in_flight = 0
+                    self._changed.notify_all()
+
+    def _upload(self, batch: List[MetricsSnapshot]) -> None:
+        for attempt in range(self.max_retries):
+            try:
+                if self._send_batch(batch):
+                    self.sent += len(batch)
+                else:
+                    self.rejected += len(batch)
+                return
+            except CircuitOpenError:
+                break
+            except Exception as e:
+                self.logger.warning(f"Batch upload attempt {attempt + 1} failed: {str(e)}")
+            if attempt < self.max_retries - 1 and self._stop.wait(backoff_delay(self.retry_delay, attempt)):
+                break
+        for snapshot in batch:
+            self._spill_one(snapshot)
+
+    def _spill_one(self, snapshot: MetricsSnapshot) -> None:
+        try:
+            self._spill(snapshot)
+        except Exception as e:
+            self.logger.error(f"Could not spill snapshot: {str(e)}")
+            with self._lock:
+                self.dropped += 1
+            return
+        with self._lock:
+            self.spilled += 1
@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, Float, String, DateTime, ForeignKey
+from sqlalchemy import create_engine, inspect, text, Column, Integer, Float, String, Boolean, DateTime, ForeignKey, Index, JSON
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime, UTC
@@ -13,44 +13,242 @@ class Device(Base):
     name = Column(String(100), nullable=False)
     device_type = Column(String(50), nullable=False)
     created_at = Column(DateTime, default=lambda: datetime.now(UTC))
+    last_seen_at = Column(DateTime)
     
     # Relationship with snapshots
     snapshots = relationship('Snapshot', back_populates='device')
 
+    # Device names are unique; bulk registration upserts against this index
+    __table_args__ = (
+        Index('ix_devices_name', 'name', unique=True),
+        Index('ix_devices_device_type_name', 'device_type', 'name'),
+        # Liveness refreshes read back recently reported devices
+        Index('ix_devices_last_seen_at', 'last_seen_at'),
+    )
+
 class Snapshot(Base):
     __tablename__ = 'snapshots'
     
     id = Column(Integer, primary_key=True)
     device_id = Column(Integer, ForeignKey('devices.id'))
     timestamp = Column(DateTime, nullable=False, default=lambda: datetime.now(UTC))
+    # Effective collection interval when the snapshot was taken (adaptive sampling)
+    interval_seconds = Column(Float)
     
     # Relationships
     device = relationship('Device', back_populates='snapshots')
     system_metrics = relationship('SystemMetric', back_populates='snapshot', uselist=False)
     crypto_metrics = relationship('CryptoMetric', back_populates='snapshot', uselist=False)
+    collector_metrics = relationship('CollectorMetric', back_populates='snapshot', uselist=False)
+    summaries = relationship('MetricSummary', back_populates='snapshot')
+
+    # Range scans by device and time (metrics queries, exports); unfiltered
+    # exports page through (timestamp, id) without sorting
+    __table_args__ = (
+        Index('ix_snapshots_device_timestamp', 'device_id', 'timestamp'),
+        Index('ix_snapshots_timestamp_id', 'timestamp', 'id'),
+    )
 
 class SystemMetric(Base):
     __tablename__ = 'system_metrics'
     
     id = Column(Integer, primary_key=True)
-    snapshot_id = Column(Integer, ForeignKey('snapshots.id'))
+    snapshot_id = Column(Integer, ForeignKey('snapshots.id'), index=True)
     thread_count = Column(Integer)
     ram_usage_percent = Column(Float)
+    process_count = Column(Integer)
+    cpu_percent = Column(Float)
+    cpu_per_core = Column(JSON)
+    load_1 = Column(Float)
+    load_5 = Column(Float)
+    load_15 = Column(Float)
+    disk_read_bytes_per_sec = Column(Float)
+    disk_write_bytes_per_sec = Column(Float)
+    net_sent_bytes_per_sec = Column(Float)
+    net_recv_bytes_per_sec = Column(Float)
+    top_processes = Column(JSON)
     
     # Relationship with snapshot
     snapshot = relationship('Snapshot', back_populates='system_metrics')
 
 class CryptoMetric(Base):
+    """Legacy per-snapshot prices; new prices are stored once in market_prices"""
     __tablename__ = 'crypto_metrics'
     
     id = Column(Integer, primary_key=True)
-    snapshot_id = Column(Integer, ForeignKey('snapshots.id'))
+    snapshot_id = Column(Integer, ForeignKey('snapshots.id'), index=True)
     bitcoin_price_usd = Column(Float)
     ethereum_price_usd = Column(Float)
     
     # Relationship with snapshot
     snapshot = relationship('Snapshot', back_populates='crypto_metrics')
 
+class MarketSymbol(Base):
+    """Registry of market symbols (CoinGecko ids); enabled symbols are fetched by the market ingester"""
+    __tablename__ = 'market_symbols'
+    
+    id = Column(Integer, primary_key=True)
+    symbol = Column(String(100), nullable=False, unique=True)
+    enabled = Column(Boolean, nullable=False, default=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(UTC))
+
+class MarketPrice(Base):
+    """
+    One price per symbol per aligned interval, shared by every device's snapshots.
+
+    Stored as a clustered (symbol_id, ts) series without a rowid: integer
+    keys and epoch-second timestamps keep each row a few bytes and each
+    symbol's series contiguous on disk.
+    """
+    __tablename__ = 'market_prices'
+    __table_args__ = {'sqlite_with_rowid': False}
+    
+    symbol_id = Column(Integer, ForeignKey('market_symbols.id'), primary_key=True)
+    ts = Column(Integer, primary_key=True)
+    price = Column(Float, nullable=False)
+
+class CollectorMetric(Base):
+    """The collector's own overhead over the interval ending at a snapshot"""
+    __tablename__ = 'collector_metrics'
+    
+    id = Column(Integer, primary_key=True)
+    snapshot_id = Column(Integer, ForeignKey('snapshots.id'), index=True)
+    cpu_percent = Column(Float)
+    cpu_seconds = Column(Float)
+    rss_bytes = Column(Integer)
+    scheduling_lag_seconds = Column(Float)
+    flush_seconds = Column(Float)
+    source_latencies = Column(JSON)
+    source_intervals = Column(JSON)
+    interval_factor = Column(Integer)
+    under_pressure = Column(Boolean)
+    
+    # Relationship with snapshot
+    snapshot = relationship('Snapshot', back_populates='collector_metrics')
+
+class MetricSummary(Base):
+    __tablename__ = 'metric_summaries'
+    
+    id = Column(Integer, primary_key=True)
+    snapshot_id = Column(Integer, ForeignKey('snapshots.id'), index=True)
+    # Name of the summarized metric, e.g. 'ram_usage_percent'
+    metric = Column(String(50), nullable=False)
+    # Statistics over the high-frequency samples taken during the snapshot interval
+    sample_count = Column(Integer, nullable=False)
+    min = Column(Float)
+    max = Column(Float)
+    mean = Column(Float)
+    last = Column(Float)
+    p95 = Column(Float)
+    
+    # Relationship with snapshot
+    snapshot = relationship('Snapshot', back_populates='summaries')
+
+class Command(Base):
+    __tablename__ = 'commands'
+    
+    id = Column(Integer, primary_key=True)
+    device_id = Column(Integer, ForeignKey('devices.id'), nullable=False)
+    command_type = Column(String(50), nullable=False)
+    params = Column(JSON)
+    # queued -> delivered -> acked -> done/failed (see commands.TRANSITIONS)
+    status = Column(String(20), nullable=False, default='queued')
+    result = Column(JSON)
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(UTC))
+    updated_at = Column(DateTime, nullable=False, default=lambda: datetime.now(UTC))
+    delivered_at = Column(DateTime)
+    batch_id = Column(Integer, ForeignKey('command_batches.id'), index=True)
+    
+    # Relationship with device
+    device = relationship('Device')
+    
+    # Long-poll delivery looks up a device's queued commands in id order
+    __table_args__ = (
+        Index('ix_commands_device_status', 'device_id', 'status', 'id'),
+    )
+
+class CommandBatch(Base):
+    __tablename__ = 'command_batches'
+    
+    id = Column(Integer, primary_key=True)
+    command_type = Column(String(50), nullable=False)
+    params = Column(JSON)
+    selector = Column(JSON)
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(UTC))
+    target_count = Column(Integer, nullable=False, default=0)
+    
+    # Per-state counts, kept in step with command transitions
+    queued_count = Column(Integer, nullable=False, default=0)
+    delivered_count = Column(Integer, nullable=False, default=0)
+    acked_count = Column(Integer, nullable=False, default=0)
+    done_count = Column(Integer, nullable=False, default=0)
+    failed_count = Column(Integer, nullable=False, default=0)
+
+class DeviceTag(Base):
+    __tablename__ = 'device_tags'
+    
+    device_id = Column(Integer, ForeignKey('devices.id'), primary_key=True)
+    tag = Column(String(100), primary_key=True)
+    
+    # Fan-out resolves selectors by tag
+    __table_args__ = (
+        Index('ix_device_tags_tag', 'tag', 'device_id'),
+    )
+
+def upgrade_schema(engine):
+    """Add columns and indexes introduced after a table was first created (create_all skips existing tables)"""
+    existing_tables = inspect(engine).get_table_names()
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {c['name'] for c in inspect(connection).get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+    if 'devices' in existing_tables:
+        merge_duplicate_devices(engine)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+def merge_duplicate_devices(engine):
+    """
+    Merge devices registered more than once under the same name into the
+    lowest id, so the unique index on name can be created. Rows referencing
+    an extra device are repointed to the kept one (tags it already has are
+    dropped), then the extras are deleted. Returns the number deleted.
+    """
+    referencing = [
+        (table.name, fk.parent.name)
+        for table in Base.metadata.sorted_tables
+        for fk in table.foreign_keys
+        if fk.column.table.name == 'devices'
+    ]
+    with engine.begin() as connection:
+        duplicates = connection.execute(text(
+            "SELECT devices.id, keep.id FROM devices "
+            "JOIN (SELECT name, MIN(id) AS id FROM devices GROUP BY name HAVING COUNT(*) > 1) AS keep "
+            "ON devices.name = keep.name WHERE devices.id <> keep.id"
+        )).all()
+        if not duplicates:
+            return 0
+        pairs = [{'duplicate_id': duplicate_id, 'keep_id': keep_id} for duplicate_id, keep_id in duplicates]
+        connection.execute(text(
+            "UPDATE devices SET last_seen_at = "
+            "(SELECT MAX(last_seen_at) FROM devices AS d WHERE d.id IN (:keep_id, :duplicate_id)) "
+            "WHERE id = :keep_id"
+        ), pairs)
+        for table, column in referencing:
+            # OR IGNORE leaves rows that would collide with the kept device's own; they go below
+            connection.execute(text(
+                f"UPDATE OR IGNORE {table} SET {column} = :keep_id WHERE {column} = :duplicate_id"
+            ), pairs)
+            connection.execute(text(f"DELETE FROM {table} WHERE {column} = :duplicate_id"), pairs)
+        connection.execute(text("DELETE FROM devices WHERE id = :duplicate_id"), pairs)
+    return len(duplicates)
+
 def get_database_engine(db_path=None):
     """Get database engine based on environment"""
     if db_path is None:
@@ -0,0 +1,85 @@
+import time
+
+import psutil
+
+
+class OverheadMonitor:
+    """
+    Measures the collector's own cost and enforces a CPU budget.
+
+    Each report() covers the time since the previous one: CPU used by the
+    whole collector process as a percentage of one core, resident memory,
+    the worst scheduling lag seen, the last flush duration and each
+    source's collection latency. The values are stored as the
+    collector_metrics group of the snapshot they were reported with.
+
+    The budget is checked over windows of at least window seconds, since
+    CPU time advances in clock ticks and single short intervals are noisy.
+    While a window is above budget_percent the interval factor doubles, up
+    to max_factor, and it halves again once usage falls below half the
+    budget. Start-up work before the first report is not counted.
+    """
+
+    def __init__(self, budget_percent=1.0, max_factor=8, window=30.0,
+                 process=None, clock=time.monotonic):
+        self.budget_percent = budget_percent
+        self.max_factor = max_factor
+        self.window = window
+        self.factor = 1
+        self._process = process or psutil.Process()
+        self._clock = clock
+        self._last_time = clock()
+        self._last_cpu = self._cpu_seconds()
+        self._max_lag = 0.0
+        self._window_start = None
+        self.window_cpu_percent = None
+
+    def _cpu_seconds(self):
+        times = self._process.cpu_times()
+        return times.user + times.system
+
+    def observe_lag(self, lag):
+        """Record the scheduling lag of a tick (reported as the maximum since the last report)"""
+        self._max_lag = max(self._max_lag, lag)
+
+    def report(self, flush_seconds=None, latencies=None):
+        """Collector metrics since the previous report"""
+        now = self._clock()
+        with self._process.oneshot():
+            cpu = self._cpu_seconds()
+            rss = self._process.memory_info().rss
+        elapsed = now - self._last_time
+        cpu_percent = 100.0 * (cpu - self._last_cpu) / elapsed if elapsed > 0 else 0.0
+        self._last_time, self._last_cpu = now, cpu
+
+        lag, self._max_lag = self._max_lag, 0.0
+        return {
+            'cpu_percent': round(cpu_percent, 4),
+            'cpu_seconds': round(cpu, 4),
+            'rss_bytes': rss,
+            'scheduling_lag_seconds': round(lag, 6),
+            'flush_seconds': round(flush_seconds, 6) if flush_seconds is not None else None,
+            'source_latencies': {name: round(latency, 6) for name, latency in (latencies or {}).items()},
+            'interval_factor': self.factor
+        }
+
+    def adjust(self):
+        """Update the interval factor at the end of each window; returns True if it changed"""
+        if self._window_start is None:
+            self._window_start = (self._last_time, self._last_cpu)
+            return False
+        start_time, start_cpu = self._window_start
+        elapsed = self._last_time - start_time
+        if elapsed < self.window:
+            return False
+        self.window_cpu_percent = 100.0 * (self._last_cpu - start_cpu) / elapsed
+        self._window_start = (self._last_time, self._last_cpu)
+
+        factor = self.factor
+        if self.window_cpu_percent > self.budget_percent:
+            factor = min(self.factor * 2, self.max_factor)
+        elif self.window_cpu_percent < self.budget_percent / 2:
+            factor = max(self.factor // 2, 1)
+        changed = factor != self.factor
+        self.factor = factor
+        return changed
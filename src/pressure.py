@@ -0,0 +1,59 @@
+class PressurePolicy:
+    """
+    Adapts collection intervals to host pressure.
+
+    The host is under pressure once CPU or RAM usage reaches its threshold,
+    and leaves that state when both are back below threshold - hysteresis,
+    so the policy doesn't flap around the limit. Under pressure cheap
+    sources (and snapshots) run speedup times faster, down to min_interval,
+    to keep resolution while it matters; expensive sources (network
+    fetches, process scans) run backoff times slower so the collector adds
+    as little load as possible. Intervals are computed from each source's
+    configured interval times the collector's overhead factor.
+    """
+
+    def __init__(self, cpu_threshold=90.0, ram_threshold=90.0, hysteresis=5.0,
+                 speedup=4.0, backoff=4.0, min_interval=1.0):
+        self.cpu_threshold = cpu_threshold
+        self.ram_threshold = ram_threshold
+        self.hysteresis = hysteresis
+        self.speedup = speedup
+        self.backoff = backoff
+        self.min_interval = min_interval
+        self.under_pressure = False
+        self._readings = {}
+
+    def update(self, system_values):
+        """Re-evaluate pressure from the latest system metrics; returns True if the state changed"""
+        # Missing readings keep their last known value rather than clearing pressure
+        for name in ('cpu_percent', 'ram_usage_percent'):
+            value = (system_values or {}).get(name)
+            if value is not None:
+                self._readings[name] = value
+        # CPU is measured over the time between samples, so the first sample
+        # has none; stay in the normal state until a real reading arrives
+        cpu = self._readings.get('cpu_percent')
+        if cpu is None:
+            return False
+        ram = self._readings.get('ram_usage_percent')
+        margin = self.hysteresis if self.under_pressure else 0.0
+        under_pressure = (
+            cpu >= self.cpu_threshold - margin or
+            (ram is not None and ram >= self.ram_threshold - margin)
+        )
+        changed = under_pressure != self.under_pressure
+        self.under_pressure = under_pressure
+        return changed
+
+    def _scaled(self, interval, expensive):
+        if not self.under_pressure:
+            return interval
+        if expensive:
+            return interval * self.backoff
+        return max(interval / self.speedup, min(self.min_interval, interval))
+
+    def source_interval(self, source, factor=1):
+        return self._scaled(source.base_interval * factor, source.expensive)
+
+    def snapshot_interval(self, interval, factor=1):
+        return self._scaled(interval * factor, expensive=False)
@@ -0,0 +1,276 @@
+import argparse
+import logging
+import os
+import threading
+import time
+
+import requests
+from flask import Flask, jsonify
+
+from metrics_sdk.breaker import CircuitBreaker, retry_after
+
+COINGECKO_URL = 'https://api.coingecko.com/api/v3/simple/price'
+
+# Coins fetched from CoinGecko and the metric names they are reported as
+COINS = {
+    'bitcoin': 'bitcoin_price_usd',
+    'ethereum': 'ethereum_price_usd',
+}
+
+# CoinGecko takes many comma-separated ids per simple/price call; larger symbol
+# lists are split into batches of this many ids
+FETCH_BATCH_SIZE = 250
+
+# Collectors read prices from this service instead of CoinGecko when set
+# (e.g. http://localhost:5100)
+PRICE_FEED_URL = os.getenv('PRICE_FEED_URL')
+
+# Seconds the breaker stays open after upstream failures; doubles (up to the
+# max) while the upstream keeps failing
+BREAKER_RESET_TIMEOUT = 60.0
+BREAKER_MAX_RESET_TIMEOUT = 600.0
+
+logger = logging.getLogger('PriceFeed')
+
+
+class UpstreamError(Exception):
+    """The upstream price API failed; retry_after is set when it asked us to back off"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _simple_price(url, ids, timeout):
+    """Raw simple/price response for the given CoinGecko ids"""
+    try:
+        response = requests.get(
+            url,
+            params={'ids': ','.join(ids), 'vs_currencies': 'usd'},
+            timeout=timeout
+        )
+    except requests.RequestException as e:
+        raise UpstreamError(str(e))
+    if response.status_code != 200:
+        raise UpstreamError(f"CoinGecko returned {response.status_code}", retry_after(response))
+    try:
+        return response.json()
+    except ValueError as e:
+        raise UpstreamError(f"Unexpected CoinGecko response: {e}")
+
+
+def fetch_coingecko(url=COINGECKO_URL, timeout=10.0):
+    """Current USD prices from CoinGecko; raises UpstreamError on any failure"""
+    data = _simple_price(url, COINS, timeout)
+    try:
+        return {metric: float(data[coin]['usd']) for coin, metric in COINS.items()}
+    except (KeyError, TypeError, ValueError) as e:
+        raise UpstreamError(f"Unexpected CoinGecko response: {e}")
+
+
+def fetch_symbols(symbols, url=COINGECKO_URL, timeout=10.0, batch_size=FETCH_BATCH_SIZE):
+    """
+    USD prices for many CoinGecko ids, batch_size ids per request.
+
+    Returns {symbol: price} for every symbol upstream priced. A failed
+    batch is skipped, except that a Retry-After stops the remaining
+    batches; UpstreamError is raised only when nothing could be fetched.
+    """
+    symbols = list(dict.fromkeys(symbols))
+    prices = {}
+    error = None
+    for start in range(0, len(symbols), batch_size):
+        batch = symbols[start:start + batch_size]
+        try:
+            data = _simple_price(url, batch, timeout)
+        except UpstreamError as e:
+            logger.warning(f"Price batch {start // batch_size + 1} failed: {str(e)}")
+            error = e
+            if e.retry_after:
+                break
+            continue
+        for symbol in batch:
+            try:
+                prices[symbol] = float(data[symbol]['usd'])
+            except (KeyError, TypeError, ValueError):
+                pass
+    if error is not None and not prices:
+        raise error
+    return prices
+
+
+def fetch_from_service(url, timeout=10.0):
+    """Prices from a shared price-feed service (see create_app)"""
+    try:
+        response = requests.get(f"{url.rstrip('/')}/v1/prices", timeout=timeout)
+    except requests.RequestException as e:
+        raise UpstreamError(str(e))
+    if response.status_code != 200:
+        raise UpstreamError(f"Price feed returned {response.status_code}", retry_after(response))
+    prices = response.json().get('prices') or {}
+    if all(prices.get(metric) is None for metric in COINS.values()):
+        raise UpstreamError('Price feed has no prices yet')
+    return prices
+
+
+def upstream_breaker(clock=time.monotonic):
+    """Circuit breaker for an upstream price API"""
+    return CircuitBreaker(reset_timeout=BREAKER_RESET_TIMEOUT, max_reset_timeout=BREAKER_MAX_RESET_TIMEOUT, clock=clock)
+
+
+class PriceFeed:
+    """
+    Cached crypto prices shared by every caller in the process.
+
+    - Values younger than ttl are served from the cache.
+    - Values older than ttl but younger than stale_ttl are served
+      immediately while one background fetch revalidates them.
+    - With no usable value, the caller fetches synchronously; concurrent
+      callers join the fetch already in flight (single flight) instead of
+      starting their own.
+    - Upstream failures feed a circuit breaker; while it is open no
+      requests are made and the last known prices are served until they
+      are stale_ttl old. Older prices are never served: values are None.
+    """
+
+    def __init__(self, fetch=fetch_coingecko, ttl=60.0, stale_ttl=600.0, timeout=10.0,
+                 breaker=None, clock=time.monotonic):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self.breaker = breaker or upstream_breaker(clock)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._prices = None
+        self._fetched_at = None
+        self._inflight = None
+        self.fetches = 0
+        self.errors = 0
+        self.hits = 0
+
+    def age(self):
+        """Seconds since the cached prices were fetched, or None"""
+        with self._lock:
+            return self._clock() - self._fetched_at if self._fetched_at is not None else None
+
+    def get(self):
+        """Prices by metric name; values are None when no prices are available"""
+        age = self.age()
+        if age is None or age >= self.stale_ttl:
+            self._refresh()
+        elif age >= self.ttl:
+            self._revalidate()
+        else:
+            self.hits += 1
+        with self._lock:
+            if self._prices and self._clock() - self._fetched_at < self.stale_ttl:
+                return dict(self._prices)
+            return {metric: None for metric in COINS.values()}
+
+    def _revalidate(self):
+        """Refresh in the background unless a fetch is already running"""
+        with self._lock:
+            if self._inflight is not None:
+                return
+        threading.Thread(target=self._refresh, name='price-feed-refresh', daemon=True).start()
+
+    def _refresh(self):
+        with self._lock:
+            leader = self._inflight is None
+            if leader:
+                self._inflight = threading.Event()
+            done = self._inflight
+        if not leader:
+            # Another caller is already fetching; share its result
+            done.wait(self.timeout)
+            return
+
+        try:
+            if not self.breaker.allow():
+                return
+            self.fetches += 1
+            try:
+                prices = self._fetch(timeout=self.timeout)
+            except Exception as e:
+                self.errors += 1
+                self.breaker.record_failure(getattr(e, 'retry_after', None))
+                logger.warning(f"Price fetch failed ({self.breaker.state}): {str(e)}")
+                return
+            self.breaker.record_success()
+            with self._lock:
+                self._prices = prices
+                self._fetched_at = self._clock()
+        finally:
+            with self._lock:
+                self._inflight = None
+            done.set()
+
+    def stats(self):
+        return {
+            'age_seconds': self.age(),
+            'fetches': self.fetches,
+            'errors': self.errors,
+            'hits': self.hits,
+            'breaker': self.breaker.state
+        }
+
+
+_default_feed = None
+_default_feed_lock = threading.Lock()
+
+
+def default_feed():
+    """Process-wide feed; reads from PRICE_FEED_URL when set, otherwise CoinGecko"""
+    global _default_feed
+    with _default_feed_lock:
+        if _default_feed is None:
+            if PRICE_FEED_URL:
+                _default_feed = PriceFeed(lambda timeout: fetch_from_service(PRICE_FEED_URL, timeout))
+            else:
+                _default_feed = PriceFeed()
+        return _default_feed
+
+
+def create_app(feed):
+    """Tiny HTTP service so the collectors on a host (or site) share one feed"""
+    app = Flask(__name__)
+
+    @app.route('/v1/prices', methods=['GET'])
+    def get_prices():
+        """Current prices with their age and staleness"""
+        prices = feed.get()
+        age = feed.age()
+        return jsonify({
+            'prices': prices,
+            'age_seconds': age,
+            'stale': age is None or age >= feed.ttl
+        }), 200
+
+    @app.route('/v1/prices/stats', methods=['GET'])
+    def get_stats():
+        """Cache and circuit breaker counters"""
+        return jsonify(feed.stats()), 200
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve cached crypto prices to local collectors')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--ttl', type=float, default=60.0, help='Seconds prices are served without refetching')
+    parser.add_argument('--stale-ttl', type=float, default=600.0, help='Seconds stale prices may be served while refetching')
+    parser.add_argument('--upstream', default=COINGECKO_URL, help='CoinGecko-compatible simple/price URL')
+    args = parser.parse_args()
+
+    feed = PriceFeed(
+        lambda timeout: fetch_coingecko(args.upstream, timeout),
+        ttl=args.ttl,
+        stale_ttl=args.stale_ttl
+    )
+    create_app(feed).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import math
+import random
+import threading
+import time
+from datetime import datetime, UTC
+
+
+def next_boundary(now, interval, phase=0.0):
+    """First wall-clock time after now that is phase seconds past a multiple of interval"""
+    return (math.floor((now - phase) / interval) + 1) * interval + phase
+
+
+def monotonic_deadline(interval, phase=0.0, wall_clock=time.time, clock=time.monotonic):
+    """Monotonic time of the next aligned boundary, for waits immune to wall-clock steps"""
+    wall_now = wall_clock()
+    return clock() + (next_boundary(wall_now, interval, phase) - wall_now)
+
+
+class Tick:
+    """One scheduler firing"""
+
+    def __init__(self, scheduled, lag, skipped):
+        # Aligned wall-clock boundary this tick stands for (naive UTC)
+        self.scheduled = scheduled
+        # Seconds between the boundary (plus jitter) and when the tick actually fired
+        self.lag = lag
+        # Boundaries coalesced into this tick because they were missed
+        self.skipped = skipped
+
+    def __repr__(self):
+        return f'Tick(scheduled={self.scheduled.isoformat()}, lag={self.lag:.4f}, skipped={self.skipped})'
+
+
+class AlignedScheduler:
+    """
+    Fires on wall-clock-aligned interval boundaries without drift.
+
+    Boundaries are absolute multiples of the interval (e.g. :00, :01, ...
+    for 1 s), so the time spent working between ticks never accumulates
+    and devices with synchronized clocks sample at the same instants.
+    Waiting uses the monotonic clock; the wall clock is only read to place
+    the next boundary, so NTP adjustments shift at most one wait.
+
+    jitter spreads load by delaying every firing by a fixed random offset
+    in [0, jitter) chosen per scheduler; ticks still report the aligned
+    boundary as their timestamp. If the caller falls behind by whole
+    intervals, the missed boundaries are coalesced into the next tick and
+    counted in Tick.skipped.
+    """
+
+    def __init__(self, interval, jitter=0.0, wall_clock=time.time, clock=time.monotonic):
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+        self.interval = float(interval)
+        self.jitter = min(float(jitter), self.interval)
+        self.offset = random.uniform(0, self.jitter) if self.jitter else 0.0
+        self._wall_clock = wall_clock
+        self._clock = clock
+        self._next = None
+        self._stop = threading.Event()
+        self.ticks = 0
+        self.skipped = 0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+
+    def set_interval(self, interval):
+        """Change the interval; takes effect from the next boundary"""
+        self.interval = float(interval)
+        self.jitter = min(self.jitter, self.interval)
+        self.offset = min(self.offset, self.jitter)
+        self._next = None
+
+    def stop(self):
+        self._stop.set()
+
+    def wait(self):
+        """Block until the next boundary; returns a Tick, or None once stopped"""
+        wall_now = self._wall_clock()
+        if self._next is None:
+            self._next = next_boundary(wall_now, self.interval)
+
+        # Sleep on the monotonic clock until the boundary (plus jitter offset)
+        fire_at = self._next + self.offset
+        deadline = self._clock() + (fire_at - wall_now)
+        while not self._stop.is_set():
+            remaining = deadline - self._clock()
+            if remaining <= 0:
+                break
+            self._stop.wait(remaining)
+        if self._stop.is_set():
+            return None
+
+        # Coalesce boundaries we were too late for into this tick
+        lag = self._wall_clock() - fire_at
+        skipped = max(int(lag // self.interval), 0)
+        scheduled = self._next + skipped * self.interval
+        lag -= skipped * self.interval
+        self._next = scheduled + self.interval
+
+        self.ticks += 1
+        self.skipped += skipped
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        return Tick(
+            scheduled=datetime.fromtimestamp(scheduled, UTC).replace(tzinfo=None),
+            lag=lag,
+            skipped=skipped
+        )
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'ticks': self.ticks,
+            'skipped': self.skipped,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag
+        }
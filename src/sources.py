@@ -0,0 +1,280 @@
+import heapq
+import threading
+import time
+from array import array
+
+import psutil
+
+from metrics_sdk.models import MetricSummary
+from price_feed import default_feed
+
+
+def _rate(current, previous, elapsed):
+    """Per-second rate between two counter readings; None on the first reading or a counter reset"""
+    if previous is None or not elapsed or current < previous:
+        return None
+    return round((current - previous) / elapsed, 2)
+
+
+def _busy_percent(current, previous):
+    """CPU busy percentage between two cpu_times() readings of one core"""
+    # guest time is already counted in user time on Linux
+    def total(times):
+        return sum(times) - getattr(times, 'guest', 0) - getattr(times, 'guest_nice', 0)
+
+    def idle(times):
+        return times.idle + getattr(times, 'iowait', 0)
+
+    elapsed = total(current) - total(previous)
+    if elapsed <= 0:
+        return 0.0
+    return round(max(0.0, 100.0 * (1 - (idle(current) - idle(previous)) / elapsed)), 2)
+
+
+class HostStats:
+    """
+    System-wide host metrics built from cheap incremental reads.
+
+    Load averages and the total thread count come from one read of
+    /proc/loadavg through a handle kept open between samples. CPU, disk and
+    network figures are derived from the counter deltas between consecutive
+    calls, so each instance reports rates over its own sampling interval
+    and None for them on its first call.
+    """
+
+    LOADAVG_PATH = '/proc/loadavg'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loadavg = None
+        self._last_time = None
+        self._last_cpu = None
+        self._last_disk = None
+        self._last_net = None
+
+    def _read_loadavg(self):
+        """(load_1, load_5, load_15, thread_count); thread_count is None without procfs"""
+        try:
+            if self._loadavg is None:
+                self._loadavg = open(self.LOADAVG_PATH, 'rb', buffering=0)
+            self._loadavg.seek(0)
+            # e.g. b'0.52 0.58 0.59 3/1024 12345': the 4th field is running/total threads
+            fields = self._loadavg.read(128).split()
+            return float(fields[0]), float(fields[1]), float(fields[2]), int(fields[3].split(b'/')[1])
+        except (OSError, IndexError, ValueError):
+            load_1, load_5, load_15 = psutil.getloadavg()
+            return load_1, load_5, load_15, None
+
+    def sample(self):
+        load_1, load_5, load_15, thread_count = self._read_loadavg()
+        if thread_count is None:
+            thread_count = sum(p.info['num_threads'] or 0 for p in psutil.process_iter(['num_threads']))
+
+        cpu = psutil.cpu_times(percpu=True)
+        disk = psutil.disk_io_counters()
+        net = psutil.net_io_counters()
+        now = time.monotonic()
+
+        with self._lock:
+            # Like the rates, CPU busy time needs two readings
+            per_core = [_busy_percent(c, p) for c, p in zip(cpu, self._last_cpu)] if self._last_cpu else None
+            elapsed = now - self._last_time if self._last_time is not None else None
+            last_disk, last_net = self._last_disk, self._last_net
+            self._last_cpu, self._last_disk, self._last_net, self._last_time = cpu, disk, net, now
+
+        return {
+            'thread_count': thread_count,
+            'process_count': len(psutil.pids()),
+            'ram_usage_percent': psutil.virtual_memory().percent,
+            'cpu_percent': round(sum(per_core) / len(per_core), 2) if per_core else None,
+            'cpu_per_core': per_core,
+            'load_1': load_1,
+            'load_5': load_5,
+            'load_15': load_15,
+            'disk_read_bytes_per_sec': _rate(disk.read_bytes, last_disk.read_bytes, elapsed) if disk and last_disk else None,
+            'disk_write_bytes_per_sec': _rate(disk.write_bytes, last_disk.write_bytes, elapsed) if disk and last_disk else None,
+            'net_sent_bytes_per_sec': _rate(net.bytes_sent, last_net.bytes_sent, elapsed) if net and last_net else None,
+            'net_recv_bytes_per_sec': _rate(net.bytes_recv, last_net.bytes_recv, elapsed) if net and last_net else None,
+        }
+
+
+def top_processes_by_memory(limit=5):
+    """The processes with the largest resident set size"""
+    processes = []
+    # process_iter with attrs reads each process's attributes in a single oneshot()
+    for process in psutil.process_iter(['pid', 'name', 'memory_info']):
+        memory = process.info['memory_info']
+        if memory is not None:
+            processes.append((memory.rss, process.info['pid'], process.info['name']))
+    return [
+        {'pid': pid, 'name': name, 'rss_bytes': rss}
+        for rss, pid, name in heapq.nlargest(limit, processes)
+    ]
+
+
+def get_crypto_prices():
+    """BTC/ETH prices from the shared, cached price feed"""
+    return default_feed().get()
+
+
+class MetricSource:
+    """
+    Base class for collector plugins.
+
+    A source produces one metric group (a dict of values) per collect()
+    call. The collector runs every source on its own interval, so a slow or
+    hung source only delays its own group.
+    """
+
+    name = None
+    # Snapshot group the values are stored under ('system_metrics', 'crypto_metrics', ...)
+    group = None
+    default_interval = 60.0
+    default_timeout = 10.0
+    # Expensive sources (network fetches, process scans) are slowed down under host pressure
+    expensive = False
+
+    def __init__(self, interval=None, timeout=None):
+        # Configured interval; the collector may stretch interval beyond it under load
+        self.base_interval = float(interval if interval is not None else self.default_interval)
+        self.interval = self.base_interval
+        self.timeout = float(timeout if timeout is not None else self.default_timeout)
+
+    def collect(self):
+        raise NotImplementedError
+
+    def summarize(self):
+        """Per-metric MetricSummary of samples since the last report (for sampling sources)"""
+        return {}
+
+    def __repr__(self):
+        return f'{type(self).__name__}(interval={self.interval}, timeout={self.timeout})'
+
+
+class SystemMetricsSource(MetricSource):
+    """System-wide threads, processes, RAM, CPU, load and IO rates"""
+
+    name = 'system'
+    group = 'system_metrics'
+    default_timeout = 5.0
+
+    def __init__(self, interval=None, timeout=None):
+        super().__init__(interval, timeout)
+        self.host = HostStats()
+
+    def collect(self):
+        return self.host.sample()
+
+
+class RingBuffer:
+    """Fixed-capacity buffer of float samples; the oldest samples are overwritten when full"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._values = array('d', bytes(8 * capacity))
+        self._start = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def append(self, value):
+        with self._lock:
+            end = (self._start + self._size) % self.capacity
+            self._values[end] = value
+            if self._size < self.capacity:
+                self._size += 1
+            else:
+                self._start = (self._start + 1) % self.capacity
+
+    def drain(self):
+        """Return buffered samples oldest first and empty the buffer"""
+        with self._lock:
+            values = [self._values[(self._start + i) % self.capacity] for i in range(self._size)]
+            self._start = 0
+            self._size = 0
+        return values
+
+    def __len__(self):
+        return self._size
+
+
+class HighFrequencySystemSource(SystemMetricsSource):
+    """
+    System metrics sampled at a high rate into per-metric ring buffers.
+
+    Each collect() takes one sample; summarize() reduces everything sampled
+    since the previous report to min/max/mean/last/p95 so spikes between
+    snapshots are kept without storing raw samples.
+    """
+
+    name = 'system_hf'
+    default_interval = 1.0
+    default_timeout = 1.0
+    # Samples kept per metric between reports (an hour at 1 Hz)
+    capacity = 3600
+
+    def __init__(self, interval=None, timeout=None):
+        super().__init__(interval, timeout)
+        self._buffers = {}
+
+    def collect(self):
+        values = self.host.sample()
+        for metric, value in values.items():
+            # Only scalar metrics are summarized (not per-core lists)
+            if value is None or not isinstance(value, (int, float)):
+                continue
+            if metric not in self._buffers:
+                self._buffers[metric] = RingBuffer(self.capacity)
+            self._buffers[metric].append(float(value))
+        return values
+
+    def summarize(self):
+        return {
+            metric: MetricSummary.from_values(buffer.drain())
+            for metric, buffer in list(self._buffers.items())
+            if len(buffer)
+        }
+
+
+class TopProcessesSource(MetricSource):
+    """
+    Top processes by memory.
+
+    Walking every process is far more expensive than the other system
+    metrics, so this runs as its own slower source; its values are merged
+    into the system group of each snapshot.
+    """
+
+    name = 'processes'
+    group = 'system_metrics'
+    default_interval = 30.0
+    expensive = True
+    top_n = 5
+
+    def collect(self):
+        return {'top_processes': top_processes_by_memory(self.top_n)}
+
+
+class CryptoPriceSource(MetricSource):
+    """
+    BTC/ETH spot prices.
+
+    Prices come from the process-wide PriceFeed (TTL cache, single-flight
+    fetches, circuit breaker), which reads from the local price-feed
+    service when PRICE_FEED_URL is set and from CoinGecko otherwise.
+    """
+
+    name = 'crypto'
+    group = 'crypto_metrics'
+    expensive = True
+
+    def collect(self):
+        return get_crypto_prices()
+
+
+# Plugins selectable by name through COLLECTOR_SOURCES (default: system, processes and crypto)
+SOURCES = {
+    SystemMetricsSource.name: SystemMetricsSource,
+    HighFrequencySystemSource.name: HighFrequencySystemSource,
+    TopProcessesSource.name: TopProcessesSource,
+    CryptoPriceSource.name: CryptoPriceSource,
+}
@@ -0,0 +1,139 @@
+import logging
+import time
+
+from sqlalchemy import insert
+
+from liveness import write_last_seen
+from market import insert_prices, price_rows
+from models import Snapshot, SystemMetric, CollectorMetric, MetricSummary
+
+# Snapshot groups stored as per-snapshot rows (crypto_metrics goes to market_prices)
+GROUP_TABLES = {
+    'system_metrics': SystemMetric.__table__,
+    'collector_metrics': CollectorMetric.__table__,
+}
+
+
+class SnapshotBuffer:
+    """
+    Buffers collected snapshots and writes them in bulk.
+
+    Samples are kept as plain dicts (no ORM objects, no long-lived session)
+    and flushed every max_samples samples or flush_interval seconds in one
+    short transaction using Core executemany inserts, which also moves each
+    device's last_seen_at forward. A crash loses at most the current flush
+    window. If the database is unavailable the buffer keeps retrying but
+    never holds more than max_pending samples, dropping the oldest so
+    memory stays bounded over long uptimes.
+    """
+
+    def __init__(self, session_factory, max_samples=60, flush_interval=60.0,
+                 max_pending=None, logger=None, clock=time.monotonic):
+        self.session_factory = session_factory
+        self.max_samples = max_samples
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending or max_samples * 10
+        self.logger = logger or logging.getLogger('MetricsCollector')
+        self._clock = clock
+        self._pending = []
+        self._last_flush = clock()
+        self.flushed = 0
+        self.dropped = 0
+        self.last_flush_seconds = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, device_id, timestamp, groups, summaries=None, interval_seconds=None):
+        """Queue one snapshot; flushes when the sample or time threshold is reached"""
+        self._pending.append({
+            'device_id': device_id,
+            'timestamp': timestamp,
+            'interval_seconds': interval_seconds,
+            'groups': groups,
+            'summaries': summaries or {}
+        })
+        if len(self._pending) > self.max_pending:
+            overflow = len(self._pending) - self.max_pending
+            del self._pending[:overflow]
+            self.dropped += overflow
+            self.logger.warning(f"Snapshot buffer full, dropped {overflow} oldest samples")
+        return self.flush_if_due()
+
+    def flush_if_due(self):
+        if not self._pending:
+            return 0
+        if len(self._pending) >= self.max_samples or self._clock() - self._last_flush >= self.flush_interval:
+            return self.flush()
+        return 0
+
+    def flush(self):
+        """Write all pending snapshots in one transaction; returns the number written"""
+        if not self._pending:
+            return 0
+        batch = self._pending
+        started = self._clock()
+        try:
+            with self.session_factory() as session, session.begin():
+                self._write(session, batch)
+        except Exception as e:
+            self.logger.error(f"Error flushing {len(batch)} snapshots: {str(e)}")
+            return 0
+        finally:
+            self._last_flush = self._clock()
+
+        self.last_flush_seconds = self._last_flush - started
+        self._pending = []
+        self.flushed += len(batch)
+        return len(batch)
+
+    def _write(self, session, batch):
+        snapshots = Snapshot.__table__
+        snapshot_ids = session.execute(
+            insert(snapshots).returning(snapshots.c.id, sort_by_parameter_order=True),
+            [{
+                'device_id': s['device_id'],
+                'timestamp': s['timestamp'],
+                'interval_seconds': s['interval_seconds']
+            } for s in batch]
+        ).scalars().all()
+
+        group_rows = {group: [] for group in GROUP_TABLES}
+        market_rows = []
+        summary_rows = []
+        for snapshot_id, sample in zip(snapshot_ids, batch):
+            for group, values in sample['groups'].items():
+                if group == 'crypto_metrics':
+                    market_rows.extend(price_rows(values, sample['timestamp']))
+                else:
+                    group_rows[group].append({'snapshot_id': snapshot_id, **values})
+            for metric, summary in sample['summaries'].items():
+                summary_rows.append({
+                    'snapshot_id': snapshot_id,
+                    'metric': metric,
+                    'sample_count': summary.count,
+                    'min': summary.min,
+                    'max': summary.max,
+                    'mean': summary.mean,
+                    'last': summary.last,
+                    'p95': summary.p95
+                })
+
+        for group, rows in group_rows.items():
+            if rows:
+                session.execute(insert(GROUP_TABLES[group]), _uniform(rows))
+        insert_prices(session, market_rows)
+        if summary_rows:
+            session.execute(insert(MetricSummary.__table__), summary_rows)
+
+        last_seen = {}
+        for sample in batch:
+            device_id = sample['device_id']
+            last_seen[device_id] = max(sample['timestamp'], last_seen.get(device_id, sample['timestamp']))
+        write_last_seen(session, last_seen)
+
+
+def _uniform(rows):
+    """executemany needs every row to bind the same columns"""
+    columns = set().union(*rows)
+    return [{column: row.get(column) for column in columns} for row in rows]
@@ -0,0 +1,563 @@
+import unittest
+import threading
+import time
+import contextlib
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from datetime import datetime, timedelta, UTC
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from collector_logging import JsonFormatter, SampleRateFilter, gzip_namer, gzip_rotator, setup_logging
+from metrics_collector import SourceRunner, apply_deadbands
+from overhead import OverheadMonitor
+from pressure import PressurePolicy
+from metrics_sdk.deadband import Deadband, DeadbandFilter
+from metrics_sdk.models import MetricSummary
+from scheduler import AlignedScheduler, next_boundary
+from market import MarketIngester, backfill_from_snapshots, crypto_as_of, insert_prices, load_series, price_rows, register_symbols, symbol_ids
+from models import Base, CryptoMetric, Device, Snapshot, SystemMetric, MarketPrice, MetricSummary as MetricSummaryRow
+from sources import CryptoPriceSource, HostStats, MetricSource, RingBuffer, SystemMetricsSource, _rate
+from storage import SnapshotBuffer
+
+# Disable logging during tests
+logging.getLogger('MetricsCollector').setLevel(logging.CRITICAL)
+
+class CountingSource(MetricSource):
+    name = 'counting'
+    group = 'system_metrics'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = 0
+
+    def collect(self):
+        self.calls += 1
+        return {'thread_count': self.calls}
+
+class HangingSource(MetricSource):
+    name = 'hanging'
+    group = 'crypto_metrics'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.release = threading.Event()
+
+    def collect(self):
+        self.release.wait()
+        return {'bitcoin_price_usd': 1.0}
+
+class TestSourceRunner(unittest.TestCase):
+    def test_hung_source_does_not_delay_others(self):
+        """A source stuck past its timeout must not hold up other sources."""
+        fast = CountingSource(interval=0.05, timeout=1)
+        hung = HangingSource(interval=0.05, timeout=0.1)
+        runner = SourceRunner([fast, hung])
+        runner.start()
+        try:
+            time.sleep(0.5)
+            self.assertGreaterEqual(fast.calls, 5)
+            groups = runner.latest()
+            self.assertIn('system_metrics', groups)
+            self.assertNotIn('crypto_metrics', groups)
+        finally:
+            hung.release.set()
+            runner.stop()
+
+    def test_groups_from_sources_are_merged(self):
+        """Each source's latest values appear under its group."""
+        class PriceSource(MetricSource):
+            name = 'price'
+            group = 'crypto_metrics'
+
+            def collect(self):
+                return {'bitcoin_price_usd': 50000.0, 'ethereum_price_usd': 3000.0}
+
+        runner = SourceRunner([CountingSource(interval=0.05), PriceSource(interval=0.05)])
+        runner.start()
+        try:
+            time.sleep(0.2)
+            groups = runner.latest()
+        finally:
+            runner.stop()
+        self.assertEqual(groups['crypto_metrics']['bitcoin_price_usd'], 50000.0)
+        self.assertIn('thread_count', groups['system_metrics'])
+
+class TestDeadbands(unittest.TestCase):
+    def test_unchanged_groups_are_dropped(self):
+        deadband_filter = DeadbandFilter({'ram_usage_percent': Deadband(absolute=1.0)})
+        groups = {'system_metrics': {'ram_usage_percent': 50.0}}
+        self.assertEqual(apply_deadbands(deadband_filter, groups, {})[0], groups)
+
+        groups, summaries = apply_deadbands(
+            deadband_filter, {'system_metrics': {'ram_usage_percent': 50.5}}, {}
+        )
+        self.assertEqual(groups, {})
+
+    def test_spike_in_summary_is_kept(self):
+        """A spike between snapshots is stored even if the last value is back in band."""
+        deadband_filter = DeadbandFilter({'ram_usage_percent': Deadband(absolute=1.0)})
+        apply_deadbands(deadband_filter, {'system_metrics': {'ram_usage_percent': 50.0}}, {})
+
+        spike = MetricSummary.from_values([50.0, 95.0, 50.2])
+        groups, summaries = apply_deadbands(
+            deadband_filter,
+            {'system_metrics': {'ram_usage_percent': 50.2}},
+            {'ram_usage_percent': spike}
+        )
+        self.assertEqual(groups, {})
+        self.assertEqual(summaries, {'ram_usage_percent': spike})
+
+    def test_idle_host_is_suppressed_between_heartbeats(self):
+        """Unbanded fields that change every sample do not make an idle host's snapshots due."""
+        clock = FakeClock(0.0)
+        deadband_filter = DeadbandFilter({'ram_usage_percent': Deadband(absolute=1.0),
+                                          'cpu_percent': Deadband(absolute=5.0)},
+                                         max_silence=300, clock=clock.monotonic)
+        stored = []
+        for tick in range(61):  # ten minutes at 10s
+            clock.now = tick * 10.0
+            noise = tick % 3 * 0.1
+            groups, summaries = apply_deadbands(deadband_filter, {'system_metrics': {
+                'ram_usage_percent': 40.0 + noise, 'cpu_percent': 2.0 + noise,
+                'cpu_per_core': [1.0 + noise, 3.0 - noise], 'load_1': 0.1 + noise,
+                'net_sent_bytes_per_sec': 1000.0 + tick
+            }}, {'cpu_percent': MetricSummary.from_values([2.0, 2.1]),
+                 'disk_read_bytes_per_sec': MetricSummary.from_values([0.0, float(tick)])})
+            if groups or summaries:
+                stored.append((clock.now, groups, summaries))
+
+        self.assertEqual([t for t, _, _ in stored], [0.0, 300.0, 600.0])
+        # The heartbeat carries the unbanded fields and summaries
+        _, groups, summaries = stored[1]
+        self.assertEqual(groups['system_metrics']['net_sent_bytes_per_sec'], 1030.0)
+        self.assertEqual(sorted(summaries), ['disk_read_bytes_per_sec'])
+
+        # A banded change sends the unbanded fields along with it
+        clock.now += 10
+        groups, summaries = apply_deadbands(deadband_filter, {'system_metrics': {
+            'ram_usage_percent': 60.0, 'cpu_percent': 2.0, 'load_1': 0.5}},
+            {'disk_read_bytes_per_sec': MetricSummary.from_values([0.0, 1.0])})
+        self.assertEqual(groups['system_metrics'], {'ram_usage_percent': 60.0, 'cpu_percent': None, 'load_1': 0.5})
+        self.assertEqual(list(summaries), ['disk_read_bytes_per_sec'])
+
+class TestHostStats(unittest.TestCase):
+    def test_thread_count_is_system_wide(self):
+        """Threads come from the total in /proc/loadavg, not the collector process."""
+        with tempfile.NamedTemporaryFile('w', suffix='loadavg', delete=False) as f:
+            f.write('0.50 0.40 0.30 2/1234 5678\n')
+        self.addCleanup(os.remove, f.name)
+        host = HostStats()
+        host.LOADAVG_PATH = f.name
+        values = host.sample()
+        self.assertEqual(values['thread_count'], 1234)
+        self.assertEqual((values['load_1'], values['load_5'], values['load_15']), (0.5, 0.4, 0.3))
+        # Rates and CPU busy time need two readings
+        self.assertIsNone(values['net_sent_bytes_per_sec'])
+        self.assertIsNone(values['cpu_percent'])
+        self.assertIsNone(values['cpu_per_core'])
+        values = host.sample()
+        self.assertIsNotNone(values['net_sent_bytes_per_sec'])
+        self.assertIsNotNone(values['cpu_percent'])
+        self.assertTrue(values['cpu_per_core'])
+
+    def test_rate(self):
+        self.assertEqual(_rate(300, 100, 2.0), 100.0)
+        self.assertIsNone(_rate(300, None, 2.0))
+        self.assertIsNone(_rate(50, 100, 2.0))  # counter reset
+
+class TestRingBuffer(unittest.TestCase):
+    def test_overwrites_oldest_when_full(self):
+        buffer = RingBuffer(3)
+        for value in range(5):
+            buffer.append(float(value))
+        self.assertEqual(buffer.drain(), [2.0, 3.0, 4.0])
+        self.assertEqual(buffer.drain(), [])
+
+    def test_drain_resets_window(self):
+        buffer = RingBuffer(10)
+        buffer.append(1.0)
+        buffer.drain()
+        buffer.append(2.0)
+        self.assertEqual(buffer.drain(), [2.0])
+
+class FakeClock:
+    """Wall and monotonic clocks that only move when told to."""
+    def __init__(self, start):
+        self.now = start
+
+    def wall(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+class TestAlignedScheduler(unittest.TestCase):
+    def test_next_boundary(self):
+        self.assertEqual(next_boundary(125.3, 60), 180)
+        self.assertEqual(next_boundary(120.0, 60), 180)
+        self.assertEqual(next_boundary(125.3, 60, phase=10), 130)
+
+    def test_ticks_are_aligned_and_do_not_drift(self):
+        """Work between ticks must not push later ticks off the boundaries."""
+        clock = FakeClock(1000.4)
+        scheduler = AlignedScheduler(1.0, wall_clock=clock.wall, clock=clock.monotonic)
+        # Waiting is simulated by advancing the clock inside the stop event
+        scheduler._stop.wait = lambda timeout: setattr(clock, 'now', clock.now + timeout)
+
+        stamps = []
+        for _ in range(100):
+            tick = scheduler.wait()
+            stamps.append(tick.scheduled)
+            clock.now += 0.3  # simulated collection work
+        self.assertEqual(stamps[0], datetime.fromtimestamp(1001, UTC).replace(tzinfo=None))
+        self.assertEqual(stamps[-1], datetime.fromtimestamp(1100, UTC).replace(tzinfo=None))
+        self.assertEqual(scheduler.skipped, 0)
+
+    def test_missed_ticks_are_coalesced(self):
+        clock = FakeClock(1000.0)
+        scheduler = AlignedScheduler(1.0, wall_clock=clock.wall, clock=clock.monotonic)
+        scheduler._stop.wait = lambda timeout: setattr(clock, 'now', clock.now + timeout)
+
+        scheduler.wait()
+        clock.now += 3.5  # a stall longer than three intervals
+        tick = scheduler.wait()
+        self.assertEqual(tick.skipped, 2)
+        self.assertEqual(tick.scheduled, datetime.fromtimestamp(1004, UTC).replace(tzinfo=None))
+        self.assertAlmostEqual(tick.lag, 0.5)
+
+class FakeProcess:
+    """Stands in for psutil.Process with a settable CPU time."""
+    def __init__(self):
+        self.cpu = 0.0
+
+    def cpu_times(self):
+        return type('cputimes', (), {'user': self.cpu, 'system': 0.0})()
+
+    def memory_info(self):
+        return type('meminfo', (), {'rss': 50 * 1024 * 1024})()
+
+    def oneshot(self):
+        return contextlib.nullcontext()
+
+class TestOverheadMonitor(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(0.0)
+        self.process = FakeProcess()
+        self.monitor = OverheadMonitor(budget_percent=1.0, max_factor=4, window=10.0,
+                                       process=self.process, clock=self.clock.monotonic)
+
+    def run_interval(self, cpu_percent, seconds=10.0):
+        self.clock.now += seconds
+        self.process.cpu += seconds * cpu_percent / 100
+        report = self.monitor.report(flush_seconds=0.01, latencies={'system': 0.002})
+        self.monitor.adjust()
+        return report
+
+    def test_report(self):
+        self.monitor.observe_lag(0.002)
+        self.monitor.observe_lag(0.005)
+        report = self.run_interval(0.5)
+        self.assertAlmostEqual(report['cpu_percent'], 0.5)
+        self.assertEqual(report['rss_bytes'], 50 * 1024 * 1024)
+        self.assertEqual(report['scheduling_lag_seconds'], 0.005)
+        self.assertEqual(report['source_latencies'], {'system': 0.002})
+        # Lag is reported as the maximum since the previous report
+        self.assertEqual(self.run_interval(0.5)['scheduling_lag_seconds'], 0.0)
+
+    def test_interval_backs_off_over_budget(self):
+        self.run_interval(5.0)  # start-up is ignored
+        self.assertEqual(self.monitor.factor, 1)
+        self.run_interval(0.8)
+        self.assertEqual(self.monitor.factor, 1)
+        self.run_interval(3.0)
+        self.assertEqual(self.monitor.factor, 2)
+        self.run_interval(3.0)
+        self.run_interval(3.0)
+        self.assertEqual(self.monitor.factor, 4)  # capped at max_factor
+        self.run_interval(0.8)
+        self.assertEqual(self.monitor.factor, 4)  # within budget: hold
+        self.run_interval(0.2)
+        self.assertEqual(self.monitor.factor, 2)
+
+    def test_budget_is_checked_over_whole_windows(self):
+        """A single busy tick inside a quiet window does not trigger a back-off."""
+        self.run_interval(0.0, seconds=1.0)
+        self.run_interval(5.0, seconds=1.0)
+        for _ in range(9):
+            self.run_interval(0.0, seconds=1.0)
+        self.assertEqual(self.monitor.factor, 1)
+        self.assertAlmostEqual(self.monitor.window_cpu_percent, 0.5)
+
+class TestPressurePolicy(unittest.TestCase):
+    def test_pressure_has_hysteresis(self):
+        policy = PressurePolicy(cpu_threshold=90, ram_threshold=90, hysteresis=5)
+        self.assertFalse(policy.update({'cpu_percent': 50.0, 'ram_usage_percent': 89.0}))
+        self.assertTrue(policy.update({'cpu_percent': 50.0, 'ram_usage_percent': 92.0}))
+        self.assertTrue(policy.under_pressure)
+        # Dropping just under the threshold is not enough to leave
+        self.assertFalse(policy.update({'cpu_percent': 50.0, 'ram_usage_percent': 88.0}))
+        self.assertTrue(policy.update({'cpu_percent': 50.0, 'ram_usage_percent': 84.0}))
+        self.assertFalse(policy.under_pressure)
+        # Missing system metrics keep the current state
+        self.assertFalse(policy.update(None))
+
+    def test_first_sample_does_not_trigger_pressure(self):
+        policy = PressurePolicy(cpu_threshold=90, ram_threshold=90)
+        # A first host sample has no CPU figures yet
+        self.assertFalse(policy.update({'cpu_percent': None, 'cpu_per_core': None, 'ram_usage_percent': 95.0}))
+        self.assertFalse(policy.under_pressure)
+        self.assertTrue(policy.update({'cpu_percent': 10.0, 'ram_usage_percent': 95.0}))
+
+    def test_missing_values_keep_their_last_reading(self):
+        policy = PressurePolicy(cpu_threshold=90, ram_threshold=90, hysteresis=5)
+        policy.update({'cpu_percent': 95.0, 'ram_usage_percent': 50.0})
+        self.assertTrue(policy.under_pressure)
+        self.assertFalse(policy.update({'cpu_percent': None, 'ram_usage_percent': 50.0}))
+        self.assertFalse(policy.update({'ram_usage_percent': 50.0}))
+        self.assertTrue(policy.under_pressure)
+        self.assertTrue(policy.update({'cpu_percent': 20.0}))
+
+    def test_intervals_under_pressure(self):
+        policy = PressurePolicy(speedup=4, backoff=4, min_interval=1.0)
+        system = SystemMetricsSource(interval=60)
+        crypto = CryptoPriceSource(interval=60)
+        hf = SystemMetricsSource(interval=1)
+        self.assertEqual(policy.source_interval(system), 60)
+
+        policy.update({'cpu_percent': 99.0})
+        self.assertEqual(policy.source_interval(system), 15)
+        self.assertEqual(policy.source_interval(crypto), 240)
+        self.assertEqual(policy.source_interval(hf), 1)  # never below min_interval
+        self.assertEqual(policy.source_interval(crypto, factor=2), 480)
+        self.assertEqual(policy.snapshot_interval(60), 15)
+
+class TestMarketPrices(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.addCleanup(self.session.close)
+
+    def test_prices_are_stored_once_per_interval(self):
+        """Every device reports the same price; one row per symbol and bucket is kept."""
+        for device in range(50):
+            insert_prices(self.session, price_rows(
+                {'bitcoin_price_usd': 50000.0 + device, 'ethereum_price_usd': 3000.0},
+                datetime(2024, 1, 1, 0, 0, device)
+            ))
+        self.assertEqual(self.session.query(MarketPrice).count(), 2)
+        bitcoin = self.session.get(MarketPrice, (symbol_ids(self.session, ['bitcoin'])['bitcoin'], 1704067200))
+        self.assertEqual(bitcoin.price, 50000.0)
+
+    def test_as_of_lookup(self):
+        for minute in range(0, 30, 10):
+            insert_prices(self.session, price_rows({'bitcoin_price_usd': 100.0 + minute}, datetime(2024, 1, 1, 0, minute)))
+        snapshots = [datetime(2024, 1, 1, 0, 5), datetime(2024, 1, 1, 0, 25, 30), datetime(2023, 12, 31, 23, 59)]
+        prices = crypto_as_of(self.session, snapshots)
+        self.assertEqual(prices[datetime(2024, 1, 1, 0, 5)]['bitcoin_price_usd'], 100.0)
+        self.assertEqual(prices[datetime(2024, 1, 1, 0, 25, 30)]['bitcoin_price_usd'], 120.0)
+        self.assertIsNone(prices[datetime(2024, 1, 1, 0, 5)]['ethereum_price_usd'])
+        self.assertNotIn(datetime(2023, 12, 31, 23, 59), prices)
+
+        # Sparse selections (per-timestamp seeks) give the same answer
+        far = datetime(2024, 6, 1)
+        sparse = crypto_as_of(self.session, snapshots + [far])
+        self.assertEqual(sparse[datetime(2024, 1, 1, 0, 25, 30)], prices[datetime(2024, 1, 1, 0, 25, 30)])
+        self.assertNotIn(far, sparse)  # beyond the as-of tolerance
+
+    def test_series_are_returned_columnar(self):
+        """Many symbols share one timestamp column; each bucket keeps its last price."""
+        symbols = [f'coin-{i}' for i in range(40)]
+        rows = [
+            {'symbol': symbol, 'ts': 1704067200 + minute * 60, 'price': float(i * 100 + minute)}
+            for i, symbol in enumerate(symbols) for minute in range(10)
+        ]
+        insert_prices(self.session, rows)
+        series = load_series(self.session, symbols + ['missing'],
+                             datetime(2024, 1, 1), datetime(2024, 1, 1, 0, 9), step=300)
+        self.assertEqual(series['timestamps'], [datetime(2024, 1, 1), datetime(2024, 1, 1, 0, 5)])
+        self.assertEqual(series['prices']['coin-3'], [304.0, 309.0])
+        self.assertEqual(series['prices']['missing'], [None, None])
+
+        # Long ranges are widened to at most max_points per series
+        wide = load_series(self.session, symbols, datetime(2024, 1, 1), datetime(2024, 1, 8), max_points=100)
+        self.assertLessEqual(len(wide['timestamps']), 101)
+        self.assertEqual(wide['step'] % 60, 0)
+
+    def test_ingester_fetches_enabled_symbols(self):
+        register_symbols(self.session, ['bitcoin', 'solana', 'dogecoin'])
+        register_symbols(self.session, ['dogecoin'], enabled=False)
+        self.session.commit()
+        requested = []
+
+        def fetch(symbols, timeout):
+            requested.append(symbols)
+            return {symbol: 1.0 for symbol in symbols}
+
+        ingester = MarketIngester(sessionmaker(bind=self.session.get_bind()), fetch=fetch)
+        self.assertEqual(ingester.run_once(datetime(2024, 1, 1, 0, 0, 30)), 2)
+        self.assertEqual(requested, [['bitcoin', 'solana']])
+        self.assertEqual(self.session.query(MarketPrice).filter_by(ts=1704067200).count(), 2)
+
+    def test_backfill_moves_legacy_crypto_rows(self):
+        device = Device(name='host', device_type='test')
+        self.session.add(device)
+        self.session.flush()
+        for second in range(0, 150, 30):
+            snapshot = Snapshot(device_id=device.id, timestamp=datetime(2024, 1, 1, 0, 0) + timedelta(seconds=second))
+            snapshot.crypto_metrics = CryptoMetric(bitcoin_price_usd=50000.0 + second, ethereum_price_usd=None)
+            self.session.add(snapshot)
+        self.session.commit()
+
+        self.assertEqual(backfill_from_snapshots(self.session, batch_size=2), 5)
+        self.assertEqual(self.session.query(CryptoMetric).count(), 0)
+        # One price per minute bucket; the first snapshot in each wins
+        self.assertEqual([p.price for p in self.session.query(MarketPrice).order_by(MarketPrice.ts)],
+                         [50000.0, 50060.0, 50120.0])
+        self.assertEqual(backfill_from_snapshots(self.session), 0)
+
+class TestCollectorLogging(unittest.TestCase):
+    def record(self, msg='Collected metrics', **extra):
+        record = logging.LogRecord('MetricsCollector', logging.INFO, __file__, 1, msg, None, None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_json_lines(self):
+        line = JsonFormatter().format(self.record(fields={'timestamp': datetime(2024, 1, 1), 'system_metrics': {'thread_count': 3}}))
+        self.assertNotIn('\n', line)
+        entry = json.loads(line)
+        self.assertEqual(entry['msg'], 'Collected metrics')
+        self.assertEqual(entry['system_metrics'], {'thread_count': 3})
+        self.assertEqual(entry['timestamp'], '2024-01-01T00:00:00')
+
+    def test_sample_records_are_rate_limited(self):
+        clock = FakeClock(0.0)
+        sample_filter = SampleRateFilter(interval=10, clock=clock.monotonic)
+        passed = []
+        for _ in range(25):
+            record = self.record(sample=True)
+            if sample_filter.filter(record):
+                passed.append(record)
+            clock.now += 1
+        self.assertEqual(len(passed), 3)
+        self.assertEqual(passed[1].suppressed, 9)
+        # Other records always pass
+        self.assertTrue(all(sample_filter.filter(self.record('Flushed')) for _ in range(5)))
+
+    def test_rotated_files_are_gzipped(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        source = os.path.join(directory, 'metrics.log.1')
+        with open(source, 'w') as f:
+            f.write('{"msg":"x"}\n' * 100)
+        dest = gzip_namer(source)
+        gzip_rotator(source, dest)
+        self.assertFalse(os.path.exists(source))
+        with gzip.open(dest, 'rt') as f:
+            self.assertEqual(len(f.readlines()), 100)
+
+    def test_other_loggers_share_the_pipeline(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'metrics.log')
+        logger, listener = setup_logging(path, name='TestCollector', also=('TestPriceFeed',))
+        feed_logger = logging.getLogger('TestPriceFeed')
+        for other in (logger, feed_logger):
+            self.addCleanup(other.removeHandler, other.handlers[-1])
+
+        logger.info('Collected metrics')
+        feed_logger.warning('Upstream rate limited')
+        listener.stop()
+
+        with open(path) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual([(e['logger'], e['msg']) for e in entries],
+                         [('TestCollector', 'Collected metrics'), ('TestPriceFeed', 'Upstream rate limited')])
+
+class TestSnapshotBuffer(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.Session = sessionmaker(bind=engine)
+        with self.Session() as session:
+            device = Device(name='host', device_type='test')
+            session.add(device)
+            session.commit()
+            self.device_id = device.id
+        self.clock = FakeClock(0.0)
+
+    def count(self, model):
+        with self.Session() as session:
+            return session.query(model).count()
+
+    def test_flushes_every_n_samples(self):
+        buffer = SnapshotBuffer(self.Session, max_samples=3, flush_interval=3600, clock=self.clock.monotonic)
+        for i in range(2):
+            buffer.add(self.device_id, datetime(2024, 1, 1, 0, 0, i), {'system_metrics': {'thread_count': i}})
+        self.assertEqual(self.count(Snapshot), 0)
+
+        written = buffer.add(
+            self.device_id, datetime(2024, 1, 1, 0, 0, 2),
+            {'system_metrics': {'thread_count': 2}, 'crypto_metrics': {'bitcoin_price_usd': 1.0}},
+            {'ram_usage_percent': MetricSummary.from_values([1.0, 2.0])},
+            interval_seconds=15.0
+        )
+        self.assertEqual(written, 3)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(self.count(Snapshot), 3)
+        self.assertEqual(self.count(SystemMetric), 3)
+        self.assertEqual(self.count(MarketPrice), 1)
+        self.assertEqual(self.count(MetricSummaryRow), 1)
+
+        # Children must land on the snapshot they were collected with
+        with self.Session() as session:
+            row = session.query(SystemMetric).filter_by(thread_count=2).one()
+            self.assertEqual(row.snapshot.timestamp, datetime(2024, 1, 1, 0, 0, 2))
+            self.assertEqual(row.snapshot.interval_seconds, 15.0)
+
+    def test_flush_moves_last_seen_forward(self):
+        buffer = SnapshotBuffer(self.Session, max_samples=100, clock=self.clock.monotonic)
+        for second in (5, 9, 7):
+            buffer.add(self.device_id, datetime(2024, 1, 1, 0, 0, second), {'system_metrics': {'thread_count': 1}})
+        buffer.flush()
+        with self.Session() as session:
+            self.assertEqual(session.get(Device, self.device_id).last_seen_at, datetime(2024, 1, 1, 0, 0, 9))
+
+        # An older late sample never moves it back
+        buffer.add(self.device_id, datetime(2024, 1, 1), {'system_metrics': {'thread_count': 1}})
+        buffer.flush()
+        with self.Session() as session:
+            self.assertEqual(session.get(Device, self.device_id).last_seen_at, datetime(2024, 1, 1, 0, 0, 9))
+
+    def test_flushes_after_interval(self):
+        buffer = SnapshotBuffer(self.Session, max_samples=100, flush_interval=10, clock=self.clock.monotonic)
+        buffer.add(self.device_id, datetime(2024, 1, 1), {'system_metrics': {'thread_count': 1}})
+        self.assertEqual(buffer.flush_if_due(), 0)
+        self.clock.now += 10
+        self.assertEqual(buffer.flush_if_due(), 1)
+        self.assertEqual(self.count(Snapshot), 1)
+
+    def test_pending_is_bounded_when_database_fails(self):
+        failing = sessionmaker(bind=create_engine('sqlite://'))  # no tables
+        buffer = SnapshotBuffer(failing, max_samples=2, max_pending=5, clock=self.clock.monotonic)
+        for i in range(20):
+            buffer.add(self.device_id, datetime(2024, 1, 1, 0, 0, i), {'system_metrics': {'thread_count': i}})
+        self.assertEqual(len(buffer), 5)
+        self.assertEqual(buffer.dropped, 15)
+
+        # The newest samples survive and are written once the database is back
+        buffer.session_factory = self.Session
+        self.assertEqual(buffer.flush(), 5)
+        with self.Session() as session:
+            counts = sorted(m.thread_count for m in session.query(SystemMetric))
+        self.assertEqual(counts, [15, 16, 17, 18, 19])
+
+if __name__ == '__main__':
+    unittest.main()
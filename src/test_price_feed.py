@@ -0,0 +1,173 @@
+import unittest
+import threading
+import time
+import logging
+
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+from metrics_sdk.breaker import CircuitBreaker
+from price_feed import PriceFeed, UpstreamError, create_app, fetch_coingecko, fetch_from_service, fetch_symbols
+
+# Disable logging during tests
+logging.getLogger('PriceFeed').setLevel(logging.CRITICAL)
+
+class StubUpstream:
+    """CoinGecko-compatible simple/price endpoint on a local port."""
+    def __init__(self):
+        self.calls = 0
+        self.batches = []
+        self.delay = 0.0
+        self.status = 200
+        self.retry_after = None
+        self.price = 50000.0
+        self._lock = threading.Lock()
+
+        app = Flask(__name__)
+
+        @app.route('/api/v3/simple/price')
+        def simple_price():
+            with self._lock:
+                self.calls += 1
+            time.sleep(self.delay)
+            if self.status != 200:
+                headers = {'Retry-After': str(self.retry_after)} if self.retry_after else {}
+                return jsonify({'error': 'rate limited'}), self.status, headers
+            ids = request.args['ids'].split(',')
+            self.batches.append(len(ids))
+            return jsonify({coin: {'usd': self.price if coin == 'bitcoin' else 3000.0}
+                            for coin in ids if not coin.startswith('unknown')})
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/api/v3/simple/price'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def fetch(self, timeout):
+        return fetch_coingecko(self.url, timeout)
+
+    def close(self):
+        self.server.shutdown()
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+class TestPriceFeed(unittest.TestCase):
+    def setUp(self):
+        self.upstream = StubUpstream()
+        self.clock = FakeClock()
+        self.feed = PriceFeed(self.upstream.fetch, ttl=60, stale_ttl=600, timeout=5,
+                              breaker=CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=self.clock),
+                              clock=self.clock)
+
+    def tearDown(self):
+        self.upstream.close()
+
+    def test_prices_are_cached_for_ttl(self):
+        self.assertEqual(self.feed.get()['bitcoin_price_usd'], 50000.0)
+        self.clock.now += 59
+        self.feed.get()
+        self.assertEqual(self.upstream.calls, 1)
+
+    def test_concurrent_cold_fetches_are_deduplicated(self):
+        """Many callers on an empty cache make a single upstream request."""
+        self.upstream.delay = 0.2
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.feed.get())) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.upstream.calls, 1)
+        self.assertTrue(all(r['bitcoin_price_usd'] == 50000.0 for r in results))
+
+    def test_stale_prices_are_served_while_revalidating(self):
+        self.feed.get()
+        self.upstream.price = 51000.0
+        self.upstream.delay = 0.2
+        self.clock.now += 120
+
+        started = time.monotonic()
+        prices = self.feed.get()
+        self.assertLess(time.monotonic() - started, 0.1)
+        self.assertEqual(prices['bitcoin_price_usd'], 50000.0)
+        self.assertTrue(wait_for(lambda: self.feed.get()['bitcoin_price_usd'] == 51000.0))
+        self.assertEqual(self.upstream.calls, 2)
+
+    def test_breaker_opens_on_upstream_errors(self):
+        self.feed.get()
+        self.upstream.status = 500
+        for _ in range(2):
+            self.clock.now += 700  # past stale_ttl: fetch synchronously
+            prices = self.feed.get()
+        self.assertEqual(self.feed.breaker.state, CircuitBreaker.OPEN)
+        # Prices older than stale_ttl are not served, and upstream is left alone
+        self.assertIsNone(prices['bitcoin_price_usd'])
+        self.assertIsNone(self.feed.get()['ethereum_price_usd'])
+        self.assertEqual(self.upstream.calls, 3)
+
+        # After the reset timeout one trial request closes the breaker again
+        self.upstream.status = 200
+        self.clock.now += 30
+        self.assertEqual(self.feed.get()['bitcoin_price_usd'], 50000.0)
+        self.assertEqual(self.upstream.calls, 4)
+        self.assertEqual(self.feed.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_retry_after_opens_breaker(self):
+        self.upstream.status = 429
+        self.upstream.retry_after = 120
+        prices = self.feed.get()
+        self.assertIsNone(prices['bitcoin_price_usd'])
+        self.assertEqual(self.feed.breaker.state, CircuitBreaker.OPEN)
+        self.clock.now += 60  # longer than reset_timeout, shorter than Retry-After
+        self.feed.get()
+        self.assertEqual(self.upstream.calls, 1)
+
+class TestFetchSymbols(unittest.TestCase):
+    def setUp(self):
+        self.upstream = StubUpstream()
+        self.addCleanup(self.upstream.close)
+
+    def test_symbols_are_fetched_in_batches(self):
+        symbols = ['bitcoin'] + [f'coin-{i}' for i in range(599)] + ['unknown-coin']
+        prices = fetch_symbols(symbols, url=self.upstream.url, batch_size=250)
+        self.assertEqual(self.upstream.batches, [250, 250, 101])
+        self.assertEqual(len(prices), 600)
+        self.assertEqual(prices['bitcoin'], 50000.0)
+        self.assertNotIn('unknown-coin', prices)
+
+    def test_rate_limit_stops_remaining_batches(self):
+        self.upstream.status = 429
+        self.upstream.retry_after = 30
+        with self.assertRaises(UpstreamError) as raised:
+            fetch_symbols([f'coin-{i}' for i in range(500)], url=self.upstream.url, batch_size=100)
+        self.assertEqual(raised.exception.retry_after, 30)
+        self.assertEqual(self.upstream.calls, 1)
+
+class TestPriceFeedService(unittest.TestCase):
+    def test_collectors_share_service_cache(self):
+        upstream = StubUpstream()
+        service = make_server('127.0.0.1', 0, create_app(PriceFeed(upstream.fetch)), threaded=True)
+        threading.Thread(target=service.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{service.server_port}'
+        try:
+            for _ in range(5):
+                prices = fetch_from_service(url, timeout=5)
+            self.assertEqual(prices['ethereum_price_usd'], 3000.0)
+            self.assertEqual(upstream.calls, 1)
+        finally:
+            service.shutdown()
+            upstream.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,706 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from sqlalchemy import inspect, text
+
+import api
+from commands import CommandNotifier, InvalidTransition, select_devices, transition_command
+from device_cache import DeviceListCache
+from export import MAX_BATCH_SIZE, parse_batch_size, main as export_main
+from liveness import LivenessTracker, utcnow
+from models import Base, Command, Device, DeviceTag, Snapshot, get_database_engine, upgrade_schema
+from storage import SnapshotBuffer
+
+
+class ApiTestCase(unittest.TestCase):
+    """Runs the API through Flask's test client against a fresh SQLite file."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = get_database_engine(os.path.join(self.directory, 'metrics.db'))
+        Base.metadata.create_all(self.engine)
+        api.Session.configure(bind=self.engine)
+        api.device_list_cache = DeviceListCache()
+        # The module's tracker flushes and refreshes from a thread; tests use their own
+        api.liveness.stop()
+        api.liveness = LivenessTracker()
+        api.command_notifier = CommandNotifier()
+        self.client = api.app.test_client()
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def register(self, *names, device_type='workstation'):
+        response = self.client.post('/v1/devices/batch', json={
+            'devices': [{'name': name, 'device_type': device_type} for name in names]
+        })
+        self.assertEqual(response.status_code, 200)
+        return [response.get_json()['devices'][name] for name in names]
+
+    def upload(self, *snapshots):
+        response = self.client.post('/v1/metrics/batch', json={'snapshots': list(snapshots)})
+        self.assertEqual(response.status_code, 201, response.get_json())
+        return response.get_json()['snapshot_ids']
+
+
+class TestDeviceRegistration(ApiTestCase):
+    def test_batch_upsert_is_idempotent(self):
+        response = self.client.post('/v1/devices/batch', json={'devices': [
+            {'name': 'batch-a', 'device_type': 'workstation'},
+            {'name': 'batch-b', 'device_type': 'workstation'},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        first = response.get_json()['devices']
+        self.assertEqual(set(first), {'batch-a', 'batch-b'})
+
+        again = self.client.post('/v1/devices/batch', json={'devices': [
+            {'name': 'batch-a', 'device_type': 'workstation'},
+            {'name': 'batch-b', 'device_type': 'workstation'},
+        ]}).get_json()['devices']
+        self.assertEqual(again, first)
+
+        session = api.get_db_session()
+        try:
+            rows = {d.name: d.id for d in session.query(Device)}
+        finally:
+            session.close()
+        self.assertEqual(rows, first)
+
+    def test_mixed_batch_updates_existing_and_inserts_new(self):
+        existing = self.client.post('/v1/devices', json={'name': 'batch-old', 'device_type': 'workstation'})
+        old_id = existing.get_json()['device_id']
+
+        response = self.client.post('/v1/devices/batch', json={'devices': [
+            {'name': 'batch-old', 'device_type': 'server'},
+            {'name': 'batch-new', 'device_type': 'server'},
+            {'name': 'batch-new', 'device_type': 'laptop'},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        devices = response.get_json()['devices']
+        self.assertEqual(devices['batch-old'], old_id)
+        self.assertNotEqual(devices['batch-new'], old_id)
+
+        session = api.get_db_session()
+        try:
+            types = {d.name: d.device_type for d in session.query(Device)}
+        finally:
+            session.close()
+        # Existing rows are updated in place; the last entry for a repeated name wins
+        self.assertEqual(types, {'batch-old': 'server', 'batch-new': 'laptop'})
+
+    def test_batch_rejects_entries_without_fields(self):
+        response = self.client.post('/v1/devices/batch', json={'devices': [{'name': 'batch-a'}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post('/v1/devices/batch', json={'devices': []}).status_code, 400)
+
+    def test_upgrade_merges_duplicate_names(self):
+        """Databases from before the unique index keep one device per name."""
+        with self.engine.begin() as connection:
+            connection.execute(text('DROP INDEX ix_devices_name'))
+        session = api.get_db_session()
+        try:
+            devices = [Device(name='dup', device_type='workstation', last_seen_at=datetime(2025, 1, 1, hour))
+                       for hour in (1, 3, 2)]
+            devices.append(Device(name='single', device_type='workstation'))
+            session.add_all(devices)
+            session.flush()
+            keep, first_extra, second_extra, single = (d.id for d in devices)
+            session.add_all([Snapshot(device_id=device_id, timestamp=datetime(2025, 1, 1))
+                             for device_id in (keep, first_extra, second_extra)])
+            session.add(Command(device_id=second_extra, command_type='restart_app', status='queued'))
+            session.add_all([DeviceTag(device_id=keep, tag='lab'), DeviceTag(device_id=first_extra, tag='lab'),
+                             DeviceTag(device_id=first_extra, tag='rack-1')])
+            session.commit()
+        finally:
+            session.close()
+
+        upgrade_schema(self.engine)
+
+        session = api.get_db_session()
+        try:
+            self.assertEqual(sorted(d.id for d in session.query(Device)), [keep, single])
+            self.assertEqual(session.get(Device, keep).last_seen_at, datetime(2025, 1, 1, 3))
+            self.assertEqual({s.device_id for s in session.query(Snapshot)}, {keep})
+            self.assertEqual(session.query(Snapshot).count(), 3)
+            self.assertEqual([c.device_id for c in session.query(Command)], [keep])
+            self.assertEqual(sorted((t.device_id, t.tag) for t in session.query(DeviceTag)),
+                             [(keep, 'lab'), (keep, 'rack-1')])
+        finally:
+            session.close()
+        indexes = {index['name']: index['unique'] for index in inspect(self.engine).get_indexes('devices')}
+        self.assertEqual(indexes['ix_devices_name'], 1)
+
+
+class TestDeviceListing(ApiTestCase):
+    def names(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [d['name'] for d in response.get_json()['devices']]
+
+    def test_cursor_pages_through_names_in_order(self):
+        self.register('node-c', 'node-a', 'node-e', 'node-b', 'node-d')
+        seen = []
+        cursor = ''
+        while True:
+            page = self.client.get(f'/v1/devices?limit=2&cursor={cursor}').get_json()
+            seen.append([d['name'] for d in page['devices']])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, [['node-a', 'node-b'], ['node-c', 'node-d'], ['node-e']])
+
+    def test_prefix_and_type_filters(self):
+        self.register('web-1', 'web-2', 'db-1')
+        self.register('web-3', device_type='server')
+        self.assertEqual(self.names(self.client.get('/v1/devices?prefix=web-')), ['web-1', 'web-2', 'web-3'])
+        self.assertEqual(self.names(self.client.get('/v1/devices?prefix=web-&device_type=server')), ['web-3'])
+        self.assertEqual(self.names(self.client.get('/v1/devices?prefix=x')), [])
+        self.assertEqual(self.client.get('/v1/devices?limit=0').status_code, 400)
+
+    def test_registration_invalidates_cached_pages(self):
+        self.register('node-a')
+        self.assertEqual(self.names(self.client.get('/v1/devices')), ['node-a'])
+        self.assertEqual(self.names(self.client.get('/v1/devices')), ['node-a'])
+        self.assertEqual(api.device_list_cache.stats()['hits'], 1)
+
+        self.client.post('/v1/devices', json={'name': 'node-b', 'device_type': 'workstation'})
+        self.assertEqual(self.names(self.client.get('/v1/devices')), ['node-a', 'node-b'])
+
+        self.register('node-c')
+        self.assertEqual(self.names(self.client.get('/v1/devices')), ['node-a', 'node-b', 'node-c'])
+
+    def test_page_read_before_invalidation_is_not_cached(self):
+        cache = DeviceListCache()
+        generation = cache.generation()
+        cache.invalidate()
+        cache.put('key', {'devices': []}, generation)
+        self.assertIsNone(cache.get('key'))
+
+    def test_least_recently_used_page_is_evicted(self):
+        cache = DeviceListCache(max_entries=2)
+        for key in ('a', 'b'):
+            cache.put(key, key, cache.generation())
+        cache.get('a')
+        cache.put('c', 'c', cache.generation())
+        self.assertEqual(cache.get('a'), 'a')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'c')
+        self.assertEqual(cache.stats()['entries'], 2)
+
+
+class FailingSession:
+    """Session whose writes fail, for exercising flush retries."""
+    def execute(self, *args, **kwargs):
+        raise RuntimeError('database is locked')
+
+    def rollback(self):
+        pass
+
+
+class TestLiveness(ApiTestCase):
+    def test_stale_walks_heap_oldest_first_up_to_cutoff(self):
+        tracker = LivenessTracker()
+        base = datetime(2025, 1, 1)
+        for device_id, minutes in ((1, 30), (2, 10), (3, 50), (4, 20), (5, 40)):
+            tracker.touch(device_id, base + timedelta(minutes=minutes))
+
+        cutoff = base + timedelta(minutes=35)
+        self.assertEqual([d for d, _ in tracker.stale(cutoff)], [2, 4, 1])
+        self.assertEqual([d for d, _ in tracker.stale(cutoff, limit=2)], [2, 4])
+        self.assertEqual(tracker.stale(base), [])
+
+    def test_superseded_entries_are_skipped_and_compacted(self):
+        tracker = LivenessTracker()
+        base = datetime(2025, 1, 1)
+        tracker.touch(1, base)
+        tracker.touch(2, base + timedelta(minutes=1))
+        tracker.touch(1, base + timedelta(minutes=5))
+        # An older report for a device is ignored
+        tracker.touch(2, base)
+
+        self.assertEqual(tracker.stale(base + timedelta(minutes=3)), [(2, base + timedelta(minutes=1))])
+        self.assertEqual(tracker.last_seen(1), base + timedelta(minutes=5))
+
+        for minute in range(200):
+            tracker.touch(1, base + timedelta(minutes=10 + minute))
+        self.assertLessEqual(len(tracker._heap), 2 * 2 + 64)
+        self.assertEqual([d for d, _ in tracker.stale(datetime.max)], [2, 1])
+
+    def test_failed_flush_is_retried_without_losing_newer_updates(self):
+        device_id, = self.register('node-a')
+        tracker = LivenessTracker()
+        tracker.touch(device_id, datetime(2025, 1, 1, 1))
+
+        with self.assertRaises(RuntimeError):
+            tracker.flush(FailingSession())
+        tracker.touch(device_id, datetime(2025, 1, 1, 2))
+
+        session = api.get_db_session()
+        try:
+            self.assertEqual(tracker.flush(session), 1)
+            self.assertEqual(session.get(Device, device_id).last_seen_at, datetime(2025, 1, 1, 2))
+            self.assertEqual(tracker.flush(session), 0)
+        finally:
+            session.close()
+
+    def test_background_flush_writes_pending_updates(self):
+        device_id, = self.register('node-a')
+        tracker = LivenessTracker(flush_interval=0.05)
+        tracker.touch(device_id, datetime(2025, 1, 1))
+        tracker.start(api.Session)
+        try:
+            deadline = time.monotonic() + 2
+            while tracker.summary(datetime.min)['pending_writes'] and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            tracker.stop()
+        session = api.get_db_session()
+        try:
+            self.assertEqual(session.get(Device, device_id).last_seen_at, datetime(2025, 1, 1))
+        finally:
+            session.close()
+
+    def test_stop_flushes_what_is_left(self):
+        device_id, = self.register('node-a')
+        tracker = LivenessTracker(flush_interval=3600)
+        tracker.start(api.Session)
+        tracker.touch(device_id, datetime(2025, 1, 1))
+        tracker.stop()
+        session = api.get_db_session()
+        try:
+            self.assertEqual(session.get(Device, device_id).last_seen_at, datetime(2025, 1, 1))
+        finally:
+            session.close()
+
+    def test_stale_endpoint_sees_collector_writes(self):
+        collector, uploader = self.register('node-collector', 'node-uploader')
+        buffer = SnapshotBuffer(api.Session, max_samples=1)
+        now = utcnow()
+        buffer.add(collector, now - timedelta(minutes=30), {'system_metrics': {'thread_count': 1}})
+        self.upload({'device_id': uploader, 'timestamp': now.isoformat()})
+        stale = self.client.get('/v1/devices/stale?older_than=5m').get_json()['devices']
+        self.assertEqual([d['device_id'] for d in stale], [collector])
+
+        # Written after the tracker loaded, and older than the newest report it has seen
+        buffer.add(collector, now - timedelta(seconds=10), {'system_metrics': {'thread_count': 1}})
+        self.assertEqual(self.client.get('/v1/devices/stale?older_than=5m').get_json()['devices'], [])
+        self.assertEqual(api.liveness.last_seen(collector), now - timedelta(seconds=10))
+        summary = self.client.get('/v1/devices/liveness?older_than=5m').get_json()
+        self.assertEqual((summary['tracked_devices'], summary['stale_devices']), (2, 0))
+
+    def test_stale_endpoint(self):
+        quiet, recent, never = self.register('node-quiet', 'node-recent', 'node-never')
+        now = utcnow()
+        self.upload(
+            {'device_id': quiet, 'timestamp': (now - timedelta(minutes=30)).isoformat()},
+            {'device_id': recent, 'timestamp': (now - timedelta(seconds=30)).isoformat()},
+        )
+
+        response = self.client.get('/v1/devices/stale?older_than=5m')
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual(body['older_than_seconds'], 300)
+        self.assertEqual([d['device_id'] for d in body['devices']], [quiet])
+        self.assertGreaterEqual(body['devices'][0]['seconds_since_seen'], 1800)
+
+        self.assertEqual(len(self.client.get('/v1/devices/stale?older_than=10s').get_json()['devices']), 2)
+        self.assertEqual(self.client.get('/v1/devices/stale?older_than=soon').status_code, 400)
+
+        summary = self.client.get('/v1/devices/liveness?older_than=5m').get_json()
+        self.assertEqual((summary['tracked_devices'], summary['stale_devices'], summary['never_seen_devices']),
+                         (2, 1, 1))
+
+
+class TestCommands(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device_id, = self.register('node-a')
+
+    def send(self, app_name='agent', device_id=None):
+        response = self.client.post(f'/v1/devices/{device_id or self.device_id}/commands', json={
+            'command_type': 'restart_app', 'params': {'app_name': app_name}
+        })
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()['command_id']
+
+    def poll(self, client=None, timeout=0, limit=10):
+        response = (client or self.client).get(
+            f'/v1/devices/{self.device_id}/commands/poll?timeout={timeout}&max={limit}'
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()['commands']
+
+    def set_status(self, command_id, status):
+        return self.client.post(f'/v1/commands/{command_id}/status', json={'status': status})
+
+    def test_poll_claims_queued_commands(self):
+        command_id = self.send()
+        self.assertEqual(self.client.get(f'/v1/commands/{command_id}').get_json()['status'], 'queued')
+
+        commands = self.poll()
+        self.assertEqual([c['command_id'] for c in commands], [command_id])
+        self.assertEqual(commands[0]['status'], 'delivered')
+        self.assertIsNotNone(commands[0]['delivered_at'])
+        self.assertEqual(commands[0]['params'], {'app_name': 'agent', 'force': False})
+        # A delivered command is not handed out again
+        self.assertEqual(self.poll(), [])
+
+    def test_concurrent_pollers_claim_each_command_once(self):
+        sent = {self.send(f'app-{i}') for i in range(20)}
+        barrier = threading.Barrier(2)
+        claimed = []
+
+        def poller():
+            client = api.app.test_client()
+            barrier.wait()
+            claimed.append([c['command_id'] for c in self.poll(client, limit=20)])
+
+        threads = [threading.Thread(target=poller) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        everything = claimed[0] + claimed[1]
+        self.assertEqual(len(everything), len(set(everything)))
+        self.assertEqual(set(everything), sent)
+
+    def test_status_updates_follow_the_state_machine(self):
+        command_id = self.send()
+        self.assertEqual(self.set_status(command_id, 'acked').status_code, 409)
+
+        self.poll()
+        self.assertEqual(self.set_status(command_id, 'acked').status_code, 200)
+        response = self.client.post(f'/v1/commands/{command_id}/status', json={'status': 'done', 'result': {'pid': 42}})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['result'], {'pid': 42})
+
+        # Final states are final
+        response = self.set_status(command_id, 'failed')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['status'], 'done')
+        self.assertEqual(self.set_status(command_id, 'bogus').status_code, 409)
+        self.assertEqual(self.set_status(9999, 'acked').status_code, 404)
+
+    def test_poll_times_out_empty(self):
+        started = time.monotonic()
+        self.assertEqual(self.poll(timeout=0.3), [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+    def test_send_wakes_a_waiting_poll(self):
+        result = {}
+
+        def poller():
+            started = time.monotonic()
+            result['commands'] = self.poll(api.app.test_client(), timeout=10)
+            result['seconds'] = time.monotonic() - started
+
+        thread = threading.Thread(target=poller)
+        thread.start()
+        time.sleep(0.2)
+        command_id = self.send()
+        thread.join(5)
+
+        self.assertEqual([c['command_id'] for c in result['commands']], [command_id])
+        self.assertLess(result['seconds'], 5)
+
+
+class TestFanOut(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.web_1, self.web_2, self.db_1 = self.register('web-1', 'web-2', 'db-1')
+        self.laptop, = self.register('laptop-1', device_type='laptop')
+        self.client.post('/v1/devices/tags', json={'device_ids': [self.web_1, self.web_2], 'tags': ['web']})
+        self.client.post('/v1/devices/tags', json={'device_ids': [self.web_1, self.db_1], 'tags': ['eu']})
+        self.client.put(f'/v1/devices/{self.laptop}/tags', json={'tags': ['web', 'eu']})
+
+    def fan_out(self, selector):
+        return self.client.post('/v1/commands/fanout', json={
+            'command_type': 'restart_app', 'params': {'app_name': 'agent'}, 'selector': selector
+        })
+
+    def selected(self, selector):
+        session = api.get_db_session()
+        try:
+            return set(session.execute(select_devices(selector)).scalars())
+        finally:
+            session.close()
+
+    def test_selector_resolution(self):
+        self.assertEqual(self.selected({'tags': ['web']}), {self.web_1, self.web_2, self.laptop})
+        # Every listed tag must match
+        self.assertEqual(self.selected({'tags': ['web', 'eu']}), {self.web_1, self.laptop})
+        self.assertEqual(self.selected({'tags': ['web'], 'device_type': 'workstation'}), {self.web_1, self.web_2})
+        self.assertEqual(self.selected({'device_ids': [self.db_1, self.laptop], 'tags': ['eu']}),
+                         {self.db_1, self.laptop})
+        self.assertEqual(self.selected({'device_type': 'server'}), set())
+
+    def test_fan_out_queues_one_command_per_device(self):
+        response = self.fan_out({'tags': ['web']})
+        self.assertEqual(response.status_code, 201)
+        batch = response.get_json()
+        self.assertEqual(batch['target_count'], 3)
+        self.assertEqual(batch['counts'], {'queued': 3, 'delivered': 0, 'acked': 0, 'done': 0, 'failed': 0})
+
+        session = api.get_db_session()
+        try:
+            commands = session.query(Command).filter_by(batch_id=batch['batch_id']).all()
+        finally:
+            session.close()
+        self.assertEqual({c.device_id for c in commands}, {self.web_1, self.web_2, self.laptop})
+        self.assertEqual({c.status for c in commands}, {'queued'})
+        self.assertEqual(commands[0].params, {'app_name': 'agent', 'force': False})
+
+    def test_batch_counts_follow_command_progress(self):
+        batch_id = self.fan_out({'tags': ['web']}).get_json()['batch_id']
+        delivered = {}
+        for device_id in (self.web_1, self.web_2):
+            commands = self.client.get(f'/v1/devices/{device_id}/commands/poll?timeout=0').get_json()['commands']
+            delivered[device_id] = commands[0]['command_id']
+
+        self.client.post(f'/v1/commands/{delivered[self.web_1]}/status', json={'status': 'acked'})
+        self.client.post(f'/v1/commands/{delivered[self.web_1]}/status', json={'status': 'done'})
+        self.client.post(f'/v1/commands/{delivered[self.web_2]}/status', json={'status': 'failed'})
+        # Rejected transitions leave the counts alone
+        self.client.post(f'/v1/commands/{delivered[self.web_2]}/status', json={'status': 'acked'})
+
+        batch = self.client.get(f'/v1/commands/batches/{batch_id}').get_json()
+        self.assertEqual(batch['counts'], {'queued': 1, 'delivered': 0, 'acked': 0, 'done': 1, 'failed': 1})
+
+    def test_concurrent_transition_is_applied_once(self):
+        batch_id = self.fan_out({'device_ids': [self.web_1]}).get_json()['batch_id']
+        command_id = self.client.get(f'/v1/devices/{self.web_1}/commands/poll?timeout=0').get_json()['commands'][0]['command_id']
+
+        # Both sessions saw the command as delivered before either reported
+        first, second = api.get_db_session(), api.get_db_session()
+        try:
+            first_command, second_command = first.get(Command, command_id), second.get(Command, command_id)
+            transition_command(first, first_command, 'acked')
+            first.commit()
+            with self.assertRaises(InvalidTransition):
+                transition_command(second, second_command, 'acked')
+            second.rollback()
+        finally:
+            first.close()
+            second.close()
+
+        batch = self.client.get(f'/v1/commands/batches/{batch_id}').get_json()
+        self.assertEqual(batch['counts']['acked'], 1)
+        self.assertEqual(batch['counts']['delivered'], 0)
+
+    def test_bad_selectors_are_rejected(self):
+        for selector in ({'device_ids': 'abc'}, {'device_ids': {'id': 1}}, {'device_ids': ['1']},
+                         {'device_ids': [True]}, {'tags': 'web'}, 'web', {}):
+            response = self.fan_out(selector)
+            self.assertEqual(response.status_code, 400, selector)
+
+
+    def test_bad_tag_requests_are_rejected(self):
+        for body in ({'device_ids': ['1'], 'tags': ['web']}, {'device_ids': [True], 'tags': ['web']},
+                     {'device_ids': self.web_1, 'tags': ['web']}, {'device_ids': [], 'tags': ['web']},
+                     {'device_ids': [self.web_1], 'tags': [1]}, {'device_ids': [self.web_1], 'tags': ['']},
+                     {'device_ids': [self.web_1], 'tags': 'web'}, {'device_ids': [self.web_1], 'tags': ['x' * 101]},
+                     {'device_ids': [self.web_1]}):
+            self.assertEqual(self.client.post('/v1/devices/tags', json=body).status_code, 400, body)
+        for tags in ([None], [' '], 'web', {'web': 1}):
+            self.assertEqual(self.client.put(f'/v1/devices/{self.web_1}/tags', json={'tags': tags}).status_code,
+                             400, tags)
+
+    def test_tags_for_unknown_devices_are_rejected(self):
+        response = self.client.post('/v1/devices/tags', json={'device_ids': [self.web_1, 9999], 'tags': ['new']})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['missing_device_ids'], [9999])
+        self.assertEqual(self.client.put('/v1/devices/9999/tags', json={'tags': ['new']}).status_code, 404)
+        # Nothing was written, not even for the device that exists
+        self.assertEqual(self.selected({'tags': ['new']}), set())
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.execute(text('SELECT COUNT(*) FROM device_tags WHERE device_id = 9999')).scalar(), 0)
+
+class TestMetricsRead(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device_id, = self.register('node-a')
+
+    def test_fill_previous_carries_suppressed_values(self):
+        self.upload(
+            {'device_id': self.device_id, 'timestamp': '2025-01-01T00:00:00',
+             'system_metrics': {'thread_count': 400, 'ram_usage_percent': 40.0, 'cpu_percent': 5.0},
+             'crypto_metrics': {'bitcoin_price_usd': 50000.0, 'ethereum_price_usd': 3000.0}},
+            # Deadbands dropped ram and cpu, then the whole group
+            {'device_id': self.device_id, 'timestamp': '2025-01-01T00:01:00',
+             'system_metrics': {'thread_count': 410}},
+            {'device_id': self.device_id, 'timestamp': '2025-01-01T00:02:00'},
+        )
+
+        raw = self.client.get(f'/v1/metrics?device_id={self.device_id}').get_json()
+        self.assertIsNone(raw[0]['system_metrics'])
+        self.assertIsNone(raw[1]['system_metrics']['ram_usage_percent'])
+
+        response = self.client.get(f'/v1/metrics?device_id={self.device_id}&fill=previous')
+        self.assertEqual(response.status_code, 200)
+        rows = sorted(response.get_json(), key=lambda r: r['timestamp'])
+        self.assertEqual([(r['system_metrics']['thread_count'], r['system_metrics']['ram_usage_percent'],
+                           r['system_metrics']['cpu_percent']) for r in rows],
+                         [(400, 40.0, 5.0), (410, 40.0, 5.0), (410, 40.0, 5.0)])
+        # Prices come from the market series as of each snapshot
+        self.assertEqual({r['crypto_metrics']['bitcoin_price_usd'] for r in rows}, {50000.0})
+
+    def test_fill_previous_looks_back_before_the_page(self):
+        self.upload(
+            {'device_id': self.device_id, 'timestamp': '2025-01-01T00:00:00',
+             'system_metrics': {'thread_count': 400, 'ram_usage_percent': 40.0}},
+            {'device_id': self.device_id, 'timestamp': '2025-01-01T00:01:00',
+             'system_metrics': {'thread_count': 410}},
+        )
+        rows = self.client.get(f'/v1/metrics?device_id={self.device_id}&limit=1&fill=previous').get_json()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['system_metrics']['thread_count'], 410)
+        self.assertEqual(rows[0]['system_metrics']['ram_usage_percent'], 40.0)
+
+
+class TestMetricsBatch(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device_id, self.other_id = self.register('node-a', 'node-b')
+
+    def test_batch_keeps_client_timestamps_and_updates_last_seen(self):
+        ids = self.upload(
+            {'device_id': self.device_id, 'timestamp': '2025-01-01T00:02:00', 'system_metrics': {'thread_count': 2}},
+            {'device_id': self.device_id, 'timestamp': '2025-01-01T00:01:00', 'system_metrics': {'thread_count': 1}},
+            {'device_id': self.other_id, 'timestamp': '2025-01-01T00:00:00+01:00'},
+        )
+        self.assertEqual(len(ids), 3)
+        self.assertNotIn(None, ids)
+
+        rows = self.client.get(f'/v1/metrics?device_id={self.device_id}').get_json()
+        self.assertEqual([(r['timestamp'], r['system_metrics']['thread_count']) for r in rows],
+                         [('2025-01-01T00:02:00', 2), ('2025-01-01T00:01:00', 1)])
+        # Latest timestamp per device, converted to UTC
+        self.assertEqual(api.liveness.last_seen(self.device_id), datetime(2025, 1, 1, 0, 2))
+        self.assertEqual(api.liveness.last_seen(self.other_id), datetime(2024, 12, 31, 23, 0))
+
+        session = api.get_db_session()
+        try:
+            api.liveness.flush(session)
+            self.assertEqual(session.get(Device, self.device_id).last_seen_at, datetime(2025, 1, 1, 0, 2))
+        finally:
+            session.close()
+
+    def test_invalid_entries_are_rejected_individually(self):
+        response = self.client.post('/v1/metrics/batch', json={'snapshots': [
+            {'device_id': self.device_id, 'timestamp': '2025-01-01T00:00:00'},
+            {'timestamp': '2025-01-01T00:00:00'},
+            {'device_id': 9999, 'timestamp': '2025-01-01T00:00:00'},
+            {'device_id': self.other_id, 'timestamp': 'yesterday'},
+            'not a snapshot',
+            {'device_id': self.other_id, 'timestamp': '2025-01-01T00:05:00'},
+        ]})
+        self.assertEqual(response.status_code, 201)
+        body = response.get_json()
+        ids = body['snapshot_ids']
+        self.assertEqual([i is not None for i in ids], [True, False, False, False, False, True])
+        self.assertEqual([e['index'] for e in body['errors']], [1, 2, 3, 4])
+        self.assertEqual(body['errors'][1]['error'], 'Device not found: 9999')
+        self.assertEqual(body['errors'][2]['error'], 'Invalid timestamp')
+
+        # Rejected entries do not count as reports
+        self.assertEqual(api.liveness.last_seen(self.other_id), datetime(2025, 1, 1, 0, 5))
+        self.assertEqual(len(self.client.get('/v1/snapshots').get_json()), 2)
+
+    def test_batch_with_nothing_valid_is_rejected(self):
+        response = self.client.post('/v1/metrics/batch', json={'snapshots': [{'device_id': 9999}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['errors'], [{'index': 0, 'error': 'Device not found: 9999'}])
+        self.assertIsNone(api.liveness.last_seen(9999))
+
+        self.assertEqual(self.client.post('/v1/metrics/batch', json={'snapshots': []}).status_code, 400)
+        too_many = [{'device_id': self.device_id}] * (api.MAX_BATCH_SNAPSHOTS + 1)
+        self.assertEqual(self.client.post('/v1/metrics/batch', json={'snapshots': too_many}).status_code, 400)
+
+
+class TestExport(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device_id, self.other_id = self.register('export-a', 'export-b')
+        self.upload(
+            {
+                'device_id': self.device_id,
+                'timestamp': '2025-01-01T00:00:00',
+                'interval_seconds': 60.0,
+                'system_metrics': {'thread_count': 400, 'ram_usage_percent': 41.5,
+                                   'cpu_percent': 12.5, 'cpu_per_core': [10.0, 15.0], 'load_1': 0.5},
+                'crypto_metrics': {'bitcoin_price_usd': 50000.0, 'ethereum_price_usd': 3000.0},
+                'summaries': {'ram_usage_percent': {'count': 60, 'min': 40.0, 'max': 43.0,
+                                                    'mean': 41.2, 'last': 41.5, 'p95': 42.8}}
+            },
+            {'device_id': self.other_id, 'timestamp': '2025-01-01T00:00:30',
+             'system_metrics': {'thread_count': 200, 'ram_usage_percent': 20.0}},
+            {'device_id': self.device_id, 'timestamp': '2025-01-01T00:01:00',
+             'system_metrics': {'thread_count': 410, 'ram_usage_percent': 42.0}},
+        )
+
+    def test_parquet_includes_host_metrics_and_summaries(self):
+        response = self.client.get('/v1/metrics/export?format=parquet')
+        self.assertEqual(response.status_code, 200)
+        rows = pq.read_table(io.BytesIO(response.data)).to_pylist()
+
+        self.assertEqual([row['thread_count'] for row in rows], [400, 200, 410])
+        first = rows[0]
+        self.assertEqual(first['device_id'], self.device_id)
+        self.assertEqual(first['interval_seconds'], 60.0)
+        self.assertEqual(first['cpu_percent'], 12.5)
+        self.assertEqual(json.loads(first['cpu_per_core']), [10.0, 15.0])
+        self.assertEqual(first['bitcoin_price_usd'], 50000.0)
+        self.assertEqual(first['summaries'], [{
+            'metric': 'ram_usage_percent', 'sample_count': 60, 'min': 40.0, 'max': 43.0,
+            'mean': 41.2, 'last': 41.5, 'p95': 42.8
+        }])
+        self.assertIsNone(rows[1]['summaries'])
+
+    def test_arrow_stream_pages_in_timestamp_order(self):
+        response = self.client.get(f'/v1/metrics/export?format=arrow&batch_size=1&device_id={self.device_id}')
+        self.assertEqual(response.status_code, 200)
+        reader = ipc.open_stream(io.BytesIO(response.data))
+        batches = list(reader)
+
+        self.assertEqual([batch.num_rows for batch in batches], [1, 1])
+        rows = [row for batch in batches for row in batch.to_pylist()]
+        self.assertEqual([row['thread_count'] for row in rows], [400, 410])
+        self.assertEqual({row['device_id'] for row in rows}, {self.device_id})
+
+    def test_time_range_and_bad_format(self):
+        response = self.client.get('/v1/metrics/export?start_time=2025-01-01T00:00:30Z')
+        rows = pq.read_table(io.BytesIO(response.data)).to_pylist()
+        self.assertEqual([row['thread_count'] for row in rows], [200, 410])
+
+        self.assertEqual(self.client.get('/v1/metrics/export?format=csv').status_code, 400)
+
+    def test_batch_size_is_range_checked(self):
+        for value in ('0', '-1', 'many'):
+            response = self.client.get(f'/v1/metrics/export?batch_size={value}')
+            self.assertEqual(response.status_code, 400, value)
+        self.assertEqual(parse_batch_size(10 ** 9), MAX_BATCH_SIZE)
+
+        with self.assertRaises(SystemExit):
+            export_main(['--batch-size', '0', '-o', os.path.join(self.directory, 'out.parquet')])
+
+    def test_unfiltered_export_does_not_sort(self):
+        """Paging over all devices walks the (timestamp, id) index instead of sorting."""
+        with self.engine.connect() as connection:
+            plan = ' '.join(row[-1] for row in connection.execute(text(
+                'EXPLAIN QUERY PLAN SELECT id FROM snapshots '
+                'WHERE timestamp > :ts OR (timestamp = :ts AND id > :id) ORDER BY timestamp, id LIMIT 10'
+            ), {'ts': '2025-01-01 00:00:00', 'id': 1}))
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
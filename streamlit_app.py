@@ -27,6 +27,11 @@ st.set_page_config(
 # Initialize the metrics client
 API_URL = os.getenv('API_URL', 'http://localhost:5000')
 
+@st.cache_resource
+def get_client(api_url, device_id):
+    """One client per API and device, reused across reruns"""
+    return MetricsClient(base_url=api_url, device_id=device_id)
+
 # Add API configuration to sidebar
 with st.sidebar:
     st.title("Dashboard Settings")
@@ -44,7 +49,7 @@ with st.sidebar:
     # Add API status indicator
     st.markdown("### API Status")
     try:
-        client = MetricsClient(base_url=API_URL, device_id=1)
+        client = get_client(API_URL, 1)
         # Try to get a single metric to test connection
         client.get_metrics(limit=1)
         st.success(f"✅ Connected to API")
@@ -239,20 +244,21 @@ def main():
                 )
                 st.plotly_chart(fig_system, use_container_width=True)
                 
-                # Crypto Prices Chart
+                # Crypto Prices Chart: every registered symbol in one request
+                market = client.get_market_prices(
+                    start_time=start_time,
+                    end_time=end_time,
+                    step=300 if time_range == "Last 24 Hours" else 1800
+                )
                 fig_crypto = go.Figure()
-                fig_crypto.add_trace(go.Scatter(
-                    x=df['timestamp'],
-                    y=df['bitcoin_price'],
-                    name='Bitcoin',
-                    mode='lines+markers'
-                ))
-                fig_crypto.add_trace(go.Scatter(
-                    x=df['timestamp'],
-                    y=df['ethereum_price'],
-                    name='Ethereum',
-                    mode='lines+markers'
-                ))
+                for symbol, prices in (market.prices.items() if market else []):
+                    fig_crypto.add_trace(go.Scatter(
+                        x=market.timestamps,
+                        y=prices,
+                        name=symbol.title(),
+                        mode='lines',
+                        connectgaps=True
+                    ))
                 fig_crypto.update_layout(
                     title='Cryptocurrency Prices Over Time',
                     yaxis=dict(title='Price (USD)'),
@@ -280,12 +286,23 @@ def main():
         # Device Commands Section
         st.header("Device Commands")
         
-        # Device selector
+        # Device search narrows the picker to one page of matching devices
+        device_search = st.text_input(
+            "Search Devices",
+            help="Filter devices by name prefix"
+        )
+        device_page = client.list_devices(prefix=device_search or None, limit=50)
+        device_names = {d['device_id']: d['name'] for d in device_page['devices']}
+        
+        # Device selector; defaults to the first listed device
         device_id = st.selectbox(
             "Select Device",
-            options=[1, 2, 3],
-            format_func=lambda x: f"Device {x}"
+            options=list(device_names),
+            format_func=lambda x: device_names.get(x, f"Device {x}"),
+            disabled=not device_names
         )
+        if not device_names:
+            st.info("No devices found")
         
         # Command section
         st.subheader("Restart App")
@@ -304,16 +321,13 @@ def main():
         )
         
         # Send command button
-        if st.button("Restart App", type="primary"):
+        if st.button("Restart App", type="primary", disabled=device_id is None):
             if not app_name:
                 st.error("Please enter an app name")
             else:
                 try:
-                    # Create client with selected device
-                    command_client = MetricsClient(
-                        base_url=API_URL,
-                        device_id=device_id
-                    )
+                    # Client for the selected device
+                    command_client = get_client(API_URL, device_id)
                     
                     # Send restart command
                     result = command_client.restart_app(app_name, force_restart)